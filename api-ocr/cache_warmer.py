@@ -0,0 +1,198 @@
+"""
+Warming of the image cache for all the pages of a IIIF document, ahead of a batch job.
+
+The `cache` nginx only fills on demand, so without warming, the first OCR of each page waits
+for a cold fetch from the upstream image server. `CacheWarmer` reads the IIIF manifest of a
+document (given as a Gallica ark identifier or a manifest URL), then requests every page image
+through the cache, with bounded concurrency and at a bounded rate toward the upstream.
+
+Pages are requested with HEAD requests: nginx fetches and stores the whole image on a miss
+(`proxy_cache_convert_head`, on by default), without sending it back, and reports whether the
+page was already cached with the `X-Cache-Status` header. Cached pages do not count toward
+the rate limit.
+"""
+
+import asyncio
+import logging
+import time
+from typing import Callable
+
+import httpx
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# `X-Cache-Status` values of pages served from the cache
+_CACHED_STATUSES = {"HIT", "STALE", "UPDATING", "REVALIDATED"}
+# Upstream statuses worth retrying later
+_RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+WARM_REQUESTS = metrics.Counter(
+    "mezanno_cache_warmer_requests_total",
+    "Page requests of cache warming, by HTTP status ('error' for network errors) and X-Cache-Status of the image cache.",
+    ["status", "cache_status"])
+
+
+class _RateLimiter:
+    """Spaces request starts by at least `1 / max_per_sec` seconds."""
+    def __init__(self, max_per_sec: float):
+        self._interval = 1 / max_per_sec if max_per_sec > 0 else 0.
+        self._next_start = 0.
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next_start)
+            self._next_start = start + self._interval
+        await asyncio.sleep(start - now)
+
+    def refund(self):
+        """Gives back the slot of a request which did not reach the upstream server."""
+        self._next_start -= self._interval
+
+
+def _iiif_image_services(manifest: dict) -> list[str]:
+    """Ids of the image services of the canvases of a IIIF Presentation manifest (version 2 or 3)."""
+    services = []
+    if "items" in manifest:
+        # Presentation API 3: canvas > annotation page > painting annotation > body
+        for canvas in manifest["items"]:
+            body = canvas["items"][0]["items"][0]["body"]
+            service = body.get("service") or [{}]
+            service = service[0] if isinstance(service, list) else service
+            services.append(service.get("id") or service.get("@id"))
+    else:
+        # Presentation API 2: sequence > canvas > image > resource
+        for canvas in manifest["sequences"][0]["canvases"]:
+            service = canvas["images"][0]["resource"].get("service") or {}
+            services.append(service.get("@id") or service.get("id"))
+    if not all(services):
+        raise ValueError("Manifest has canvases without image service.")
+    return [service.rstrip("/") for service in services]
+
+
+class CacheWarmer:
+    """Requests all the page images of IIIF documents through the image cache."""
+    def __init__(self, rewrite_url: Callable[[str], str], manifest_url_template: str,
+                 default_image_path: str = "full/max/0/default.jpg", concurrency: int = 4,
+                 max_requests_per_sec: float = 2., max_retries: int = 3, timeout_sec: float = 60.):
+        """
+        Args:
+            rewrite_url: Maps an upstream image URL to the URL of the same image through the cache.
+            manifest_url_template: Manifest URL of an ark identifier (`{ark}` is replaced by it).
+            default_image_path: Image request appended to the image service of each page, which must match
+                the URLs of the later OCR requests (only identical URLs hit the cache).
+            concurrency: Max number of pages requested at the same time.
+            max_requests_per_sec: Max rate of requests reaching the upstream server (cache misses).
+            max_retries: Retries of pages whose request failed with a transient error (429, 5xx, network).
+            timeout_sec: Timeout of each request.
+        """
+        self._rewrite_url = rewrite_url
+        self._manifest_url_template = manifest_url_template
+        self._default_image_path = default_image_path
+        self._concurrency = concurrency
+        self._rate_limiter = _RateLimiter(max_requests_per_sec)
+        self._max_retries = max_retries
+        self._client = httpx.AsyncClient(timeout=timeout_sec, follow_redirects=True)
+
+    def manifest_url(self, document: str) -> str:
+        """URL of the manifest of a document given as an ark identifier or a manifest URL."""
+        document = document.strip()
+        if document.startswith(("http://", "https://")):
+            return document
+        if document.startswith("ark:/"):
+            return self._manifest_url_template.format(ark=document)
+        raise ValueError(f"Invalid document {document!r}: expected an ark identifier (ark:/...) or a manifest URL.")
+
+    async def page_urls(self, document: str, image_path: str | None = None) -> list[str]:
+        """Upstream image URLs of the pages of a document."""
+        response = await self._client.get(self.manifest_url(document))
+        response.raise_for_status()
+        image_path = (image_path or self._default_image_path).strip("/")
+        return [f"{service}/{image_path}" for service in _iiif_image_services(response.json())]
+
+    async def _warm_page(self, cache_url: str) -> str:
+        """Requests a page through the cache, returning "cached" or "fetched"; raises on failure."""
+        for attempt in range(self._max_retries + 1):
+            await self._rate_limiter.acquire()
+            try:
+                response = await self._client.head(cache_url)
+                if response.status_code == 405:
+                    # Server without HEAD support: read the image instead
+                    async with self._client.stream("GET", cache_url) as response:
+                        async for _chunk in response.aiter_raw():
+                            pass
+            except httpx.HTTPError as e:
+                WARM_REQUESTS.inc(status="error", cache_status="none")
+                error = f"Cannot request page: {e!r}"
+                retry_after = None
+            else:
+                cache_status = response.headers.get("X-Cache-Status", "").upper()
+                WARM_REQUESTS.inc(status=response.status_code, cache_status=cache_status.lower() or "none")
+                if response.status_code == 200:
+                    if cache_status in _CACHED_STATUSES:
+                        self._rate_limiter.refund()
+                        return "cached"
+                    return "fetched"
+                if response.status_code not in _RETRY_STATUSES:
+                    raise RuntimeError(f"Image server returned status {response.status_code}.")
+                error = f"Image server returned status {response.status_code}."
+                retry_after = response.headers.get("Retry-After")
+            if attempt < self._max_retries:
+                delay = float(retry_after) if retry_after and retry_after.isdigit() else 2. ** attempt
+                logger.warning(f"{error} Retrying {cache_url} in {delay} seconds.")
+                await asyncio.sleep(delay)
+        raise RuntimeError(error)
+
+    async def warm(self, document: str, image_path: str = ""):
+        """Warms the cache for all the pages of a document, yielding progress after each page.
+
+        Each page yields `{"page_index", "image_url", "status": "cached" | "fetched" | "failed", "done", "total"}`
+        (with an `"error"` for failed pages). The last value summarizes the document
+        (`page_count`, `cached`, `fetched` and `failed_pages`), or holds an `"error"` if the manifest
+        cannot be read.
+        """
+        logger.info(f"Received request to warm the cache for document: {document}")
+        try:
+            page_urls = await self.page_urls(document, image_path or None)
+        except (ValueError, KeyError, IndexError, TypeError, httpx.HTTPError) as e:
+            yield {"error": f"Cannot read the manifest of {document!r}: {e!r}"}
+            return
+
+        semaphore = asyncio.Semaphore(self._concurrency)
+        async def warm_page(page_index: int, image_url: str) -> dict:
+            async with semaphore:
+                page = {"page_index": page_index, "image_url": image_url}
+                try:
+                    page["status"] = await self._warm_page(self._rewrite_url(image_url))
+                except Exception as e:
+                    page["status"], page["error"] = "failed", str(e)
+                return page
+
+        counts = {"cached": 0, "fetched": 0, "failed": 0}
+        failed_pages = []
+        page_tasks = [asyncio.create_task(warm_page(page_index, image_url))
+                      for page_index, image_url in enumerate(page_urls)]
+        try:
+            for done, page_task in enumerate(asyncio.as_completed(page_tasks), start=1):
+                page = await page_task
+                counts[page["status"]] += 1
+                if page["status"] == "failed":
+                    failed_pages.append(page["page_index"])
+                yield {**page, "done": done, "total": len(page_urls)}
+        finally:
+            for page_task in page_tasks:
+                page_task.cancel()
+        logger.info(f"Cache warmed for document {document}: {counts}")
+        yield {
+            "document": document,
+            "page_count": len(page_urls),
+            "cached": counts["cached"],
+            "fetched": counts["fetched"],
+            "failed_pages": sorted(failed_pages),
+        }
+
+    async def aclose(self):
+        await self._client.aclose()
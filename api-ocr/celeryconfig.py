@@ -1,2 +1,33 @@
+import os
+
+from kombu import Exchange, Queue
+
 # This is needed because we need to accept bytes objects we can be serialized by pickle only
 # CELERY_ACCEPT_CONTENT = ['pickle', 'json', 'msgpack', 'yaml']
+
+# Task results are serialized with msgpack, so that compact OCR results (bytes,
+# see compact_result.py) go through the result backend as they are
+result_serializer = "msgpack"
+result_accept_content = ["json", "msgpack"]
+
+# OCR task queues, from the most to the least latency-sensitive: interactive requests,
+# other single page requests, and batch requests (see api-ocr/task_routing.py).
+# Must match ocr-worker/celeryconfig.py
+OCR_QUEUES = ("ocr-interactive", "ocr-standard", "ocr-bulk")
+# Priority of tasks within a queue, from 0 to OCR_MAX_PRIORITY (RabbitMQ priority queues)
+OCR_MAX_PRIORITY = 9
+task_queues = [Queue(name, Exchange("ocr", type="direct"), routing_key=name,
+                     queue_arguments={"x-max-priority": OCR_MAX_PRIORITY})
+               for name in OCR_QUEUES]
+task_default_queue = "ocr-standard"
+
+# Local broker without RabbitMQ, for offline benchmarks (`filesystem://` broker URL, see api-ocr/load_test.py):
+# messages are files in a directory shared by the API and the workers
+if os.environ.get("CELERY_BROKER_URL", "").startswith("filesystem://"):
+    _broker_dir = os.environ.get("FILESYSTEM_BROKER_DIR", "/tmp/mezanno-broker")
+    broker_transport_options = {
+        "data_folder_in": _broker_dir,
+        "data_folder_out": _broker_dir,
+        "control_folder": os.path.join(_broker_dir, "control"),
+        "polling_interval": float(os.environ.get("FILESYSTEM_BROKER_POLLING_SEC", 0.01)),
+    }
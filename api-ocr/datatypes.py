@@ -1,4 +1,4 @@
-from typing import TypeAlias
+from typing import Literal, TypeAlias
 from pydantic import BaseModel, TypeAdapter
 
 class ImageRegion(BaseModel):
@@ -11,9 +11,37 @@ class ImageRegion(BaseModel):
 ImageRegionList: TypeAlias = list[ImageRegion]
 ImageRegionListModel = TypeAdapter(ImageRegionList)
 
+class OCRPage(BaseModel):
+    image_url: str
+    regions: ImageRegionList = []
+# Sample list of OCRPage objects:
+# [{"image_url": "https://picsum.photos/200/300", "regions": []}, {"image_url": "https://picsum.photos/100"}]
+OCRPageList: TypeAlias = list[OCRPage]
+OCRPageListModel = TypeAdapter(OCRPageList)
+
+# Custom Celery task state used by the worker to publish each page of a batch
+# as soon as it is ready (must match `PAGE_DONE_STATE` in ocr-worker/worker.py)
+PAGE_DONE_STATE = "PAGE_DONE"
+# Custom Celery task state used by the worker to publish each region of a page
+# as soon as it is ready (must match `REGION_DONE_STATE` in ocr-worker/worker.py)
+REGION_DONE_STATE = "REGION_DONE"
+# Custom Celery task state stored by the API for jobs whose task was sent but has not finished
+# (see `OCRProxy.submit_job`), so that known jobs can be told from unknown ones (PENDING)
+JOB_SUBMITTED_STATE = "SUBMITTED"
+
 # OCRMode is a string that indicates the mode of OCR processing.
 #  "block" will detect lines and transcribe them, "line" will directly transcribe lines
-# OCRMode = Literal["block", "line"]
+#  (each region is a single line, e.g. a line box from the layout worker)
+# Must match `OCR_MODES` in ocr-worker/worker.py
+OCRMode = Literal["block", "line"]
+
+
+class OCRJobRequest(BaseModel):
+    image_url: str
+    regions: ImageRegionList = []
+    mode: OCRMode = "block"
+# Sample OCRJobRequest:
+# {"image_url": "https://picsum.photos/200/300", "regions": [{"xtl": 0, "ytl": 0, "xbr": 200, "ybr": 100}]}
 
 
 class LineTranscription(BaseModel):
@@ -29,4 +57,5 @@ class OCREngineInfo(BaseModel):
 
 class OCRResult(BaseModel):
     ocr_engine: OCREngineInfo
+    mode: OCRMode = "block"
     lines: list[LineTranscription]
\ No newline at end of file
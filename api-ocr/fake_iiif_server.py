@@ -0,0 +1,131 @@
+"""
+Local stand-in for a IIIF server (manifests and images), to test the cache warmer and the OCR pipeline
+without sending requests to Gallica.
+
+Serves, for any ark identifier:
+- `/iiif/presentation/v3/{ark}/manifest.json`: a Presentation API 3 manifest of `--pages` pages,
+- `/iiif/image/v3/{ark}/f{n}/{region}/{size}/{rotation}/{quality}.{format}`: a blank PNG page
+  (of the requested `w,h` size, of the size of the requested `x,y,w,h` region, `--width` x `--height`
+  otherwise), after `--latency_sec`.
+
+Example:
+    python fake_iiif_server.py --port 8900 --pages 20
+    # then, with --iiif_manifest_url_template http://localhost:8900/iiif/presentation/v3/{ark}/manifest.json,
+    # warm the cache for document ark:/12148/fake
+"""
+
+import argparse
+import json
+import re
+import struct
+import time
+import zlib
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+_MANIFEST_RE = re.compile(r"^/iiif/presentation/v3/(?P<ark>.+)/manifest\.json$")
+_IMAGE_RE = re.compile(r"^/iiif/image/v3/(?P<ark>.+)/f(?P<page>\d+)/(?P<region>[^/]+)/(?P<size>[^/]+)/[^/]+/[^/]+\.\w+$")
+
+
+@lru_cache(maxsize=64)
+def _png(width: int, height: int) -> bytes:
+    """A white grayscale PNG image."""
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF)
+    rows = b"".join(b"\x00" + b"\xff" * width for _ in range(height))
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 0, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(rows)) + chunk(b"IEND", b""))
+
+
+class FakeIIIFHandler(BaseHTTPRequestHandler):
+    # Set by `main`
+    page_count = 10
+    page_size = (1000, 1500)
+    latency_sec = 0.
+
+    def _base_url(self) -> str:
+        return f"http://{self.headers.get('Host', 'localhost')}"
+
+    def _manifest(self, ark: str) -> dict:
+        width, height = self.page_size
+        canvases = []
+        for page in range(1, self.page_count + 1):
+            canvas_id = f"{self._base_url()}/iiif/presentation/v3/{ark}/canvas/f{page}"
+            service_id = f"{self._base_url()}/iiif/image/v3/{ark}/f{page}"
+            canvases.append({
+                "id": canvas_id, "type": "Canvas", "width": width, "height": height,
+                "items": [{
+                    "id": f"{canvas_id}/page", "type": "AnnotationPage",
+                    "items": [{
+                        "id": f"{canvas_id}/image", "type": "Annotation", "motivation": "painting", "target": canvas_id,
+                        "body": {
+                            "id": f"{service_id}/full/max/0/default.png", "type": "Image", "format": "image/png",
+                            "width": width, "height": height,
+                            "service": [{"id": service_id, "type": "ImageService3", "profile": "level1"}],
+                        },
+                    }],
+                }],
+            })
+        return {
+            "@context": "http://iiif.io/api/presentation/3/context.json",
+            "id": f"{self._base_url()}/iiif/presentation/v3/{ark}/manifest.json",
+            "type": "Manifest",
+            "label": {"none": [f"Fake document {ark}"]},
+            "items": canvases,
+        }
+
+    def _send(self, status: int, content_type: str, body: bytes, with_body: bool = True):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if with_body:
+            self.wfile.write(body)
+
+    def _handle(self, with_body: bool):
+        match = _MANIFEST_RE.match(self.path)
+        if match:
+            self._send(200, "application/json", json.dumps(self._manifest(match["ark"])).encode(), with_body)
+            return
+        match = _IMAGE_RE.match(self.path)
+        if match and 1 <= int(match["page"]) <= self.page_count:
+            time.sleep(self.latency_sec)
+            width, height = self.page_size
+            region = re.match(r"^(\d+),(\d+),(\d+),(\d+)$", match["region"])
+            if region:
+                x, y, w, h = (int(value) for value in region.groups())
+                width, height = max(1, min(w, width - x)), max(1, min(h, height - y))
+            size = re.match(r"^(\d+),(\d+)$", match["size"])
+            if size:
+                width, height = int(size[1]), int(size[2])
+            self._send(200, "image/png", _png(width, height), with_body)
+            return
+        self._send(404, "text/plain", b"Not found.", with_body)
+
+    def do_GET(self):
+        self._handle(with_body=True)
+
+    def do_HEAD(self):
+        self._handle(with_body=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for a IIIF server")
+    parser.add_argument("--host", default="0.0.0.0", type=str, help="Listening address")
+    parser.add_argument("--port", default=8900, type=int, help="Listening port")
+    parser.add_argument("--pages", default=10, type=int, help="Number of pages of each document")
+    parser.add_argument("--width", default=1000, type=int, help="Width of page images")
+    parser.add_argument("--height", default=1500, type=int, help="Height of page images")
+    parser.add_argument("--latency_sec", default=0., type=float, help="Delay before sending each image")
+    args = parser.parse_args()
+
+    FakeIIIFHandler.page_count = args.pages
+    FakeIIIFHandler.page_size = (args.width, args.height)
+    FakeIIIFHandler.latency_sec = args.latency_sec
+    server = ThreadingHTTPServer((args.host, args.port), FakeIIIFHandler)
+    print(f"Fake IIIF server listening on {args.host}:{args.port}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
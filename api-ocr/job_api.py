@@ -0,0 +1,66 @@
+"""
+Asynchronous job API of the OCR API, served next to the Gradio interface.
+
+Gradio requests hold their connection (and a slot of `GRADIO_CONCURRENCY_LIMIT`) until the page
+is transcribed. Jobs do not: `POST /jobs` sends the page task and answers its job id at once,
+then clients poll `GET /jobs/{job_id}` (long polling with `wait_sec`) and fetch the answer with
+`GET /jobs/{job_id}/result`. Job states live in the result backend, so outstanding jobs cost no
+server resources, and any replica can answer for them; the result backend must therefore be
+persistent and shared (e.g. Redis, not `rpc://`).
+"""
+
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import JSONResponse
+
+from compact_result import RESULT_FORMATS
+from datatypes import ImageRegionListModel, OCRJobRequest
+import tracing
+
+
+def create_job_router(ocr_proxy, max_wait_sec: float = 30.) -> APIRouter:
+    """
+    Routes of the job API.
+
+    Args:
+        ocr_proxy (OCRProxy): Proxy sending the tasks and reading their states.
+        max_wait_sec (float): Max long polling duration of a request, in seconds.
+    """
+    router = APIRouter(prefix="/jobs", tags=["jobs"])
+
+    def clamp_wait(wait_sec: float) -> float:
+        return min(max(wait_sec, 0.), max_wait_sec)
+
+    @router.post("", status_code=202)
+    async def submit_job(job: OCRJobRequest, request: Request) -> dict:
+        """Sends a page to transcribe, and returns `{"job_id": str, "status": str}` without waiting."""
+        with tracing.span("api.submit_job", traceparent=request.headers.get(tracing.TRACEPARENT_HEADER),
+                          image_url=job.image_url, mode=job.mode):
+            answer = await ocr_proxy.submit_job(job.image_url, ImageRegionListModel.dump_json(job.regions).decode("utf-8"),
+                                                job.mode)
+        if "error" in answer:
+            raise HTTPException(status_code=422, detail=answer["error"])
+        return answer
+
+    @router.get("/{job_id}")
+    async def get_job(job_id: str, wait_sec: float = 0.) -> dict:
+        """Status of a job; if it is not finished, waits at most `wait_sec` seconds for it to finish."""
+        status = await ocr_proxy.job_status(job_id, clamp_wait(wait_sec))
+        if status is None:
+            raise HTTPException(status_code=404, detail=f"Unknown or expired job {job_id}.")
+        return status
+
+    @router.get("/{job_id}/result")
+    async def get_job_result(job_id: str, result_format: str = "json", wait_sec: float = 0.):
+        """Answer of a finished job, as the answer of `transcribe` (with a 202 status and the job status
+        if it is not finished after waiting at most `wait_sec` seconds)."""
+        if result_format not in RESULT_FORMATS:
+            raise HTTPException(status_code=422, detail=f"Invalid result format {result_format!r},"
+                                                        f" valid formats are: {', '.join(RESULT_FORMATS)}")
+        status, answer = await ocr_proxy.job_result(job_id, result_format, clamp_wait(wait_sec))
+        if status is None:
+            raise HTTPException(status_code=404, detail=f"Unknown or expired job {job_id}.")
+        if answer is None:
+            return JSONResponse(status, status_code=202)
+        return answer
+
+    return router
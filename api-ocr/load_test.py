@@ -0,0 +1,476 @@
+"""
+Load test of the OCR API and of the layout wrapper, offline, with local stand-ins for every external dependency.
+
+By default, the whole stack runs on this machine:
+- a fake IIIF image server (fake_iiif_server.py) instead of `openapi.bnf.fr`,
+- a local broker instead of RabbitMQ (`filesystem://` broker and `file://` result backend,
+  see celeryconfig.py),
+- an OCR worker (ocr-worker/worker.py) with the stub OCR engine of ocr-worker/stub_ocr_driver.py,
+  whose cost per line is configurable,
+- the layout wrapper (layout-worker-wrapper/worker_wrapper.py), in front of fake layout services
+  (layout-worker-wrapper/fake_layout_service.py).
+Any of them can be replaced by a running service (`--image_url_template`, `--celery_broker_url`
+and `--celery_result_backend`, `--layout_url`), e.g. to measure the real OCR engine.
+
+Requests are sent by `--concurrency` concurrent clients, in a random mix of kinds (`--mix`):
+- `ocr_regions`: `OCRProxy.transcribe` of a few small regions of a page,
+- `ocr_page`: `OCRProxy.transcribe` of a whole page,
+- `ocr_lines`: `OCRProxy.transcribe` of single lines (line mode),
+- `layout`: `GET /layout` of the wrapper, for a whole page.
+
+The report (JSON, on stdout or in `--output`) gives, overall and for each kind, the throughput,
+the latency percentiles and the percentiles of the duration of each stage of the requests:
+- OCR requests: `cache_lookup` (result cache), `send_task` (publishing the task), `task` (from
+  publishing the task to its final state), `result_delivery` (from the end of the task to its
+  reception by the API), `queue_and_run` (the rest of `task`: waiting in the queue, fetching the
+  image and running OCR) and `deliver_result` (decoding, caching and encoding the result),
+- layout requests: `layout_queue` and `layout_processing` (in the layout service, as reported by
+  the fake layout service), and `wrapper` (the rest: dispatch, image fetch and transfers).
+
+Example:
+    PYTHONPATH=../shared uv run load_test.py --requests 500 --concurrency 32 --mix ocr_regions=3,ocr_page=1,layout=1 --output report.json
+"""
+
+import argparse
+import asyncio
+import contextvars
+import json
+import logging
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from contextlib import aclosing
+from datetime import datetime, timezone
+from functools import wraps
+from http.server import ThreadingHTTPServer
+from pathlib import Path
+
+import httpx
+from celery import Celery
+
+from fake_iiif_server import FakeIIIFHandler
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+REQUEST_KINDS = ("ocr_regions", "ocr_page", "ocr_lines", "layout")
+PERCENTILES = (50, 95, 99)
+
+# Durations of the stages of the current request (one dict per request task)
+_request_stages: contextvars.ContextVar[dict] = contextvars.ContextVar("request_stages")
+
+
+def _record_stage(name: str, duration_sec: float):
+    stages = _request_stages.get(None)
+    if stages is not None:
+        stages[name] = stages.get(name, 0.) + duration_sec
+
+
+def _timed_coroutine(name: str, fn):
+    @wraps(fn)
+    async def timed(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await fn(*args, **kwargs)
+        finally:
+            _record_stage(name, time.perf_counter() - start)
+    return timed
+
+
+def _timed_async_generator(name: str, fn):
+    @wraps(fn)
+    async def timed(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            async with aclosing(fn(*args, **kwargs)) as values:
+                async for value in values:
+                    yield value
+        finally:
+            _record_stage(name, time.perf_counter() - start)
+    return timed
+
+
+def _instrument_ocr_proxy(ocr_proxy):
+    """Records the duration of the stages of the requests of `ocr_proxy` (see the module docstring)."""
+    ocr_proxy._get_cached_result = _timed_coroutine("cache_lookup", ocr_proxy._get_cached_result)
+    ocr_proxy._result_listener.send_task = _timed_coroutine("send_task", ocr_proxy._result_listener.send_task)
+    ocr_proxy._page_task_states = _timed_async_generator("task", ocr_proxy._page_task_states)
+    ocr_proxy._deliver_result = _timed_coroutine("deliver_result", ocr_proxy._deliver_result)
+
+    task_answer = ocr_proxy._task_answer
+    @wraps(task_answer)
+    async def timed_task_answer(meta: dict, *args, **kwargs):
+        date_done = meta.get("date_done")
+        if isinstance(date_done, str):
+            date_done = datetime.fromisoformat(date_done)
+        if date_done is not None:
+            if date_done.tzinfo is None:
+                date_done = date_done.replace(tzinfo=timezone.utc)
+            _record_stage("result_delivery", max(0., (datetime.now(timezone.utc) - date_done).total_seconds()))
+        return await task_answer(meta, *args, **kwargs)
+    ocr_proxy._task_answer = timed_task_answer
+
+
+def _percentile(sorted_values: list, percent: float) -> float:
+    """Percentile of sorted values, with linear interpolation between the closest ranks."""
+    position = (len(sorted_values) - 1) * percent / 100
+    lower = int(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
+
+
+def _distribution(values: list) -> dict:
+    if not values:
+        return {}
+    values = sorted(values)
+    return {
+        **{f"p{percent}": _percentile(values, percent) for percent in PERCENTILES},
+        "mean": sum(values) / len(values),
+        "max": values[-1],
+    }
+
+
+def _summary(records: list, duration_sec: float) -> dict:
+    """Throughput, latency and stage durations of request records."""
+    succeeded = [record for record in records if record["error"] is None]
+    stage_names = sorted({name for record in succeeded for name in record["stages"]})
+    return {
+        "requests": len(records),
+        "errors": len(records) - len(succeeded),
+        "throughput_rps": len(succeeded) / duration_sec if duration_sec > 0 else 0.,
+        "latency_sec": _distribution([record["latency_sec"] for record in succeeded]),
+        "stages_sec": {name: _distribution([record["stages"][name] for record in succeeded if name in record["stages"]])
+                       for name in stage_names},
+    }
+
+
+def _parse_mix(mix: str) -> dict:
+    """Parses `kind=weight,...` into a dict of weights."""
+    weights = {}
+    for item in mix.split(","):
+        kind, _, weight = item.strip().partition("=")
+        if kind not in REQUEST_KINDS:
+            raise argparse.ArgumentTypeError(f"Invalid request kind {kind!r}, valid kinds are: {', '.join(REQUEST_KINDS)}")
+        weights[kind] = float(weight or 1)
+    return weights
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _git_revision() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class _QuietIIIFHandler(FakeIIIFHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class RequestGenerator:
+    """Random requests of the configured mix, on the pages of the image server."""
+    def __init__(self, mix: dict, image_url_template: str, page_count: int, page_size: tuple, seed: int):
+        self._kinds = list(mix)
+        self._weights = [mix[kind] for kind in self._kinds]
+        self._image_url_template = image_url_template
+        self._page_count = page_count
+        self._page_width, self._page_height = page_size
+        self._rng = random.Random(seed)
+
+    def _box(self, width: int, height: int) -> dict:
+        xtl = self._rng.randrange(0, max(1, self._page_width - width))
+        ytl = self._rng.randrange(0, max(1, self._page_height - height))
+        return {"xtl": xtl, "ytl": ytl, "xbr": min(xtl + width, self._page_width), "ybr": min(ytl + height, self._page_height)}
+
+    def next(self) -> dict:
+        kind = self._rng.choices(self._kinds, self._weights)[0]
+        request = {"kind": kind, "image_url": self._image_url_template.format(page=self._rng.randint(1, self._page_count))}
+        if kind == "ocr_regions":
+            request["regions"] = [self._box(600, 200) for _ in range(self._rng.randint(1, 3))]
+        elif kind == "ocr_lines":
+            request["regions"] = [self._box(800, 40) for _ in range(self._rng.randint(10, 30))]
+        return request
+
+
+class LocalStack:
+    """Stand-ins of the services which are not given, started for the duration of the load test."""
+    def __init__(self, args):
+        self._args = args
+        self._work_dir = Path(tempfile.mkdtemp(prefix="mezanno-load-test-"))
+        self._processes: list[subprocess.Popen] = []
+        self._iiif_server: ThreadingHTTPServer | None = None
+
+    def _start_process(self, name: str, command: list, cwd: Path, env: dict) -> subprocess.Popen:
+        log_file = open(self._work_dir / f"{name}.log", "wb")
+        env = {**os.environ, "PYTHONPATH": os.pathsep.join(filter(None, [str(REPO_DIR / "shared"), os.environ.get("PYTHONPATH")])),
+               **env}
+        process = subprocess.Popen(command, cwd=cwd, env=env, stdout=log_file, stderr=subprocess.STDOUT)
+        self._processes.append(process)
+        return process
+
+    def _wait_until(self, name: str, process: subprocess.Popen, is_ready):
+        deadline = time.monotonic() + self._args.startup_timeout_sec
+        while not is_ready():
+            if process.poll() is not None:
+                raise RuntimeError(f"{name} exited with status {process.returncode}, see {self._work_dir / name}.log")
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"{name} not ready after {self._args.startup_timeout_sec} s, see {self._work_dir / name}.log")
+            time.sleep(0.1)
+
+    @staticmethod
+    def _responds(url: str) -> bool:
+        try:
+            return httpx.get(url, timeout=1).status_code == 200
+        except httpx.HTTPError:
+            return False
+
+    def start_iiif_server(self) -> str:
+        """Starts the fake IIIF server in a thread, and returns the image URL template of its pages."""
+        _QuietIIIFHandler.page_count = self._args.pages
+        _QuietIIIFHandler.page_size = (self._args.page_width, self._args.page_height)
+        _QuietIIIFHandler.latency_sec = self._args.image_latency_sec
+        self._iiif_server = ThreadingHTTPServer(("127.0.0.1", 0), _QuietIIIFHandler)
+        threading.Thread(target=self._iiif_server.serve_forever, name="fake-iiif-server", daemon=True).start()
+        port = self._iiif_server.server_address[1]
+        return f"http://127.0.0.1:{port}/iiif/image/v3/ark:/12148/loadtest/f{{page}}/full/max/0/default.png"
+
+    def start_ocr_worker(self) -> tuple[str, str]:
+        """Starts an OCR worker with the stub engine and a local broker, and returns the broker and backend URLs."""
+        broker_dir = self._work_dir / "broker"
+        results_dir = self._work_dir / "results"
+        broker_dir.mkdir()
+        results_dir.mkdir()
+        broker_url, result_backend = "filesystem://", f"file://{results_dir}"
+        # Read by celeryconfig.py, when imported
+        os.environ["CELERY_BROKER_URL"] = broker_url
+        os.environ["FILESYSTEM_BROKER_DIR"] = str(broker_dir)
+        ready_file = self._work_dir / "ocr-worker-ready"
+        from celeryconfig import OCR_QUEUES
+        process = self._start_process("ocr-worker", [
+            self._args.worker_python, "-m", "celery", "-A", "worker", "worker", "--loglevel", "WARNING",
+            "-P", "threads", "--concurrency", str(self._args.worker_concurrency), "-Q", ",".join(OCR_QUEUES),
+        ], cwd=REPO_DIR / "ocr-worker", env={
+            "CELERY_BROKER_URL": broker_url,
+            "CELERY_RESULT_BACKEND": result_backend,
+            "FILESYSTEM_BROKER_DIR": str(broker_dir),
+            "OCR_ENGINE": "stub",
+            "PERO_CONFIG_DIR": "stub",
+            "STUB_OCR_SEC_PER_LINE": str(self._args.stub_sec_per_line),
+            "STUB_OCR_SEC_PER_MEGAPIXEL": str(self._args.stub_sec_per_megapixel),
+            "STUB_OCR_BUSY_WAIT": str(self._args.stub_busy_wait),
+            "WORKER_READY_FILE": str(ready_file),
+            "IMAGE_CACHE_MAX_BYTES": "0",
+            "METRICS_PORT": "0",
+        })
+        self._wait_until("ocr-worker", process, ready_file.exists)
+        return broker_url, result_backend
+
+    def start_layout_wrapper(self) -> str:
+        """Starts fake layout services and the layout wrapper in front of them, and returns the `/layout` URL."""
+        wrapper_dir = REPO_DIR / "layout-worker-wrapper"
+        layout_service_urls = []
+        for replica_idx in range(self._args.layout_replicas):
+            port = _free_port()
+            process = self._start_process(f"fake-layout-service-{replica_idx}", [
+                sys.executable, "fake_layout_service.py", "--host", "127.0.0.1", "--port", str(port),
+                "--sec_per_request", str(self._args.layout_sec_per_request),
+            ], cwd=wrapper_dir, env={})
+            self._wait_until(f"fake-layout-service-{replica_idx}", process,
+                             lambda: self._responds(f"http://127.0.0.1:{port}/health_check"))
+            layout_service_urls.append(f"http://127.0.0.1:{port}/imgproc/layout")
+
+        port = _free_port()
+        process = self._start_process("layout-wrapper", [
+            self._args.wrapper_python, "-m", "uvicorn", "worker_wrapper:app", "--host", "127.0.0.1", "--port", str(port),
+            "--log-level", "warning",
+        ], cwd=wrapper_dir, env={
+            "LAYOUT_SERVICE_URLS": ",".join(layout_service_urls),
+            "LAYOUT_MAX_IN_FLIGHT_PER_REPLICA": "1",
+            "LAYOUT_MAX_QUEUED": "-1",
+            "RESULT_CACHE_MAX_ENTRIES": "0",
+        })
+        self._wait_until("layout-wrapper", process, lambda: self._responds(f"http://127.0.0.1:{port}/docs"))
+        return f"http://127.0.0.1:{port}/layout"
+
+    def stop(self):
+        for process in self._processes:
+            process.terminate()
+        for process in self._processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        if self._iiif_server is not None:
+            self._iiif_server.shutdown()
+        if self._args.keep_logs:
+            print(f"Logs of the local services: {self._work_dir}", file=sys.stderr)
+        else:
+            shutil.rmtree(self._work_dir, ignore_errors=True)
+
+
+async def _ocr_request(ocr_proxy, request: dict) -> str | None:
+    """Sends an OCR request, and returns its error (None on success)."""
+    mode = "line" if request["kind"] == "ocr_lines" else "block"
+    answer = await ocr_proxy.transcribe(request["image_url"], json.dumps(request.get("regions", [])), "json", mode)
+    return answer.get("error")
+
+
+async def _layout_request(client: httpx.AsyncClient, layout_url: str, request: dict) -> str | None:
+    """Sends a layout request, and returns its error (None on success)."""
+    response = await client.get(layout_url, params={"image_url": request["image_url"]})
+    if response.status_code != 200:
+        return f"Layout wrapper returned status {response.status_code}: {response.text[:200]}"
+    layout = response.json()
+    if "message" in layout:
+        return f"{layout['message']}: {layout.get('error') or layout.get('status_code')}"
+    if "processing_sec" in layout:
+        _record_stage("layout_queue", layout["queue_sec"])
+        _record_stage("layout_processing", layout["processing_sec"])
+    return None
+
+
+async def _timed_request(ocr_proxy, client: httpx.AsyncClient, layout_url: str, request: dict) -> dict:
+    stages = {}
+    _request_stages.set(stages)
+    start = time.perf_counter()
+    try:
+        if request["kind"] == "layout":
+            error = await _layout_request(client, layout_url, request)
+        else:
+            error = await _ocr_request(ocr_proxy, request)
+    except Exception as e:
+        error = repr(e)
+    latency_sec = time.perf_counter() - start
+    if {"task", "send_task", "result_delivery"} <= stages.keys():
+        stages["queue_and_run"] = max(0., stages["task"] - stages["send_task"] - stages["result_delivery"])
+    if "layout_processing" in stages:
+        stages["wrapper"] = max(0., latency_sec - stages["layout_queue"] - stages["layout_processing"])
+    return {"kind": request["kind"], "latency_sec": latency_sec, "stages": stages, "error": error}
+
+
+async def run_load(args, ocr_proxy, layout_url: str, image_url_template: str) -> dict:
+    """Sends the requests with `args.concurrency` concurrent clients, and returns the report."""
+    generator = RequestGenerator(args.mix, image_url_template, args.pages, (args.page_width, args.page_height), args.seed)
+    async with httpx.AsyncClient(timeout=args.task_timeout_sec) as client:
+        async def send(request_count: int) -> list:
+            remaining = iter(range(request_count))
+            async def client_loop() -> list:
+                # Each request runs in its own task, with its own stage durations
+                return [await asyncio.create_task(_timed_request(ocr_proxy, client, layout_url, generator.next()))
+                        for _ in remaining]
+            return [record for records in await asyncio.gather(*(client_loop() for _ in range(args.concurrency)))
+                    for record in records]
+
+        if args.warmup_requests:
+            await send(args.warmup_requests)
+        started_at = datetime.now(timezone.utc)
+        start = time.perf_counter()
+        records = await send(args.requests)
+        duration_sec = time.perf_counter() - start
+
+    errors = [record["error"] for record in records if record["error"] is not None]
+    return {
+        "git_revision": _git_revision(),
+        "started_at": started_at.isoformat(),
+        "duration_sec": duration_sec,
+        "config": {key: value for key, value in vars(args).items() if key not in ("output",)},
+        "overall": _summary(records, duration_sec),
+        "by_kind": {kind: _summary([record for record in records if record["kind"] == kind], duration_sec)
+                    for kind in args.mix if any(record["kind"] == kind for record in records)},
+        "error_samples": errors[:10],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test of the OCR API and of the layout wrapper")
+    parser.add_argument("--requests", default=200, type=int, help="Number of measured requests")
+    parser.add_argument("--warmup_requests", default=10, type=int, help="Number of requests sent before measuring")
+    parser.add_argument("--concurrency", default=8, type=int, help="Number of concurrent clients")
+    parser.add_argument("--mix", default="ocr_regions=3,ocr_page=1,ocr_lines=1,layout=1", type=_parse_mix,
+                        help=f"Weights of request kinds, as kind=weight,... (kinds: {', '.join(REQUEST_KINDS)})")
+    parser.add_argument("--seed", default=0, type=int, help="Seed of the random requests")
+    parser.add_argument("--task_timeout_sec", default=60, type=int, help="Timeout of each request")
+    parser.add_argument("--tile_large_pages", action="store_true", help="Split large regions into tiles (see main_api_ocr.py)")
+    parser.add_argument("--output", default="", type=str, help="Report file (default: stdout)")
+    parser.add_argument("--keep_logs", action="store_true", help="Keep the logs of the local services")
+    parser.add_argument("--log_level", default="WARNING", type=str, help="Log level of the API (per request logs are INFO)")
+    parser.add_argument("--startup_timeout_sec", default=60, type=float, help="Max startup time of each local service")
+    # Image server
+    parser.add_argument("--image_url_template", default="", type=str,
+                        help="Image URL of a page, where {page} is replaced by its number (default: a local fake IIIF server)")
+    parser.add_argument("--pages", default=100, type=int, help="Number of distinct pages")
+    parser.add_argument("--page_width", default=2000, type=int, help="Width of pages")
+    parser.add_argument("--page_height", default=3000, type=int, help="Height of pages")
+    parser.add_argument("--image_latency_sec", default=0.02, type=float, help="Latency of the fake IIIF server")
+    # OCR
+    parser.add_argument("--celery_broker_url", default="", type=str,
+                        help="Broker of running OCR workers (default: a local broker and an OCR worker with the stub engine)")
+    parser.add_argument("--celery_result_backend", default="", type=str, help="Result backend of running OCR workers")
+    parser.add_argument("--result_poll_interval_sec", default=0.01, type=float,
+                        help="Polling interval of result backends which cannot push results (such as the local one)")
+    parser.add_argument("--worker_python", default=sys.executable, type=str, help="Python interpreter of the local OCR worker")
+    parser.add_argument("--worker_concurrency", default=4, type=int, help="Number of tasks run at once by the local OCR worker")
+    parser.add_argument("--stub_sec_per_line", default=0.02, type=float, help="OCR cost of each line with the stub engine")
+    parser.add_argument("--stub_sec_per_megapixel", default=0.05, type=float, help="Line detection cost per megapixel with the stub engine")
+    parser.add_argument("--stub_busy_wait", action="store_true", help="Spend the stub OCR cost busy-waiting rather than sleeping")
+    # Layout
+    parser.add_argument("--layout_url", default="", type=str,
+                        help="`/layout` URL of a running layout wrapper (default: a local wrapper and fake layout services)")
+    parser.add_argument("--wrapper_python", default=sys.executable, type=str, help="Python interpreter of the local layout wrapper")
+    parser.add_argument("--layout_replicas", default=2, type=int, help="Number of local fake layout services")
+    parser.add_argument("--layout_sec_per_request", default=0.1, type=float, help="Processing time of the fake layout services")
+    args = parser.parse_args()
+
+    # Configured before main_api_ocr.py is imported, whose own configuration is then ignored
+    logging.basicConfig(level=args.log_level, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+
+    uses_ocr = any(kind != "layout" for kind in args.mix)
+    uses_layout = "layout" in args.mix
+    stack = LocalStack(args)
+    result_listener = None
+    try:
+        image_url_template = args.image_url_template or stack.start_iiif_server()
+        ocr_proxy = None
+        if uses_ocr:
+            broker_url, result_backend = args.celery_broker_url, args.celery_result_backend
+            if not broker_url:
+                broker_url, result_backend = stack.start_ocr_worker()
+            os.environ["CELERY_BROKER_URL"] = broker_url
+            from main_api_ocr import OCRProxy
+            from result_listener import ResultListener
+            celeryapp = Celery(broker=broker_url, backend=result_backend)
+            celeryapp.config_from_object("celeryconfig")
+            result_listener = ResultListener(celeryapp, poll_interval_sec=args.result_poll_interval_sec)
+            result_listener.start()
+            ocr_proxy = OCRProxy(celeryapp=celeryapp, result_listener=result_listener, task_timeout_sec=args.task_timeout_sec,
+                                 use_image_cache=False, tile_large_pages=args.tile_large_pages)
+            _instrument_ocr_proxy(ocr_proxy)
+        layout_url = (args.layout_url or stack.start_layout_wrapper()) if uses_layout else ""
+
+        report = asyncio.run(run_load(args, ocr_proxy, layout_url, image_url_template))
+    finally:
+        if result_listener is not None:
+            result_listener.stop()
+        stack.stop()
+
+    report_json = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report_json)
+    else:
+        print(report_json)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,270 @@
+"""
+Push-based delivery of Celery task states to asyncio coroutines.
+
+A single thread owns the result backend: it sends tasks, subscribes to their
+results and drains the backend connection, then hands every state update to
+the event loop of the coroutines waiting for it. Hundreds of in-flight requests
+thus share one consumer instead of each polling `AsyncResult.ready()`.
+
+Celery result backends are not thread-safe (and the `rpc://` backend uses one
+reply queue per thread), so every backend call happens in the listener thread.
+"""
+
+import asyncio
+import concurrent.futures
+import logging
+import queue
+import socket
+import threading
+import time
+from collections import OrderedDict
+from contextlib import aclosing
+from typing import AsyncIterator
+
+from celery import Celery, states
+from celery.backends.asynchronous import AsyncBackendMixin
+from celery.backends.rpc import RPCBackend
+
+logger = logging.getLogger(__name__)
+
+
+class _TrackedTask:
+    """States received so far for a task, and the queues of its subscribers."""
+    def __init__(self):
+        self.history: list[dict] = []
+        self.subscribers: list[tuple[asyncio.AbstractEventLoop, asyncio.Queue]] = []
+
+
+class ResultListener:
+    """Single result consumer shared by all in-flight requests."""
+    def __init__(self, celeryapp: Celery, drain_timeout_sec: float = 0.01, poll_interval_sec: float = 0.2,
+                 max_recent_results: int = 1024):
+        self._celeryapp = celeryapp
+        self._drain_timeout_sec = drain_timeout_sec
+        self._poll_interval_sec = poll_interval_sec
+        self._max_recent_results = max_recent_results
+
+        # Only accessed from the listener thread
+        self._tasks: dict[str, _TrackedTask] = {}
+        self._recent: OrderedDict[str, dict] = OrderedDict()  # task_id -> final meta
+        self._backend = None
+
+        self._commands: queue.SimpleQueue = queue.SimpleQueue()
+        self._stopped = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def start(self):
+        """Starts the listener thread (idempotent)."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="result-listener", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    @property
+    def tracked_task_count(self) -> int:
+        """Number of sent tasks whose result is awaited (read from any thread, for metrics)."""
+        return len(self._tasks)
+
+    # Coroutine API
+    # -------------------------------------------------------------------------
+    async def send_task(self, name: str, args: tuple = (), kwargs: dict | None = None, track: bool = True,
+                        **options) -> str:
+        """Sends a task from the listener thread and starts tracking its states.
+
+        Returns the task id. States are recorded from now on, so a later call to
+        `wait` or `stream` cannot miss the result. With `track=False`, states are not
+        recorded until `stream` is called: only use it when the states are stored by the
+        result backend (not rpc://), e.g. for tasks whose result may never be awaited.
+        """
+        return await self._call(self._send_task, name, args, kwargs, options, track)
+
+    async def store_state(self, task_id: str, state: str, result=None):
+        """Stores a state of a task in the result backend, e.g. before the task is sent."""
+        await self._call(self._backend_store_result, task_id, result, state)
+
+    async def wait(self, task_id: str, timeout: float | None) -> dict:
+        """Waits for the final state of a task.
+
+        Returns the task meta (`status`, `result`, `traceback`…) as soon as the
+        backend publishes it; for failed tasks, `result` is the exception.
+        Raises `asyncio.TimeoutError` after `timeout` seconds.
+        """
+        async with aclosing(self.stream(task_id, timeout=timeout)) as task_states:
+            async for meta in task_states:
+                if meta["status"] in states.READY_STATES:
+                    return meta
+        raise RuntimeError(f"Stream for task {task_id} ended without final state.")
+
+    async def latest(self, task_id: str, timeout: float = 0.) -> dict | None:
+        """Returns the latest state of a task, waiting at most `timeout` seconds for its final state (long polling).
+
+        Returns None if the backend has no state for this task (unknown task, or not started
+        and not stored with `store_state`).
+        """
+        meta = None
+        try:
+            async with aclosing(self.stream(task_id, timeout=timeout)) as task_states:
+                async for meta in task_states:
+                    pass
+        except asyncio.TimeoutError:
+            pass
+        return meta
+
+    async def stream(self, task_id: str, timeout: float | None) -> AsyncIterator[dict]:
+        """Yields every state of a task (including custom ones), ending with its final state.
+
+        `timeout` bounds the total duration, as for `wait`.
+        With backends which cannot push results, intermediate states may be skipped.
+        """
+        loop = asyncio.get_running_loop()
+        states_queue: asyncio.Queue = asyncio.Queue()
+        await self._call(self._subscribe, task_id, loop, states_queue)
+        deadline = None if timeout is None else loop.time() + timeout
+        try:
+            while True:
+                remaining = None if deadline is None else max(0.0, deadline - loop.time())
+                if not states_queue.empty():
+                    # States already received are yielded even past the deadline (e.g. with a zero timeout)
+                    meta = states_queue.get_nowait()
+                else:
+                    meta = await asyncio.wait_for(states_queue.get(), remaining)
+                yield meta
+                if meta["status"] in states.READY_STATES:
+                    return
+        finally:
+            self._commands.put((self._unsubscribe, (task_id, states_queue), None))
+
+    async def _call(self, fn, *args):
+        """Runs `fn(*args)` in the listener thread and returns its result."""
+        if self._thread is None:
+            raise RuntimeError("ResultListener must be started before use.")
+        future = concurrent.futures.Future()
+        self._commands.put((fn, args, future))
+        return await asyncio.wrap_future(future)
+
+    # Listener thread
+    # -------------------------------------------------------------------------
+    def _run(self):
+        self._backend = self._celeryapp.backend
+        is_async = isinstance(self._backend, AsyncBackendMixin)
+        if is_async:
+            self._backend.result_consumer.on_message = self._on_message
+        else:
+            logger.warning(f"Result backend {type(self._backend).__name__} cannot push results,"
+                           f" polling every {self._poll_interval_sec}s instead.")
+        last_poll = time.monotonic()
+
+        while not self._stopped.is_set():
+            self._run_commands()
+            if is_async:
+                try:
+                    self._backend.result_consumer.drain_events(timeout=self._drain_timeout_sec)
+                except socket.timeout:
+                    pass
+                except Exception:
+                    logger.exception("Error while draining result backend.")
+                    time.sleep(self._poll_interval_sec)
+            else:
+                time.sleep(self._drain_timeout_sec)
+                if time.monotonic() - last_poll >= self._poll_interval_sec:
+                    last_poll = time.monotonic()
+                    self._poll_all()
+
+    def _run_commands(self):
+        while True:
+            try:
+                fn, args, future = self._commands.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                result = fn(*args)
+            except Exception as e:
+                if future is None:
+                    logger.exception(f"Error in result listener command {fn.__name__}.")
+                else:
+                    future.set_exception(e)
+            else:
+                if future is not None:
+                    future.set_result(result)
+
+    def _backend_store_result(self, task_id: str, result, state: str):
+        self._backend.store_result(task_id, result, state)
+
+    def _send_task(self, name, args, kwargs, options, track) -> str:
+        r = self._celeryapp.send_task(name, args=args, kwargs=kwargs, **options)
+        if track:
+            self._track(r.id)
+        return r.id
+
+    def _track(self, task_id: str):
+        if task_id in self._tasks:
+            return
+        self._tasks[task_id] = _TrackedTask()
+        if isinstance(self._backend, AsyncBackendMixin):
+            self._backend.result_consumer.consume_from(task_id)
+        if not isinstance(self._backend, RPCBackend):
+            # The result may have been stored before we subscribed to it.
+            self._poll(task_id)
+
+    def _subscribe(self, task_id: str, loop: asyncio.AbstractEventLoop, states_queue: asyncio.Queue):
+        if task_id in self._recent:
+            loop.call_soon_threadsafe(states_queue.put_nowait, self._recent[task_id])
+            return
+        self._track(task_id)
+        tracked = self._tasks.get(task_id)
+        if tracked is None:
+            # Became ready while being tracked
+            loop.call_soon_threadsafe(states_queue.put_nowait, self._recent[task_id])
+            return
+        for meta in tracked.history:
+            loop.call_soon_threadsafe(states_queue.put_nowait, meta)
+        tracked.subscribers.append((loop, states_queue))
+
+    def _unsubscribe(self, task_id: str, states_queue: asyncio.Queue):
+        tracked = self._tasks.get(task_id)
+        if tracked is None:
+            return
+        tracked.subscribers = [(l, q) for (l, q) in tracked.subscribers if q is not states_queue]
+        if not tracked.subscribers:
+            # Nobody is waiting anymore (timeout or client gone)
+            del self._tasks[task_id]
+            if isinstance(self._backend, AsyncBackendMixin) and not isinstance(self._backend, RPCBackend):
+                # With rpc://, all tasks share one reply queue which must stay consumed.
+                self._backend.result_consumer.cancel_for(task_id)
+
+    def _on_message(self, meta: dict):
+        task_id = meta.get("task_id")
+        tracked = self._tasks.get(task_id)
+        if tracked is None:
+            return
+        meta = self._backend.meta_from_decoded(dict(meta))
+        tracked.history.append(meta)
+        for loop, states_queue in tracked.subscribers:
+            loop.call_soon_threadsafe(states_queue.put_nowait, meta)
+        if meta["status"] in states.READY_STATES:
+            del self._tasks[task_id]
+            self._recent[task_id] = meta
+            while len(self._recent) > self._max_recent_results:
+                self._recent.popitem(last=False)
+
+    def _poll(self, task_id: str):
+        meta = self._backend.get_task_meta(task_id)
+        tracked = self._tasks.get(task_id)
+        if meta["status"] == states.PENDING or tracked is None:
+            return
+        if tracked.history and tracked.history[-1]["status"] == meta["status"] \
+                and tracked.history[-1].get("result") == meta.get("result"):
+            return
+        self._on_message({**meta, "task_id": task_id})
+
+    def _poll_all(self):
+        for task_id in list(self._tasks):
+            try:
+                self._poll(task_id)
+            except Exception:
+                logger.exception(f"Error while polling state of task {task_id}.")
@@ -0,0 +1,96 @@
+"""
+Coalescing of identical in-flight requests ("single flight").
+
+The first request for a given key becomes the leader: it sends the task, with a
+task id chosen here. Identical requests arriving while the task runs get the same
+task id and simply wait for its result (which the result listener delivers to
+every waiter), instead of sending another task.
+
+In-flight tasks are recorded in this process, and optionally in Redis so that
+several api-ocr replicas share them. Sharing tasks between replicas requires a
+result backend which any replica can read (not `rpc://`, whose results are only
+sent to the replica which sent the task).
+"""
+
+import logging
+import uuid
+
+import redis.asyncio
+
+logger = logging.getLogger(__name__)
+
+# Deletes a key only if it still holds the given task id
+_RELEASE_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+
+class SingleFlight:
+    """Registry of in-flight tasks, keyed by request."""
+    def __init__(self, redis_url: str | None = None, ttl_sec: float = 60, key_prefix: str = "mezanno:inflight:"):
+        """
+        Args:
+            redis_url: Redis server shared by the replicas, or None to coalesce requests of this process only.
+            ttl_sec: Max lifetime of a shared entry, in case its leader dies before releasing it.
+                Must be longer than the task timeout.
+            key_prefix: Prefix of the Redis keys.
+        """
+        # Only accessed from the event loop
+        self._local: dict[str, str] = {}
+        self._ttl_ms = int(ttl_sec * 1000)
+        self._key_prefix = key_prefix
+        self._redis = None
+        self._release_script = None
+        if redis_url:
+            self._redis = redis.asyncio.Redis.from_url(redis_url)
+            self._release_script = self._redis.register_script(_RELEASE_SCRIPT)
+
+    async def claim(self, key: str) -> tuple[str, bool]:
+        """Returns the id of the task computing `key`, and whether the caller is its leader.
+
+        The leader must send the task with this id (`task_id` option of `send_task`),
+        then call `release` once the task is over, whatever its outcome.
+        """
+        task_id = self._local.get(key)
+        if task_id is not None:
+            return task_id, False
+        task_id = str(uuid.uuid4())
+        if self._redis is not None:
+            shared_task_id = await self._claim_shared(key, task_id)
+            if shared_task_id != task_id:
+                return shared_task_id, False
+        self._local[key] = task_id
+        return task_id, True
+
+    async def release(self, key: str, task_id: str):
+        """Forgets the task computing `key`: the next request for `key` will send a new task."""
+        if self._local.get(key) == task_id:
+            del self._local[key]
+        if self._redis is not None:
+            try:
+                await self._release_script(keys=[self._key_prefix + key], args=[task_id])
+            except redis.RedisError:
+                # The entry will expire by itself
+                logger.exception(f"Cannot release in-flight task {task_id}.")
+
+    async def _claim_shared(self, key: str, task_id: str) -> str:
+        redis_key = self._key_prefix + key
+        try:
+            # Retry if the other leader released the key between our SET and GET
+            for _ in range(3):
+                if await self._redis.set(redis_key, task_id, nx=True, px=self._ttl_ms):
+                    return task_id
+                shared_task_id = await self._redis.get(redis_key)
+                if shared_task_id is not None:
+                    return shared_task_id.decode("utf-8")
+        except redis.RedisError:
+            # Do not fail requests when Redis is down, only lose cross-replica coalescing
+            logger.exception("Cannot reach Redis, coalescing requests of this replica only.")
+        return task_id
+
+    async def aclose(self):
+        if self._redis is not None:
+            await self._redis.aclose()
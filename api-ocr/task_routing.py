@@ -0,0 +1,62 @@
+"""
+Routing of OCR tasks to queues, by estimated cost.
+
+All tasks used to go to a single queue, so a bulk job of thousands of full pages
+delayed every interactive request queued behind it. Requests are now classified:
+- interactive: a single page with a few small regions (e.g. a box drawn in the annotation UI),
+- standard: other single page requests (e.g. a full page),
+- bulk: batch requests.
+Each class has its own queue (see `OCR_QUEUES` in celeryconfig.py), and workers choose
+which queues they consume (`-Q` option of `celery worker`). Within a queue, cheaper tasks
+get a higher priority.
+"""
+
+import math
+
+from celeryconfig import OCR_MAX_PRIORITY, OCR_QUEUES
+
+INTERACTIVE_QUEUE, STANDARD_QUEUE, BULK_QUEUE = OCR_QUEUES
+
+
+class TaskRouter:
+    """Chooses the queue and priority of OCR tasks."""
+    def __init__(self, interactive_max_regions: int = 8, interactive_max_area: float = 1_000_000,
+                 full_page_area: float = 12_000_000):
+        """
+        Args:
+            interactive_max_regions: Max number of regions of an interactive request.
+            interactive_max_area: Max total area (pixels) of the regions of an interactive request.
+                Tasks of at most this area get the highest priority of their queue; each doubling
+                of the area lowers the priority by one.
+            full_page_area: Estimated area (pixels) of a page requested without regions,
+                whose size is only known once the worker has fetched it.
+        """
+        self._interactive_max_regions = interactive_max_regions
+        self._interactive_max_area = interactive_max_area
+        self._full_page_area = full_page_area
+
+    def page_area(self, regions: list) -> float:
+        """Estimated number of pixels to process for the regions of a page (`ImageRegion` dicts)."""
+        if not regions:
+            return self._full_page_area
+        return sum(max(0., region["xbr"] - region["xtl"]) * max(0., region["ybr"] - region["ytl"])
+                   for region in regions)
+
+    def priority(self, area: float) -> int:
+        """Priority of a task processing `area` pixels, from `OCR_MAX_PRIORITY` (cheapest) down to 0."""
+        doublings = math.log2(max(area, 1.) / self._interactive_max_area)
+        return max(0, OCR_MAX_PRIORITY - max(0, math.ceil(doublings)))
+
+    def route_page(self, regions: list) -> dict:
+        """Options of `send_task` (`queue` and `priority`) for a single page request."""
+        area = self.page_area(regions)
+        if regions and len(regions) <= self._interactive_max_regions and area <= self._interactive_max_area:
+            queue = INTERACTIVE_QUEUE
+        else:
+            queue = STANDARD_QUEUE
+        return {"queue": queue, "priority": self.priority(area)}
+
+    def route_batch(self, pages: list) -> dict:
+        """Options of `send_task` (`queue` and `priority`) for a chunk of pages of a batch request."""
+        area = sum(self.page_area(page.get("regions") or []) for page in pages)
+        return {"queue": BULK_QUEUE, "priority": self.priority(area)}
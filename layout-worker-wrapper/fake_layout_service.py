@@ -0,0 +1,94 @@
+"""
+Local stand-in for the C++ layout service (`layout-worker`), to benchmark the wrapper without it
+(see api-ocr/load_test.py).
+
+Serves `POST /imgproc/layout`: reads the posted image, waits `--sec_per_request` seconds plus
+`--sec_per_megabyte` seconds per megabyte of image (with at most `--max_concurrency` requests
+processed at once, like a backend with a fixed number of threads), then returns a layout with
+a single block. The `processing_sec` and `queue_sec` fields report the time spent processing
+and waiting for a processing slot.
+
+Example:
+    python fake_layout_service.py --port 8910 --sec_per_request 0.2
+    # then, run the wrapper with LAYOUT_SERVICE_URLS=http://localhost:8910/imgproc/layout
+"""
+
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeLayoutHandler(BaseHTTPRequestHandler):
+    # Set by `main`
+    sec_per_request = 0.1
+    sec_per_megabyte = 0.
+    slots = threading.BoundedSemaphore(1)
+
+    def _send_json(self, status: int, payload: dict):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_body(self) -> bytes:
+        if "Content-Length" in self.headers:
+            return self.rfile.read(int(self.headers["Content-Length"]))
+        # Chunked transfer encoding
+        chunks = []
+        while True:
+            size = int(self.rfile.readline().split(b";")[0], 16)
+            if size == 0:
+                self.rfile.readline()
+                return b"".join(chunks)
+            chunks.append(self.rfile.read(size))
+            self.rfile.readline()
+
+    def do_GET(self):
+        if self.path == "/health_check":
+            self._send_json(200, {"status": "ok"})
+        else:
+            self._send_json(404, {"message": "Not found."})
+
+    def do_POST(self):
+        if self.path != "/imgproc/layout":
+            self._send_json(404, {"message": "Not found."})
+            return
+        image = self._read_body()
+        queued_at = time.perf_counter()
+        with self.slots:
+            started_at = time.perf_counter()
+            time.sleep(self.sec_per_request + self.sec_per_megabyte * len(image) / 1e6)
+        self._send_json(200, {
+            "blocks": [{"type": "text", "bbox": [0, 0, 0, 0]}],
+            "image_bytes": len(image),
+            "queue_sec": started_at - queued_at,
+            "processing_sec": time.perf_counter() - started_at,
+        })
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the layout service")
+    parser.add_argument("--host", default="0.0.0.0", type=str, help="Listening address")
+    parser.add_argument("--port", default=8910, type=int, help="Listening port")
+    parser.add_argument("--sec_per_request", default=0.1, type=float, help="Processing time of each request")
+    parser.add_argument("--sec_per_megabyte", default=0., type=float, help="Additional processing time per megabyte of image")
+    parser.add_argument("--max_concurrency", default=1, type=int, help="Max number of requests processed at once")
+    args = parser.parse_args()
+
+    FakeLayoutHandler.sec_per_request = args.sec_per_request
+    FakeLayoutHandler.sec_per_megabyte = args.sec_per_megabyte
+    FakeLayoutHandler.slots = threading.BoundedSemaphore(args.max_concurrency)
+    server = ThreadingHTTPServer((args.host, args.port), FakeLayoutHandler)
+    print(f"Fake layout service listening on {args.host}:{args.port}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""
+Dispatch of layout requests across the replicas of the layout service.
+
+Requests used to go to a single URL with no concurrency limit: a burst of `/layout`
+calls was sent all at once, to whichever replica the Docker virtual IP picked.
+`ReplicaBalancer` sends each request to the replica with the fewest requests in flight
+(least outstanding requests), and never sends more than `max_in_flight` requests at once
+to a replica: once all replicas are busy, requests wait in a FIFO queue, and are rejected
+when the queue is full.
+
+The replicas are either listed explicitly (one URL each), or discovered by resolving the
+host of the URLs: with Docker Swarm, `tasks.<service>` resolves to the address of every
+task of the service (see `resolve_replica_urls`).
+"""
+
+import asyncio
+import itertools
+import socket
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, List, Optional
+from urllib.parse import urlsplit, urlunsplit
+
+
+class QueueFullError(Exception):
+    """Raised when a request cannot wait for a replica because too many requests are already waiting."""
+
+
+class ReplicaBalancer():
+    def __init__(self, urls: List[str], max_in_flight: int = 4, max_queued: Optional[int] = None) -> None:
+        """
+        Least-outstanding-requests balancer with a per-replica in-flight cap.
+
+        Args:
+            urls (list of str): URLs of the replicas.
+            max_in_flight (int): Max number of requests sent at the same time to each replica.
+            max_queued (int): Max number of requests waiting for a replica (unbounded if None).
+        """
+        if not urls:
+            raise ValueError("At least one replica URL is required.")
+        if max_in_flight < 1:
+            raise ValueError(f"Max in-flight requests per replica ({max_in_flight}) must be at least 1.")
+        self.max_in_flight = max_in_flight
+        self.max_queued = max_queued
+        self._in_flight: Dict[str, int] = dict.fromkeys(urls, 0)
+        self._queued = 0
+        self._condition = asyncio.Condition()
+        # Breaks ties between equally loaded replicas, so that they all get requests
+        self._tie_breaker = itertools.count()
+
+    def _pick(self) -> Optional[str]:
+        """The least loaded replica below its cap, or None if all replicas are busy."""
+        replicas = list(self._in_flight)
+        offset = next(self._tie_breaker) % len(replicas)
+        candidates = [url for url in replicas[offset:] + replicas[:offset] if self._in_flight[url] < self.max_in_flight]
+        return min(candidates, key=self._in_flight.__getitem__, default=None)
+
+    @asynccontextmanager
+    async def replica(self) -> AsyncIterator[str]:
+        """Reserves a slot on the least loaded replica, waiting for one if all are busy, and yields its URL.
+
+        Raises `QueueFullError` if `max_queued` requests are already waiting.
+        """
+        async with self._condition:
+            # Requests already waiting go first
+            url = self._pick() if self._queued == 0 else None
+            if url is None:
+                if self.max_queued is not None and self._queued >= self.max_queued:
+                    raise QueueFullError(f"All layout replicas are busy and {self._queued} requests are waiting.")
+                self._queued += 1
+                try:
+                    await self._condition.wait_for(lambda: self._pick() is not None)
+                finally:
+                    self._queued -= 1
+                url = self._pick()
+            self._in_flight[url] += 1
+        try:
+            yield url
+        finally:
+            async with self._condition:
+                if url in self._in_flight:
+                    self._in_flight[url] -= 1
+                self._condition.notify()
+
+    async def set_replicas(self, urls: List[str]) -> None:
+        """Replaces the replicas, keeping the in-flight counts of those still present."""
+        if not urls:
+            return
+        async with self._condition:
+            self._in_flight = {url: self._in_flight.get(url, 0) for url in urls}
+            self._condition.notify_all()
+
+    def stats(self) -> dict:
+        return {"in_flight": dict(self._in_flight), "queued": self._queued, "max_in_flight": self.max_in_flight}
+
+
+async def resolve_replica_urls(urls: List[str]) -> List[str]:
+    """Expands each URL into one URL per address of its host (sorted), keeping URLs which cannot be resolved."""
+    loop = asyncio.get_running_loop()
+    replica_urls = []
+    for url in urls:
+        parts = urlsplit(url)
+        try:
+            infos = await loop.getaddrinfo(parts.hostname, parts.port, type=socket.SOCK_STREAM)
+        except socket.gaierror:
+            replica_urls.append(url)
+            continue
+        for address in sorted({info[4][0] for info in infos}):
+            host = f"[{address}]" if ":" in address else address
+            netloc = f"{host}:{parts.port}" if parts.port else host
+            replica_urls.append(urlunsplit(parts._replace(netloc=netloc)))
+    return list(dict.fromkeys(replica_urls))
@@ -1,8 +1,104 @@
-from fastapi import FastAPI
+import asyncio
+from contextlib import asynccontextmanager
+import os
+import time
+
+from fastapi import FastAPI, Header, HTTPException, Response
 import uvicorn
 import httpx
 
-app = FastAPI()
+from image_fetcher import AsyncImageFetcher, ImageFetchError
+from replica_balancer import QueueFullError, ReplicaBalancer, resolve_replica_urls
+from result_cache import ResultCache, make_cache_key
+import metrics
+import tracing
+
+# Layout service replicas (comma-separated URLs), each receiving at most LAYOUT_MAX_IN_FLIGHT_PER_REPLICA
+# requests at once; other requests wait for a free replica (at most LAYOUT_MAX_QUEUED, -1 for no limit)
+LAYOUT_SERVICE_URLS = [url.strip() for url in os.environ.get(
+    "LAYOUT_SERVICE_URLS", os.environ.get("LAYOUT_SERVICE_URL", "http://layout-worker:8000/imgproc/layout")
+).split(",") if url.strip()]
+LAYOUT_MAX_IN_FLIGHT_PER_REPLICA = int(os.environ.get("LAYOUT_MAX_IN_FLIGHT_PER_REPLICA", 2))
+LAYOUT_MAX_QUEUED = int(os.environ.get("LAYOUT_MAX_QUEUED", 256))
+# Resolve the hosts of LAYOUT_SERVICE_URLS into one replica per address every N seconds
+# (e.g. `tasks.layout-worker` with Docker Swarm; 0 to use the URLs as they are)
+LAYOUT_REPLICAS_REFRESH_SEC = float(os.environ.get("LAYOUT_REPLICAS_REFRESH_SEC", 0))
+LAYOUT_TIMEOUT_SEC = float(os.environ.get("LAYOUT_TIMEOUT_SEC", 60.0))
+IMAGE_FETCH_TIMEOUT_SEC = float(os.environ.get("IMAGE_FETCH_TIMEOUT_SEC", 10.0))
+IMAGE_FETCH_MAX_CONNECTIONS_PER_HOST = int(os.environ.get("IMAGE_FETCH_MAX_CONNECTIONS_PER_HOST", 16))
+IMAGE_FETCH_MAX_BYTES = int(os.environ.get("IMAGE_FETCH_MAX_BYTES", 100 * 1024 * 1024))
+# Results of previous requests (disabled if max entries is 0)
+RESULT_CACHE_PATH = os.environ.get("RESULT_CACHE_PATH", "/data/result-cache/layout.sqlite3")
+RESULT_CACHE_TTL_SEC = float(os.environ.get("RESULT_CACHE_TTL_SEC", 30 * 24 * 3600))
+RESULT_CACHE_MAX_ENTRIES = int(os.environ.get("RESULT_CACHE_MAX_ENTRIES", 0))
+# Part of the result cache key: change it when the layout service is updated
+LAYOUT_MODEL_VERSION = os.environ.get("LAYOUT_MODEL_VERSION", "")
+
+# Pooled clients, shared by all requests
+image_fetcher: AsyncImageFetcher = None
+layout_client: httpx.AsyncClient = None
+layout_balancer: ReplicaBalancer = None
+result_cache: ResultCache = None
+
+REQUESTS_IN_FLIGHT = metrics.Gauge("mezanno_layout_wrapper_requests_in_flight", "Layout requests being processed.")
+RESULT_CACHE_LOOKUPS = metrics.Counter("mezanno_layout_wrapper_result_cache_lookups_total",
+                                       "Lookups of layouts in the result cache, by result ('hit' or 'miss').", ["result"])
+REPLICA_REQUESTS_IN_FLIGHT = metrics.Gauge("mezanno_layout_replica_requests_in_flight",
+                                           "Requests sent to each layout replica and not answered yet.", ["replica"])
+REPLICA_QUEUED_REQUESTS = metrics.Gauge("mezanno_layout_replica_queued_requests", "Requests waiting for a free layout replica.")
+REPLICA_QUEUED_REQUESTS.set_function(lambda: layout_balancer.stats()["queued"] if layout_balancer is not None else 0)
+REPLICA_REQUESTS_IN_FLIGHT.set_function(lambda: {
+    (url,): count for url, count in (layout_balancer.stats()["in_flight"].items() if layout_balancer is not None else ())})
+
+
+async def refresh_layout_replicas():
+    """Periodically updates the layout replicas from the addresses of the hosts of LAYOUT_SERVICE_URLS."""
+    while True:
+        replica_urls = await resolve_replica_urls(LAYOUT_SERVICE_URLS)
+        if set(replica_urls) != set(layout_balancer.stats()["in_flight"]):
+            print(f"layout replicas: {replica_urls}")
+            await layout_balancer.set_replicas(replica_urls)
+        await asyncio.sleep(LAYOUT_REPLICAS_REFRESH_SEC)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global image_fetcher, layout_client, layout_balancer, result_cache
+    # Spans are exported as configured by TRACING_EXPORTER (see tracing.py)
+    tracing.configure("layout-worker-wrapper")
+    metrics.observe_spans()
+    image_fetcher = AsyncImageFetcher(
+        timeout_sec=IMAGE_FETCH_TIMEOUT_SEC,
+        max_connections_per_host=IMAGE_FETCH_MAX_CONNECTIONS_PER_HOST,
+        max_bytes=IMAGE_FETCH_MAX_BYTES,
+    )
+    layout_client = httpx.AsyncClient(timeout=LAYOUT_TIMEOUT_SEC)
+    layout_balancer = ReplicaBalancer(
+        LAYOUT_SERVICE_URLS,
+        max_in_flight=LAYOUT_MAX_IN_FLIGHT_PER_REPLICA,
+        max_queued=LAYOUT_MAX_QUEUED if LAYOUT_MAX_QUEUED >= 0 else None,
+    )
+    refresh_task = None
+    if LAYOUT_REPLICAS_REFRESH_SEC > 0:
+        refresh_task = asyncio.create_task(refresh_layout_replicas())
+    if RESULT_CACHE_MAX_ENTRIES > 0:
+        result_cache = ResultCache(RESULT_CACHE_PATH, ttl_sec=RESULT_CACHE_TTL_SEC, max_entries=RESULT_CACHE_MAX_ENTRIES)
+    yield
+    if refresh_task is not None:
+        refresh_task.cancel()
+    await image_fetcher.aclose()
+    await layout_client.aclose()
+    if result_cache is not None:
+        result_cache.close()
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+@app.get("/metrics")
+async def get_metrics():
+    """Prometheus metrics of the wrapper (see metrics.py)."""
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
 
 @app.get("/layout")
 async def layout(
@@ -12,51 +108,107 @@ async def layout(
     auto_denoise: bool = True,
     text_x_height_pixels: int = -1,
     # try_download_image: bool = False,
+    timings: bool = False,
+    traceparent: str | None = Header(None),
     ):
     """
     Simple wrapper for the real layout service.
     Download the image from the given URL and send it to the layout service.
     Layout service will return the layout of the image as a JSON object.
     We must send the image using a binary POST request.
+
+    The request is traced as a child of the `traceparent` header, if any (see tracing.py).
+    With `timings`, the answer has a `"timings"` field with the duration (seconds) of each stage.
     """
+    REQUESTS_IN_FLIGHT.inc()
+    try:
+        with tracing.collect_timings() as stage_timings, \
+                tracing.span("wrapper.layout", traceparent=traceparent, image_url=image_url):
+            answer = await _layout(image_url, auto_deskew, auto_bg_removal, auto_denoise, text_x_height_pixels)
+    finally:
+        REQUESTS_IN_FLIGHT.dec()
+    if timings and isinstance(answer, dict):
+        answer = {**answer, "timings": stage_timings}
+    return answer
 
+
+async def _layout(image_url: str, auto_deskew: bool, auto_bg_removal: bool, auto_denoise: bool,
+                  text_x_height_pixels: int):
+    """`layout`, within its span."""
     # Debug output
     print(f"image_url: {image_url}")
 
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.get(image_url, timeout=10.0)
-        except httpx.RequestError as exc:
+    cache_key = make_cache_key(
+        "layout",
+        image_url=image_url,
+        auto_deskew=auto_deskew,
+        auto_bg_removal=auto_bg_removal,
+        auto_denoise=auto_denoise,
+        text_x_height_pixels=text_x_height_pixels,
+        model_version=LAYOUT_MODEL_VERSION,
+    )
+    if result_cache is not None:
+        with tracing.span("wrapper.result_cache") as span:
+            cached_layout = await asyncio.to_thread(result_cache.get, cache_key)
+            span.set_attribute("hit", cached_layout is not None)
+        RESULT_CACHE_LOOKUPS.inc(result="hit" if cached_layout is not None else "miss")
+        if cached_layout is not None:
+            print(f"result cache hit for {image_url}")
+            return cached_layout
+
+    try:
+        # Wait for a free layout replica before downloading the image, so that waiting requests hold
+        # neither an image connection nor image data; the image body is then streamed from the image
+        # server to the layout service, chunk by chunk
+        waiting_since = time.time()
+        async with layout_balancer.replica() as layout_url:
+            with tracing.span("wrapper.wait_replica", start_time=waiting_since):
+                pass
+            # Downloading and layout analysis overlap, since the image is streamed: a single span covers both
+            with tracing.span("wrapper.layout_service", layout_url=layout_url):
+                async with image_fetcher.stream(image_url) as image_response:
+                    headers = {tracing.TRACEPARENT_HEADER: tracing.current_traceparent()}
+                    if "Content-Length" in image_response.headers and "Content-Encoding" not in image_response.headers:
+                        # Lets the layout service read a sized body rather than a chunked one
+                        headers["Content-Length"] = image_response.headers["Content-Length"]
+                    # Debug output
+                    print(f"streaming image ({headers.get('Content-Length', 'unknown size')} bytes) to {layout_url}")
+                    layout_response = await layout_client.post(
+                        layout_url,
+                        content=image_fetcher.iter_body(image_response),
+                        headers=headers,
+                    )
+    except QueueFullError as exc:
+        raise HTTPException(status_code=503, detail=str(exc), headers={"Retry-After": "5"})
+    except ImageFetchError as exc:
+        if exc.status_code is None:
             return {
-                "message": f"An error occurred while requesting {exc.request.url!r}.",
+                "message": f"An error occurred while requesting {exc.url!r}.",
                 "error": str(exc),
             }
+        return {
+            "message": "image server error",
+            "status_code": exc.status_code,
+            "content": exc.content,
+            }
+    except httpx.HTTPError as exc:
+        return {
+            "message": "An error occurred while requesting the layout service.",
+            "error": str(exc),
+        }
+
+    if layout_response.status_code == 200:
+        layout = layout_response.json()
+        if result_cache is not None:
+            await asyncio.to_thread(result_cache.put, cache_key, layout)
+        return layout
+    else:
+        return {
+            "message": "layout server error",
+            "status_code": layout_response.status_code,
+            "content": layout_response.content,
+            }
 
-        if response.status_code == 200:
-            # Debug output
-            print(f"image downloaded: {len(response.content)} bytes")
-            # Send the image to the layout service
-            layout_service_url = "http://layout-worker:8000/imgproc/layout"
-            layout_response = await client.post(
-                layout_service_url,
-                content=response.content,
-                # headers={"Content-Type": "application/octet-stream"},
-            )
-            if layout_response.status_code == 200:
-                return layout_response.json()
-            else:
-                return {
-                    "message": "layout server error",
-                    "status_code": layout_response.status_code,
-                    "content": layout_response.content,
-                    }
-        else:
-            return {
-                "message": "image server error",
-                "status_code": response.status_code,
-                "content": response.content,
-                }
-    
 
 
 if __name__ == "__main__":
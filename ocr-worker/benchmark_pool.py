@@ -0,0 +1,120 @@
+"""
+Benchmark of the prefork worker mode: OCR throughput (pages/sec) against the number of pool processes.
+
+PERO models are loaded once in this process. Then, for each process count N, N processes are forked
+(sharing the model weights copy-on-write, as the Celery prefork pool does with `PERO_PRELOAD_MODELS=True`),
+each with `cores // N` inference threads (or `--threads`), and they transcribe `--pages` pages in total.
+The memory of the processes (PSS, which splits shared pages between the processes using them) shows
+how much of the models is shared.
+
+Example (in the worker image, where models are in PERO_CONFIG_DIR):
+    python benchmark_pool.py --image tmp_test_data/default.webp --pages 32 --processes 1,2,4,8
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import time
+
+import cv2
+
+from pero_ocr_driver import PERO_driver, available_cpu_count, preload_page_parser, set_inference_threads
+
+
+def _pss_mib() -> float:
+    """Proportional set size of this process (Linux only, 0 elsewhere)."""
+    try:
+        with open("/proc/self/smaps_rollup") as f:
+            for line in f:
+                if line.startswith("Pss:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return 0.
+
+
+def _run_process(config_path, batch_lines, image, bboxes, page_count, thread_count, start_event, results):
+    set_inference_threads(thread_count)
+    driver = PERO_driver(config_path, batch_lines=batch_lines)
+    # Warm-up, outside of the measure
+    driver.detect_and_recognize(image, bboxes)
+    results.put(("ready", _pss_mib()))
+    start_event.wait()
+    for _ in range(page_count):
+        driver.detect_and_recognize(image, bboxes)
+    results.put(("done", _pss_mib()))
+
+
+def benchmark(ctx, args, image, bboxes, process_count: int, cores: int) -> dict:
+    thread_count = args.threads or max(1, cores // process_count)
+    page_counts = [args.pages // process_count + (ii < args.pages % process_count) for ii in range(process_count)]
+    start_event = ctx.Event()
+    results = ctx.Queue()
+    processes = [
+        ctx.Process(target=_run_process, args=(args.config_path, args.batch_lines, image, bboxes, page_count,
+                                               thread_count, start_event, results))
+        for page_count in page_counts
+    ]
+    for process in processes:
+        process.start()
+    ready_pss = [results.get()[1] for _ in processes]
+    start = time.perf_counter()
+    start_event.set()
+    done_pss = [results.get()[1] for _ in processes]
+    elapsed = time.perf_counter() - start
+    for process in processes:
+        process.join()
+    return {
+        "processes": process_count,
+        "threads_per_process": thread_count,
+        "pages": args.pages,
+        "elapsed_sec": elapsed,
+        "pages_per_sec": args.pages / elapsed,
+        "pages_per_sec_per_core": args.pages / elapsed / min(cores, process_count * thread_count),
+        "pss_mib": _pss_mib() + max(sum(ready_pss), sum(done_pss)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of the prefork OCR worker mode")
+    parser.add_argument("--config_path", default=os.environ.get("PERO_CONFIG_DIR"), type=str,
+                        help="PERO configuration dir")
+    parser.add_argument("--image", default="tmp_test_data/default.webp", type=str, help="Page image")
+    parser.add_argument("--regions", default="[]", type=str,
+                        help="Regions (JSON list of [xtl, ytl, xbr, ybr]), the full page if empty")
+    parser.add_argument("--pages", default=16, type=int, help="Number of pages transcribed for each process count")
+    parser.add_argument("--processes", default="1,2,4", type=str, help="Process counts to compare")
+    parser.add_argument("--threads", default=0, type=int,
+                        help="Inference threads per process (0: available cores divided by the process count)")
+    parser.add_argument("--batch_lines", action="store_true", help="Recognize lines of all regions in one batch")
+    parser.add_argument("--output", default=None, type=str, help="JSON file to write results to")
+    args = parser.parse_args()
+
+    image = cv2.imread(args.image)
+    if image is None:
+        raise ValueError(f"Cannot read image {args.image}.")
+    image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+    bboxes = [tuple(bbox) for bbox in json.loads(args.regions)] or [(0, 0, image.shape[1], image.shape[0])]
+
+    cores = available_cpu_count()
+    print(f"{cores} available cores, {len(bboxes)} regions per page.")
+    # Load models before forking, without running any inference in this process
+    preload_page_parser(args.config_path)
+    print(f"Models loaded, parent process PSS: {_pss_mib():.0f} MiB.")
+
+    ctx = multiprocessing.get_context("fork")
+    results = []
+    for process_count in [int(n) for n in args.processes.split(",")]:
+        result = benchmark(ctx, args, image, bboxes, process_count, cores)
+        results.append(result)
+        print(f"{result['processes']} processes x {result['threads_per_process']} threads:"
+              f" {result['pages_per_sec']:.2f} pages/s ({result['pages_per_sec_per_core']:.3f} pages/s/core),"
+              f" PSS {result['pss_mib']:.0f} MiB")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"cores": cores, "regions": len(bboxes), "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+"""
+Cache of decoded images shared by all the worker processes of a node.
+
+Decoded RGB images are stored as `.npy` files in a directory which should live in
+shared memory (`/dev/shm`), and are memory-mapped when read: every Celery worker
+process of the node reuses a single decode, without copying the pixels.
+
+Images are keyed by the sha256 of their encoded content. A second index maps image
+URLs to content hashes, so that a URL seen recently can skip the download too.
+Eviction is least-recently-used (hits refresh the file modification time), bounded
+by a byte budget. Writes are atomic (temporary file + rename), so processes never
+see partial files, and evicting a file does not invalidate existing memory maps.
+"""
+
+import hashlib
+import os
+import tempfile
+import time
+from typing import Optional
+
+import numpy as np
+
+
+class DecodedImageCache():
+    def __init__(self, cache_dir: str, max_bytes: int, url_ttl_sec: float = 3600.) -> None:
+        """
+        Args:
+            cache_dir (str): Directory holding the cache, created if needed.
+            max_bytes (int): Max total size of the decoded images.
+            url_ttl_sec (float): How long a URL is assumed to keep pointing to the same content.
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.url_ttl_sec = url_ttl_sec
+        self._images_dir = os.path.join(cache_dir, "images")
+        self._urls_dir = os.path.join(cache_dir, "urls")
+        os.makedirs(self._images_dir, exist_ok=True)
+        os.makedirs(self._urls_dir, exist_ok=True)
+        # Counters of the current process
+        self.counters = {"url_hits": 0, "hits": 0, "misses": 0, "evictions": 0}
+
+    @staticmethod
+    def content_hash(data: bytes) -> str:
+        return hashlib.sha256(data).hexdigest()
+
+    def _image_path(self, content_hash: str) -> str:
+        return os.path.join(self._images_dir, content_hash + ".npy")
+
+    def _url_path(self, url: str) -> str:
+        return os.path.join(self._urls_dir, hashlib.sha256(url.encode("utf-8")).hexdigest())
+
+    def get_by_url(self, url: str) -> Optional[np.ndarray]:
+        """Returns the image last downloaded from `url`, if it is recent enough and still cached."""
+        url_path = self._url_path(url)
+        try:
+            if time.time() - os.stat(url_path).st_mtime > self.url_ttl_sec:
+                return None
+            with open(url_path, "r") as f:
+                content_hash = f.read().strip()
+        except OSError:
+            return None
+        image = self._load(content_hash)
+        if image is not None:
+            self.counters["url_hits"] += 1
+        return image
+
+    def get(self, content_hash: str, url: Optional[str] = None) -> Optional[np.ndarray]:
+        """Returns the decoded image for some content, or None.
+
+        If `url` is given, it is recorded as pointing to this content.
+        """
+        image = self._load(content_hash)
+        if image is None:
+            self.counters["misses"] += 1
+            return None
+        self.counters["hits"] += 1
+        if url is not None:
+            self._write_atomic(self._url_path(url), lambda f: f.write(content_hash.encode("utf-8")))
+        return image
+
+    def put(self, content_hash: str, image: np.ndarray, url: Optional[str] = None) -> np.ndarray:
+        """Stores a decoded image, and returns it memory-mapped from the cache.
+
+        If `url` is given, it is recorded as pointing to this content.
+        """
+        if image.nbytes > self.max_bytes:
+            return image
+        self._write_atomic(self._image_path(content_hash), lambda f: np.save(f, image, allow_pickle=False))
+        if url is not None:
+            self._write_atomic(self._url_path(url), lambda f: f.write(content_hash.encode("utf-8")))
+        self._evict()
+        cached = self._load(content_hash)
+        return image if cached is None else cached
+
+    def stats(self) -> dict:
+        """Counters of the current process, and current size of the cache."""
+        sizes = [entry.stat().st_size for entry in os.scandir(self._images_dir) if entry.name.endswith(".npy")]
+        return {**self.counters, "entries": len(sizes), "bytes": sum(sizes), "max_bytes": self.max_bytes}
+
+    def _load(self, content_hash: str) -> Optional[np.ndarray]:
+        path = self._image_path(content_hash)
+        try:
+            image = np.load(path, mmap_mode="r", allow_pickle=False)
+            # Mark as recently used
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return image
+
+    def _write_atomic(self, path: str, write_fn) -> None:
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                write_fn(f)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def _evict(self) -> None:
+        """Removes least recently used images until the cache fits in its byte budget."""
+        entries = []
+        for entry in os.scandir(self._images_dir):
+            if not entry.name.endswith(".npy"):
+                continue
+            try:
+                st = entry.stat()
+            except OSError:
+                continue  # removed by another process
+            entries.append((st.st_mtime, st.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                self.counters["evictions"] += 1
+            except OSError:
+                pass
+            total -= size
+        # URL index entries are tiny: just drop expired ones
+        now = time.time()
+        for entry in os.scandir(self._urls_dir):
+            try:
+                if now - entry.stat().st_mtime > self.url_ttl_sec:
+                    os.remove(entry.path)
+            except OSError:
+                pass
@@ -2,14 +2,18 @@
 import configparser
 from functools import lru_cache
 import os
+import time
 from typing import List
 
 import numpy as np
 import cv2
+import torch
 
 from pero_ocr.core.layout import PageLayout, TextLine
 from pero_ocr.document_ocr.page_parser import PageParser
 
+import tracing
+
 
 # from celery.utils.log import get_task_logger
 # logger = get_task_logger(__name__)
@@ -25,8 +29,32 @@ def _load_pero_page_parser(config_path):
     return PageParser(config, config_path=config_path)
 
 
+def preload_page_parser(config_path: str) -> None:
+    """Loads the PERO models of `config_path` in this process.
+
+    Every `PERO_driver` of this process then reuses them, and so do processes forked
+    afterwards: their model weights are shared copy-on-write with this process.
+    No inference must run before forking (OpenMP thread pools do not survive `fork`).
+    """
+    _load_pero_page_parser(config_path)
+
+
+def set_inference_threads(thread_count: int) -> None:
+    """Sets the number of threads used by torch (intra-op) and OpenCV in this process."""
+    torch.set_num_threads(thread_count)
+    cv2.setNumThreads(thread_count)
+
+
+def available_cpu_count() -> int:
+    """Number of CPU cores this process may run on."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
 class PERO_driver():
-    def __init__(self, config_path: str) -> None:
+    def __init__(self, config_path: str, batch_lines: bool = False, max_padding_ratio: float = 0.25) -> None:
         """
         Wrapper to PERO OCR.
 
@@ -37,14 +65,36 @@ class PERO_driver():
                 - checkpoint_350000.pth
                 - config.ini
                 - ocr_engine.json
+            batch_lines (bool): If True, `detect_and_recognize` detects lines region by region
+                but recognizes the lines of all regions in a single batch.
+            max_padding_ratio (float): Max share of padding pixels in each bucket of lines
+                prepared by `recognize_lines` (see `resize_and_pad_images`).
         """
         self.config_path = config_path
+        self.batch_lines = batch_lines
+        self.max_padding_ratio = max_padding_ratio
+        # Statistics of the last call of each processing step, to tune parameters
+        self.last_stats = {}
         self.page_parser = _load_pero_page_parser(config_path)
 
         # Reuse already initialized OCR engine
         self.ocr_engine = self.page_parser.ocr.ocr_engine
 
 
+    def warm_up(self) -> float:
+        """Transcribes a small synthetic page, so that the first real request does not pay
+        for lazy initializations (thread pools, kernel selection, first allocations).
+
+        Returns:
+            float: duration of the warm-up inference, in seconds.
+        """
+        page = np.full((256, 1024, 3), 255, dtype=np.uint8)
+        for line_idx, text in enumerate(["Warm-up page", "of the OCR worker", "0123456789"]):
+            cv2.putText(page, text, (32, 64 + 64 * line_idx), cv2.FONT_HERSHEY_SIMPLEX, 1.5, (0, 0, 0), 3)
+        start = time.perf_counter()
+        self.detect_and_recognize(page, [(0, 0, page.shape[1], page.shape[0])])
+        return time.perf_counter() - start
+
 
     def detect_and_recognize(self, image, bbox_list: list) -> list:
         """Process rectangular regions by detecting text regions and lines, then OCRing them.
@@ -54,62 +104,170 @@ class PERO_driver():
             bbox_list (list of tuples of int): bounding boxes of the regions
 
         Returns:
-            list of Pero lines: List of complex line objects are produced by Pero
+            list of list of dict: for each region, its lines (`id`, `polygon` as a numpy
+                array in full image coordinates, `transcription`, `transcription_confidence`)
+        """
+        if self.batch_lines:
+            return self.detect_and_recognize_many([(image, bbox_list)])[0]
+
+        # list of list of lines (a list of lines for each region)
+        return [lines for _region_idx, lines in self.detect_and_recognize_iter(image, bbox_list)]
+
+
+    def detect_and_recognize_iter(self, image, bbox_list: list):
+        """Same as `detect_and_recognize`, but yields the lines of each region as soon as it is processed.
+
+        Regions are always processed one by one (`batch_lines` is ignored), so that the first
+        results are available early.
+
+        Yields:
+            tuple: `(region index, lines of the region)`, in the order of `bbox_list`
         """
         # This should run in a different thread / process / worker machine to avoid freezing the server
-        line_lists = []  # list of list of lines (a list of lines for each region)
-        for (tlx, tly, blx, bly) in bbox_list:
-            print(f"Processing region: {tlx}, {tly}, {blx}, {bly}")
-            if not (0 <= tlx < blx and 0 <= tly < bly):
-                # skipping invalid bbox
-                line_lists.append([])
-                print(f"Skipping invalid bbox: {tlx}, {tly}, {blx}, {bly}")
+        for region_idx, bbox in enumerate(bbox_list):
+            crop = self._crop_region(image, bbox)
+            if crop is None:
+                yield region_idx, []
                 continue
-            crop = image[tly:bly, tlx:blx, ...]
-            if crop.ndim == 2:
-                # convert grayscale to color if needed
-                crop = np.tile(crop[..., np.newaxis], (1, 1, 3))
 
             page_layout = PageLayout(id="00", page_size=(crop.shape[0], crop.shape[1]))
 
             # The real thing
             print(f"Processing image of size {crop.shape} with pero.")
-            page_layout2 = self.page_parser.process_page(crop, page_layout)
-            lines: List[TextLine] = list(page_layout2.lines_iterator())
-            print(f"Found {len(lines)} lines.")
-
-            # The TextLine object contains the following attributes:
-            # - id
-            # - index
-            # - baseline
-            # - polygon
-            # - heights
-            # - transcription
-            # - logits
-            # - crop
-            # - characters
-            # - logit_coords
-            # - transcription_confidence
-
-            # Convert to a list of dictionaries
-            offset = np.array([tlx, tly])
-            lines = [
-                {
-                    "id": line.id,
-                    # "index": line.index,
-                    # "baseline": (line.baseline + offset).tolist(),
-                    "polygon": (line.polygon + offset).tolist(),
-                    # "heights": line.heights,
-                    "transcription": line.transcription,
-                    # "logits": line.logits,
-                    "transcription_confidence": float(line.transcription_confidence),
-                } for line in lines
-            ]
-
-            line_lists.append(lines)
+            with tracing.span("pero.process_page", height=crop.shape[0], width=crop.shape[1]):
+                page_layout2 = self.page_parser.process_page(crop, page_layout)
+            yield region_idx, self._layout_to_dicts(page_layout2, bbox)
+
+
+    def detect_and_recognize_many(self, jobs: list) -> list:
+        """Same as `detect_and_recognize` for several images, with line recognition batched across regions.
+
+        Layout analysis and line cropping run region by region, then the lines of all the
+        regions of all the images are recognized with a single call to `ocr_engine.process_lines`
+        (which sorts lines by width and batches them up to `max_input_horizontal_pixels`),
+        instead of one small batch per region. Results are then scattered back to their regions.
+
+        Args:
+            jobs (list of tuples): `(image, bbox_list)` pairs, as given to `detect_and_recognize`
+
+        Returns:
+            list: for each job, the result of `detect_and_recognize`
+        """
+        # Detect lines in every region
+        line_lists = []  # for each job, a list of lines for each region
+        detected = []  # (job index, region index, bbox, page layout)
+        for job_idx, (image, bbox_list) in enumerate(jobs):
+            line_lists.append([[] for _ in bbox_list])
+            for region_idx, bbox in enumerate(bbox_list):
+                crop = self._crop_region(image, bbox)
+                if crop is None:
+                    continue
+                print(f"Detecting lines in image of size {crop.shape} with pero.")
+                page_layout = PageLayout(id="00", page_size=(crop.shape[0], crop.shape[1]))
+                with tracing.span("pero.detect_lines", height=crop.shape[0], width=crop.shape[1]):
+                    page_layout = self._detect_lines(crop, page_layout)
+                detected.append((job_idx, region_idx, bbox, page_layout))
+
+        # Recognize all lines at once
+        with tracing.span("pero.recognize_lines", regions=len(detected)):
+            self._recognize_layouts([page_layout for (_, _, _, page_layout) in detected])
+
+        for job_idx, region_idx, bbox, page_layout in detected:
+            line_lists[job_idx][region_idx] = self._layout_to_dicts(page_layout, bbox)
         return line_lists
 
 
+    @staticmethod
+    def _crop_region(image, bbox):
+        """Crops a region as a color image, or returns None if the bbox is invalid."""
+        (tlx, tly, blx, bly) = bbox
+        print(f"Processing region: {tlx}, {tly}, {blx}, {bly}")
+        if not (0 <= tlx < blx and 0 <= tly < bly):
+            # skipping invalid bbox
+            print(f"Skipping invalid bbox: {tlx}, {tly}, {blx}, {bly}")
+            return None
+        crop = image[tly:bly, tlx:blx, ...]
+        if crop.ndim == 2:
+            # convert grayscale to color if needed
+            crop = np.tile(crop[..., np.newaxis], (1, 1, 3))
+        return crop
+
+
+    def _detect_lines(self, crop, page_layout: PageLayout) -> PageLayout:
+        """Runs the stages of `PageParser.process_page` which come before OCR."""
+        if self.page_parser.run_layout_parser:
+            for layout_parser in self.page_parser.layout_parsers:
+                page_layout = layout_parser.process_page(crop, page_layout)
+        if self.page_parser.run_line_cropper:
+            page_layout = self.page_parser.line_cropper.process_page(crop, page_layout)
+        return page_layout
+
+
+    def _recognize_layouts(self, page_layouts: list) -> list:
+        """Runs the stages of `PageParser.process_page` from OCR on, with a single OCR batch for all layouts."""
+        page_parser = self.page_parser
+        if page_parser.run_ocr:
+            lines: List[TextLine] = [line for page_layout in page_layouts for line in page_layout.lines_iterator()]
+            for line in lines:
+                if line.crop is None:
+                    raise Exception(f'Missing crop in line {line.id}.')
+            print(f"Recognizing {len(lines)} lines from {len(page_layouts)} regions with pero.")
+            transcriptions, logits, logit_coords = self.ocr_engine.process_lines([line.crop for line in lines])
+            for line, line_transcription, line_logits, line_logit_coords in zip(lines, transcriptions, logits, logit_coords):
+                line.transcription = line_transcription
+                line.logits = line_logits
+                line.characters = self.ocr_engine.characters
+                line.logit_coords = line_logit_coords
+
+        for ii, page_layout in enumerate(page_layouts):
+            if page_parser.run_decoder:
+                page_layout = page_parser.decoder.process_page(page_layout)
+            page_parser.update_confidences(page_layout)
+            if page_parser.filter_confident_lines_threshold > 0:
+                page_layout = page_parser.filter_confident_lines(page_layout)
+            page_layouts[ii] = page_layout
+        return page_layouts
+
+
+    @staticmethod
+    def _layout_to_dicts(page_layout: PageLayout, bbox) -> list:
+        """Converts the lines of a region layout to dicts, in full image coordinates.
+
+        Polygons are kept as numpy arrays: they are converted to lists or packed (see
+        `_format_ocr_result` in worker.py) depending on the requested result format.
+        """
+        lines: List[TextLine] = list(page_layout.lines_iterator())
+        print(f"Found {len(lines)} lines.")
+
+        # The TextLine object contains the following attributes:
+        # - id
+        # - index
+        # - baseline
+        # - polygon
+        # - heights
+        # - transcription
+        # - logits
+        # - crop
+        # - characters
+        # - logit_coords
+        # - transcription_confidence
+
+        # Convert to a list of dictionaries
+        offset = np.array([bbox[0], bbox[1]])
+        return [
+            {
+                "id": line.id,
+                # "index": line.index,
+                # "baseline": (line.baseline + offset).tolist(),
+                "polygon": line.polygon + offset,
+                # "heights": line.heights,
+                "transcription": line.transcription,
+                # "logits": line.logits,
+                "transcription_confidence": float(line.transcription_confidence),
+            } for line in lines
+        ]
+
+
     def recognize_lines(self, image, bbox_list: list, pad_color=255) -> dict:
         """Process small rectangular regions to recognize the text contained in each
         of them.
@@ -124,7 +282,7 @@ class PERO_driver():
                 lines
 
         Returns:
-            dict[int, str]: Mapping of original bbox id to transcription (if any).
+            dict[int, tuple]: Mapping of original bbox id to `(transcription, confidence)` (if any).
                 This allows to skip bad lines.
         """
         # This should run in a different thread / process / worker machine to avoid freezing the server
@@ -133,47 +291,107 @@ class PERO_driver():
         crops_list = []  # list of list of lines (a list of lines for each region)
         orig_idx = []  # list of original bbox query for each valid crop
         for ii, (tlx, tly, blx, bly) in enumerate(bbox_list):
-            if not (0 < tlx < blx and 0 < tly < bly):
+            if not (0 <= tlx < blx and 0 <= tly < bly):
                 # skipping invalid bbox
                 continue
             crop = image[tly:bly, tlx:blx, ...]
+            if crop.size == 0:
+                # bbox outside of the image
+                continue
             if crop.ndim == 2:
                 # convert grayscale to color if needed
                 crop = np.tile(crop[..., np.newaxis], (1, 1, 3))
             crops_list.append(crop)
             orig_idx.append(ii)
         
-        # Prepare the images so they all have the same shape
+        # Prepare the images so they all have the same shape within each bucket
         target_h = self.ocr_engine.line_px_height
         max_width = self.ocr_engine.max_input_horizontal_pixels
-        crops_ready = self.resize_and_pad_images(crops_list, target_h=target_h, max_width=max_width, bg_color=pad_color)
+        buckets, stats = self.resize_and_pad_images(crops_list, target_h=target_h, max_width=max_width, bg_color=pad_color,
+                                                    max_padding_ratio=self.max_padding_ratio)
+        self.last_stats["resize_and_pad"] = stats
+        print(f"Resized {stats['image_count']} lines into {stats['bucket_count']} buckets"
+              f" (padding ratio {stats['padding_ratio']:.3f}, {stats['single_bucket_padding_ratio']:.3f} with a single bucket).")
 
         # Real thing here
-        all_transcriptions, _all_logits, _all_logit_coords = self.ocr_engine.process_lines(crops_ready)
-
-        # Return mapping of {valid_idx -> transcription}
         results = {}
-        for oi, tr in zip(orig_idx, all_transcriptions):
-            results[oi] = tr
+        for bucket_idx, batch in buckets:
+            with tracing.span("pero.recognize_lines", lines=len(batch)):
+                all_transcriptions, all_logits, _all_logit_coords = self.ocr_engine.process_lines(batch)
+
+            # Return mapping of {valid_idx -> (transcription, confidence)}
+            for ci, tr, logits in zip(bucket_idx, all_transcriptions, all_logits):
+                results[orig_idx[ci]] = (tr, self._line_confidence(logits))
         return results
 
+
+    def recognize_line_regions(self, image, bbox_list: list) -> list:
+        """Same as `recognize_lines`, with the output format of `detect_and_recognize`.
+
+        Each bbox is a region holding a single line, whose polygon is the bbox rectangle.
+
+        Returns:
+            list of list of dict: for each bbox, a list with its line (empty if the line was skipped)
+        """
+        results = self.recognize_lines(image, bbox_list)
+        line_lists = []
+        for ii, (tlx, tly, blx, bly) in enumerate(bbox_list):
+            if ii not in results:
+                line_lists.append([])
+                continue
+            transcription, confidence = results[ii]
+            line_lists.append([{
+                "id": f"l{ii:04d}",
+                "polygon": np.array([[tlx, tly], [blx, tly], [blx, bly], [tlx, bly]], dtype=np.float64),
+                "transcription": transcription,
+                "transcription_confidence": confidence,
+            }])
+        return line_lists
+
+
+    def _line_confidence(self, logits) -> float:
+        """Confidence of a line transcription, computed from its logits as `PageParser` does."""
+        if logits is None or logits.shape[0] == 0:
+            # e.g. empty logits for very short lines
+            return 0.
+        line = TextLine(logits=logits, characters=self.ocr_engine.characters)
+        return float(self.page_parser.compute_line_confidence(line))
+
     @staticmethod
-    def resize_and_pad_images(img_list, target_h, max_width, bg_color=255):
+    def resize_and_pad_images(img_list, target_h, max_width, bg_color=255, max_padding_ratio=0.25):
         '''
-        Generates a new list where all images have the same shape.
+        Groups images in buckets where all images have the same shape.
         
         Will use resizing to reduce if needed, and padding otherwise.
         Background is filled with `bg_color` when padding.
         
-        The target shape is `(target_h, min(W, max_width), channels)` where:
+        Images are sorted by width after scaling, then split into buckets of consecutive
+        widths, so that horizontal padding stays below `max_padding_ratio` of the pixels
+        of each bucket (a bucket holding a single image never needs horizontal padding).
+        The target shape of a bucket is `(target_h, W, channels)` where:
         - `target_h` is a given parameter
-        - `max_width` is a given parameter
-        - `W` is the width of the largest image (after scaling)
+        - `W` is the width of the largest image of the bucket (after scaling), at most `max_width`
         - `channels` is the number of channels (all images must be either RGB or grayscale)
+
+        Returns:
+            tuple: `(buckets, stats)` where:
+            - `buckets` is a list of `(indices, batch)` pairs, `batch` being a contiguous array
+              of shape `(len(indices), target_h, W[, channels])` and `indices` the positions of
+              its images in `img_list`, by increasing width
+            - `stats` is a dict with the number of images and buckets, the width of each bucket,
+              and the padding ratios (share of padding pixels) with these buckets and with a
+              single bucket
         '''
+        stats = {
+            "image_count": len(img_list),
+            "bucket_count": 0,
+            "bucket_widths": [],
+            "padding_ratio": 0.,
+            "single_bucket_padding_ratio": 0.,
+        }
         # We expect at least 1 element
         if len(img_list) == 0:
-            return []
+            return [], stats
         img0 = img_list[0]
         
         # Gather shapes
@@ -186,57 +404,67 @@ class PERO_driver():
                 raise ValueError("All images must have the same number of channels.")
         
         # Compute target shapes
-        resized_shapes = []
-        for ii, (h, w) in enumerate(shapes):
-            ratio = 1.
-            new_h = h
-            new_w = w
-            if new_h > target_h:
-                # Try to resize image
-                new_h = target_h
-                ratio = target_h / h
-                new_w = int(w * ratio)
-            
-            if new_w > max_width:
-                print(f"WARNING: large image (f{ii}): width after resize is f{new_w} and max width is f{max_width}.")
-                new_w = max_width
-                ratio = max_width / w
-                new_h = int(h * ratio)
-        
-            resized_shapes.append((new_h, new_w))
-        
-            # Check for small images
-            if h < target_h / 2:
-                print(f"WARNING: small image (f{ii}): target height is f{target_h} but image height is f{h}.")
-            if w < target_h:
-                print(f"WARNING: thin image (f{ii}): image height is f{w} (target height is f{target_h} and max width is f{max_width}.")
-
-        # print("\n".join([f"({h1}, {w1}) > ({h2}, {w2})" for (h1, w1), (h2, w2) in zip(shapes, resized_shapes)]))
-        
-        # Need actual_max_w for padding
-        actual_max_w = np.max(np.array(resized_shapes)[:,1])
-        # print(f"actual_max_w: {actual_max_w}")
-        
-        # Resize and pad images
-        final_shape = (target_h, actual_max_w, 3) if img0.ndim > 2 else (target_h, actual_max_w)
-        final_images = []
-        for (new_h, new_w), img in zip(resized_shapes, img_list):
-            h, w = img.shape[:2]
-            
-            resized = img
-            if new_h < h:
-                # Must resize
-                resized = cv2.resize(img, (new_w, new_h))
-            
-            padded = resized
-            if new_h < target_h or new_w < actual_max_w:
-                # Must pad
-                padded = np.full(final_shape, bg_color, dtype=img.dtype)
-                padded[:resized.shape[0],:resized.shape[1],...] = resized
-            
-            final_images.append(padded)
-            
-        return final_images
+        h, w = shapes[:, 0], shapes[:, 1]
+        new_h = np.minimum(h, target_h)
+        new_w = np.where(h > target_h, (w * (target_h / h)).astype(int), w)
+        too_wide = new_w > max_width
+        new_h = np.where(too_wide, (h * (max_width / w)).astype(int), new_h)
+        new_w = np.where(too_wide, max_width, new_w)
+        new_h = np.maximum(new_h, 1)
+        new_w = np.maximum(new_w, 1)
+
+        # Check for large, small and thin images
+        if np.any(too_wide):
+            print(f"WARNING: {np.count_nonzero(too_wide)} large images: width after resize is above max width {max_width}"
+                  f" (first ones: {np.flatnonzero(too_wide)[:10].tolist()}).")
+        small = h < target_h / 2
+        if np.any(small):
+            print(f"WARNING: {np.count_nonzero(small)} small images: target height is {target_h} but image height is smaller"
+                  f" than {target_h / 2} (first ones: {np.flatnonzero(small)[:10].tolist()}).")
+        thin = w < target_h
+        if np.any(thin):
+            print(f"WARNING: {np.count_nonzero(thin)} thin images: image width is below target height {target_h}"
+                  f" (first ones: {np.flatnonzero(thin)[:10].tolist()}).")
+
+        # Sort by width and split into buckets with bounded padding
+        order = np.argsort(new_w, kind="stable")
+        sorted_w = new_w[order]
+        bucket_bounds = []  # (start, end) in `order`
+        start = 0
+        width_sum = 0
+        for ii, width in enumerate(sorted_w.tolist()):
+            # Padding ratio of the bucket [start, ii], whose width is `width` (the largest so far)
+            if ii > start and 1. - (width_sum + width) / ((ii - start + 1) * width) > max_padding_ratio:
+                bucket_bounds.append((start, ii))
+                start = ii
+                width_sum = 0
+            width_sum += width
+        bucket_bounds.append((start, len(order)))
+
+        # Resize and pad images, writing them into a single array per bucket
+        channels_shape = img0.shape[2:]
+        buckets = []
+        padded_pixels = 0
+        for start, end in bucket_bounds:
+            bucket_idx = order[start:end]
+            bucket_w = int(sorted_w[end - 1])
+            batch = np.full((end - start, target_h, bucket_w) + channels_shape, bg_color, dtype=img0.dtype)
+            for jj, ii in enumerate(bucket_idx):
+                img = img_list[ii]
+                resized = img
+                if new_h[ii] < h[ii]:
+                    # Must resize
+                    resized = cv2.resize(img, (int(new_w[ii]), int(new_h[ii])))
+                batch[jj, :resized.shape[0], :resized.shape[1], ...] = resized
+            buckets.append((bucket_idx.tolist(), batch))
+            padded_pixels += (end - start) * target_h * bucket_w
+
+        image_pixels = int(np.sum(new_h * new_w))
+        stats["bucket_count"] = len(buckets)
+        stats["bucket_widths"] = [batch.shape[2] for _, batch in buckets]
+        stats["padding_ratio"] = 1. - image_pixels / padded_pixels
+        stats["single_bucket_padding_ratio"] = 1. - image_pixels / (len(img_list) * target_h * int(sorted_w[-1]))
+        return buckets, stats
 
 
 def main_test():
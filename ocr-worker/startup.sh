@@ -17,6 +17,11 @@ set -o posix
 # Capture all parameters as the final command to be run
 COMMAND="$@"
 
+# Start time, reported by the worker with its startup duration
+STARTUP_STARTED_AT=$(date +%s.%N)
+# The worker creates this file once it is ready (see worker.py): remove the one of a previous run
+rm -f "${WORKER_READY_FILE:-/tmp/ocr-worker-ready}"
+
 # List of files, expected sha256 hashes (sha256sum), and their respective URLs
 declare -A files
 files=(
@@ -86,14 +91,23 @@ urls=(
 )
 
 # Function to check if a file exists and matches the expected hash
+# A marker file next to it records the hash with the size and modification time of the file
+# when it was last verified: unchanged files are not hashed again
 check_file() {
     local file=$1
     local expected_hash=$2
+    local marker="${file}.verified"
     if [[ -f "$file" ]]; then
+        local signature="$expected_hash $(stat -c '%s %Y' "$file")"
+        if [[ -f "$marker" && "$(cat "$marker")" == "$signature" ]]; then
+            echo "File $file is unchanged since it was verified."
+            return 0
+        fi
         # Calculate the hash of the file
         local hash=$(sha256sum "$file" | awk '{print $1}')
         if [[ "$hash" == "$expected_hash" ]]; then
             echo "File $file is present and matches the expected hash."
+            echo "$signature" > "$marker"
             return 0
         else
             echo "File $file is present but does not match the expected hash."
@@ -152,6 +166,10 @@ download_all_files() {
 # Main script
 echo "Downloading files if necessary..."
 download_all_files
+VERIFIED_AT=$(date +%s.%N)
+export WORKER_STARTUP_STARTED_AT="$STARTUP_STARTED_AT"
+export MODEL_VERIFICATION_SEC=$(awk "BEGIN {print $VERIFIED_AT - $STARTUP_STARTED_AT}")
+echo "Model files verified in ${MODEL_VERIFICATION_SEC} s."
 
 
 # Start the worker
@@ -0,0 +1,105 @@
+"""
+Stand-in for PERO OCR, to benchmark the stack without models (see api-ocr/load_test.py).
+
+`StubOCRDriver` has the interface of `PERO_driver`, and is used by the worker instead of it
+when `OCR_ENGINE=stub`. It does not read images: each region is cut into lines of
+`STUB_OCR_LINE_HEIGHT_PX` pixels, and each line costs `STUB_OCR_SEC_PER_LINE` seconds
+(plus `STUB_OCR_SEC_PER_MEGAPIXEL` seconds of line detection per megapixel of region).
+The cost is spent sleeping, or busy-waiting with `STUB_OCR_BUSY_WAIT=True` to hold a CPU
+core (and the GIL) like real inference.
+"""
+
+import os
+import time
+
+import cv2
+import numpy as np
+
+STUB_OCR_SEC_PER_LINE = float(os.environ.get("STUB_OCR_SEC_PER_LINE", 0.02))
+STUB_OCR_SEC_PER_MEGAPIXEL = float(os.environ.get("STUB_OCR_SEC_PER_MEGAPIXEL", 0.05))
+STUB_OCR_LINE_HEIGHT_PX = max(1, int(os.environ.get("STUB_OCR_LINE_HEIGHT_PX", 40)))
+STUB_OCR_BUSY_WAIT = os.environ.get("STUB_OCR_BUSY_WAIT", "False") in ["True", "true", "1"]
+
+
+def preload_page_parser(config_path: str) -> None:
+    """Nothing to load."""
+
+
+def set_inference_threads(thread_count: int) -> None:
+    cv2.setNumThreads(thread_count)
+
+
+def available_cpu_count() -> int:
+    """Number of CPU cores this process may run on."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def _spend(duration_sec: float) -> None:
+    if STUB_OCR_BUSY_WAIT:
+        end = time.perf_counter() + duration_sec
+        while time.perf_counter() < end:
+            pass
+    else:
+        time.sleep(duration_sec)
+
+
+class StubOCRDriver():
+    def __init__(self, config_path: str, batch_lines: bool = False, max_padding_ratio: float = 0.25) -> None:
+        """
+        Fake OCR engine with a configurable cost, with the interface of `PERO_driver`.
+
+        Args:
+            config_path (str): Ignored.
+            batch_lines (bool): Ignored.
+            max_padding_ratio (float): Ignored.
+        """
+        self.config_path = config_path
+        self.batch_lines = batch_lines
+        self.last_stats = {}
+
+    def warm_up(self) -> float:
+        start = time.perf_counter()
+        self.detect_and_recognize(None, [(0, 0, 1024, 256)])
+        return time.perf_counter() - start
+
+    @staticmethod
+    def _region_lines(bbox) -> list:
+        """Lines of a region: horizontal bands of `STUB_OCR_LINE_HEIGHT_PX` pixels, in full image coordinates."""
+        xtl, ytl, xbr, ybr = bbox
+        if xbr <= xtl or ybr <= ytl:
+            return []
+        lines = []
+        for line_idx, line_ytl in enumerate(range(ytl, ybr, STUB_OCR_LINE_HEIGHT_PX)):
+            line_ybr = min(line_ytl + STUB_OCR_LINE_HEIGHT_PX, ybr)
+            lines.append({
+                "id": f"r000-l{line_idx:03d}",
+                "polygon": np.array([[xtl, line_ytl], [xbr, line_ytl], [xbr, line_ybr], [xtl, line_ybr]], dtype=np.float64),
+                "transcription": f"Stub line {line_idx}",
+                "transcription_confidence": 0.9,
+            })
+        return lines
+
+    def detect_and_recognize(self, image, bbox_list: list) -> list:
+        return [lines for _region_idx, lines in self.detect_and_recognize_iter(image, bbox_list)]
+
+    def detect_and_recognize_iter(self, image, bbox_list: list):
+        for region_idx, bbox in enumerate(bbox_list):
+            lines = self._region_lines(bbox)
+            area = max(0, bbox[2] - bbox[0]) * max(0, bbox[3] - bbox[1])
+            _spend(STUB_OCR_SEC_PER_MEGAPIXEL * area / 1e6 + STUB_OCR_SEC_PER_LINE * len(lines))
+            yield region_idx, lines
+
+    def detect_and_recognize_many(self, jobs: list) -> list:
+        return [self.detect_and_recognize(image, bbox_list) for image, bbox_list in jobs]
+
+    def recognize_line_regions(self, image, bbox_list: list) -> list:
+        _spend(STUB_OCR_SEC_PER_LINE * len(bbox_list))
+        return [[{
+            "id": f"l{ii:04d}",
+            "polygon": np.array([[tlx, tly], [blx, tly], [blx, bly], [tlx, bly]], dtype=np.float64),
+            "transcription": f"Stub line {ii}",
+            "transcription_confidence": 0.9,
+        }] for ii, (tlx, tly, blx, bly) in enumerate(bbox_list)]
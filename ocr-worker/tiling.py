@@ -0,0 +1,160 @@
+"""
+Splitting of large regions into overlapping tiles, and merging of the lines found in each tile.
+
+A full newspaper page processed as a single region takes a long time on a single worker.
+Large regions are instead split into a grid of tiles which overlap by `overlap` pixels,
+so that each line shorter than the overlap is seen whole in at least one tile, and tiles
+are transcribed in parallel (see `run_ocr_tiled` in worker.py).
+
+Lines in the overlaps are found in several tiles, whole or truncated at a tile border.
+Lines of different tiles which overlap on the same text row are grouped, then each group
+gives a single line:
+- a line contained in another one (a duplicate, or a truncated copy) is dropped in favor of
+  the larger one,
+- lines which extend each other (a line longer than the overlap, cut at a tile border) are
+  joined: their polygons are merged, and the text of the overlap is kept only once.
+"""
+
+from difflib import SequenceMatcher
+from typing import List
+
+import cv2
+import numpy as np
+
+# Min vertical overlap of two lines, relative to the height of the smallest one, to be on the same text row
+_SAME_ROW_MIN_OVERLAP = 0.5
+# Tolerance (pixels) when testing whether a line contains another one horizontally
+_CONTAINMENT_TOLERANCE = 4
+# Min length of the common text of two joined lines to align them on it
+_MIN_COMMON_TEXT = 2
+
+
+def _tile_starts(start: int, end: int, tile_size: int, overlap: int) -> list:
+    """Start coordinates of the tiles covering [start, end) on one axis, evenly spread."""
+    length = end - start
+    if length <= tile_size:
+        return [start]
+    count = int(np.ceil((length - overlap) / (tile_size - overlap)))
+    step = (length - tile_size) / (count - 1)
+    return [start + int(round(tile_idx * step)) for tile_idx in range(count)]
+
+
+def split_region(bbox: tuple, tile_size: int, overlap: int) -> list:
+    """Splits a region into tiles of at most `tile_size` pixels wide and high, overlapping by at least `overlap` pixels.
+
+    Args:
+        bbox (tuple of int): `(xtl, ytl, xbr, ybr)` of the region.
+
+    Returns:
+        list of tuples: `(xtl, ytl, xbr, ybr)` of the tiles, row by row; `[bbox]` if the region fits in a tile.
+    """
+    if not 0 <= overlap < tile_size:
+        raise ValueError(f"Tile overlap ({overlap}) must be positive and smaller than the tile size ({tile_size}).")
+    xtl, ytl, xbr, ybr = bbox
+    return [
+        (x, y, min(x + tile_size, xbr), min(y + tile_size, ybr))
+        for y in _tile_starts(ytl, ybr, tile_size, overlap)
+        for x in _tile_starts(xtl, xbr, tile_size, overlap)
+    ]
+
+
+def _join_transcriptions(left: str, right: str, right_overlap_ratio: float) -> str:
+    """Joins the texts of two parts of a line, keeping the text of their overlap once.
+
+    `right_overlap_ratio` is the share of the right part which overlaps the left part: the common
+    text is searched in the matching ends of both texts, or estimated from it if it is not found.
+    """
+    overlap_length = int(round(right_overlap_ratio * len(right)))
+    window = overlap_length + _MIN_COMMON_TEXT
+    left_start = max(0, len(left) - window)
+    match = SequenceMatcher(None, left[left_start:], right[:window], autojunk=False).find_longest_match(
+        0, len(left) - left_start, 0, min(window, len(right)))
+    if match.size >= _MIN_COMMON_TEXT:
+        return left[:left_start + match.a + match.size] + right[match.b + match.size:]
+    return left + right[overlap_length:]
+
+
+class _TileLine:
+    def __init__(self, tile_idx: int, line: dict):
+        self.tile_idx = tile_idx
+        self.line = line
+        self.points = np.asarray(line["polygon"], dtype=np.float64).reshape(-1, 2)
+        self.x0, self.y0 = self.points.min(axis=0)
+        self.x1, self.y1 = self.points.max(axis=0)
+
+    def area(self) -> float:
+        return (self.x1 - self.x0) * (self.y1 - self.y0)
+
+    def contains(self, other: "_TileLine") -> bool:
+        return self.x0 - _CONTAINMENT_TOLERANCE <= other.x0 and other.x1 <= self.x1 + _CONTAINMENT_TOLERANCE
+
+    def join(self, right: "_TileLine") -> "_TileLine":
+        """Joins this line with a line which extends it to the right."""
+        right_overlap_ratio = min(1., max(0., self.x1 - right.x0) / max(right.x1 - right.x0, 1.))
+        left_text, right_text = self.line["transcription"], right.line["transcription"]
+        points = np.concatenate([self.points, right.points]).astype(np.float32)
+        weights = [max(len(left_text), 1), max(len(right_text), 1)]
+        return _TileLine(self.tile_idx, {
+            **self.line,
+            "polygon": cv2.convexHull(points).reshape(-1, 2).astype(np.float64),
+            "transcription": _join_transcriptions(left_text, right_text, right_overlap_ratio),
+            "transcription_confidence": float(np.average(
+                [self.line["transcription_confidence"], right.line["transcription_confidence"]], weights=weights)),
+        })
+
+
+def _same_row_groups(lines: List[_TileLine]) -> list:
+    """Groups lines of different tiles which overlap on the same text row (indices, in order of first line)."""
+    boxes = np.array([[line.x0, line.y0, line.x1, line.y1] for line in lines]).reshape(-1, 4)
+    tiles = np.array([line.tile_idx for line in lines])
+    x_overlap = np.minimum(boxes[:, None, 2], boxes[None, :, 2]) - np.maximum(boxes[:, None, 0], boxes[None, :, 0])
+    y_overlap = np.minimum(boxes[:, None, 3], boxes[None, :, 3]) - np.maximum(boxes[:, None, 1], boxes[None, :, 1])
+    heights = boxes[:, 3] - boxes[:, 1]
+    min_heights = np.minimum(heights[:, None], heights[None, :])
+    linked = (x_overlap > 0) & (y_overlap >= _SAME_ROW_MIN_OVERLAP * min_heights) & (tiles[:, None] != tiles[None, :])
+
+    # Connected components (union-find)
+    parents = list(range(len(lines)))
+    def find(idx):
+        while parents[idx] != idx:
+            parents[idx] = parents[parents[idx]]
+            idx = parents[idx]
+        return idx
+    for idx_a, idx_b in zip(*np.nonzero(np.triu(linked))):
+        parents[find(idx_a)] = find(idx_b)
+    groups = {}
+    for idx in range(len(lines)):
+        groups.setdefault(find(idx), []).append(idx)
+    return sorted(groups.values(), key=lambda group: group[0])
+
+
+def merge_tile_lines(tile_lines: list) -> list:
+    """Merges the lines found in the tiles of a region into the lines of the region.
+
+    Args:
+        tile_lines (list of list of dict): lines of each tile (as returned by
+            `PERO_driver.detect_and_recognize` for the tile), in full image coordinates.
+
+    Returns:
+        list of dict: lines of the region (`id`, `polygon` as a numpy array, `transcription`,
+            `transcription_confidence`), in the order of the tiles then of the lines in each tile.
+            Ids are prefixed with the index of the tile the line comes from, to keep them unique.
+    """
+    lines = [_TileLine(tile_idx, line) for tile_idx, lines in enumerate(tile_lines) for line in lines]
+    if not lines:
+        return []
+    merged = []
+    for group in _same_row_groups(lines):
+        group_lines = sorted((lines[idx] for idx in group), key=lambda line: line.x0)
+        result = group_lines[0]
+        for line in group_lines[1:]:
+            if result.contains(line) or line.contains(result):
+                result = max(result, line, key=_TileLine.area)
+            else:
+                result = result.join(line)
+        merged.append({
+            **result.line,
+            "id": f"t{result.tile_idx:03d}-{result.line['id']}",
+            "polygon": result.points,
+        })
+    return merged
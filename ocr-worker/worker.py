@@ -1,13 +1,23 @@
 import os
 import json
+import shutil
+import threading
+import time
+from contextlib import ExitStack
 
 
-from celery import Celery
+from celery import Celery, chord, group, states
+from celery.signals import task_postrun, task_prerun, worker_init, worker_process_init, worker_ready, worker_shutdown
 import cv2
-import requests
 import numpy as np
 
-from pero_ocr_driver import PERO_driver
+from compact_result import RESULT_FORMATS, pack_ocr_result
+from iiif import IIIFImageUrl, ImageWindow
+from image_cache import DecodedImageCache
+from image_fetcher import ImageFetcher, ImageFetchError
+from tiling import merge_tile_lines, split_region
+import metrics
+import tracing
 
 # FIXME use pydantic and make sure we have type declarations compatible with Python 3.9
 # class ImageRegion(BaseModel):
@@ -39,78 +49,355 @@ CELERY_RESULT_BACKEND = os.environ["CELERY_RESULT_BACKEND"]  # 'rpc://'
 
 VALID_IMAGE_TYPES = ['image/jpeg', 'image/jpg', 'image/png', 'image/webp']
 
+# OCR modes: "block" detects lines in each region then transcribes them,
+# "line" directly transcribes each region as a single line (no layout analysis)
+OCR_MODES = ("block", "line")
+
+# Custom task state used to stream page results of `run_ocr_batch`
+PAGE_DONE_STATE = "PAGE_DONE"
+# Custom task state used to stream region results of `run_ocr_stream`
+REGION_DONE_STATE = "REGION_DONE"
+
+# OCR engine: "pero", or "stub" for benchmarks without models (see stub_ocr_driver.py)
+OCR_ENGINE = os.environ.get("OCR_ENGINE", "pero")
+if OCR_ENGINE == "stub":
+    from stub_ocr_driver import StubOCRDriver as PERO_driver
+    from stub_ocr_driver import available_cpu_count, preload_page_parser, set_inference_threads
+    OCR_ENGINE_NAME = "Stub OCR"
+else:
+    from pero_ocr_driver import PERO_driver, available_cpu_count, preload_page_parser, set_inference_threads
+    OCR_ENGINE_NAME = "PERO OCR"
+
 # PERO configuration
 PERO_CONFIG_DIR = os.environ["PERO_CONFIG_DIR"]
 PERO_MODEL_VERSION = os.path.basename(PERO_CONFIG_DIR)
 PERO_CODE_VERSION = "https://github.com/DCGM/pero-ocr?rev=57c07b1d192859bc4ec71859769d4f624c50dbfc"
+# Recognize the lines of all the regions of a page in a single batch
+PERO_BATCH_LINES = os.environ.get("PERO_BATCH_LINES", "False") in ["True", "true", "1"]
+# Number of pages of a `run_ocr_batch` task whose lines are recognized in a single batch
+PERO_BATCH_PAGES = max(1, int(os.environ.get("PERO_BATCH_PAGES", 1)))
+# `run_ocr_tiled`: regions larger than this size (pixels) are split into tiles overlapping by this overlap
+OCR_TILE_SIZE = int(os.environ.get("OCR_TILE_SIZE", 2048))
+OCR_TILE_OVERLAP = int(os.environ.get("OCR_TILE_OVERLAP", 256))
+# Prefork pool (`-P prefork`): load PERO models in the parent process before it forks the pool
+# processes, which then share the model weights instead of loading one copy each
+PERO_PRELOAD_MODELS = os.environ.get("PERO_PRELOAD_MODELS", "False") in ["True", "true", "1"]
+# Inference threads of each pool process (0: available CPU cores divided by the number of pool processes)
+PERO_THREADS_PER_PROCESS = int(os.environ.get("PERO_THREADS_PER_PROCESS", 0))
+# Load models and run a first inference at startup, before consuming tasks
+PERO_WARM_UP = os.environ.get("PERO_WARM_UP", "True") in ["True", "true", "1"]
+
+# Readiness: this file is created once the models of all the processes are warm and the worker consumes tasks (empty: disabled)
+WORKER_READY_FILE = os.environ.get("WORKER_READY_FILE", "/tmp/ocr-worker-ready")
+# Set by startup.sh: start time of the container command (epoch seconds), and duration of model verification
+WORKER_STARTUP_STARTED_AT = float(os.environ.get("WORKER_STARTUP_STARTED_AT", time.time()))
+MODEL_VERIFICATION_SEC = float(os.environ["MODEL_VERIFICATION_SEC"]) if "MODEL_VERIFICATION_SEC" in os.environ else None
+
+# IIIF image URLs of full pages: only fetch the part of the page covering the regions, at this scale (see iiif.py).
+# Off by default: region URLs are cached per region, so they bypass the page cache (nginx and decoded images)
+IIIF_REGION_FETCH = os.environ.get("IIIF_REGION_FETCH", "False") in ["True", "true", "1"]
+IIIF_FETCH_SCALE = min(1.0, float(os.environ.get("IIIF_FETCH_SCALE", 1.0)))
+
+# Image downloads: pooled connections, bounded concurrency per host, max image size
+IMAGE_FETCHER = ImageFetcher(
+    timeout_sec=float(os.environ.get("IMAGE_FETCH_TIMEOUT_SEC", 10.0)),
+    max_connections_per_host=int(os.environ.get("IMAGE_FETCH_MAX_CONNECTIONS_PER_HOST", 4)),
+    max_bytes=int(os.environ.get("IMAGE_FETCH_MAX_BYTES", 100 * 1024 * 1024)),
+)
+
+# Decoded image cache, shared by the worker processes of a node (disabled if max size is 0)
+IMAGE_CACHE_DIR = os.environ.get("IMAGE_CACHE_DIR", "/dev/shm/mezanno-image-cache")
+IMAGE_CACHE_MAX_BYTES = int(os.environ.get("IMAGE_CACHE_MAX_BYTES", 0))
+IMAGE_CACHE_URL_TTL_SEC = float(os.environ.get("IMAGE_CACHE_URL_TTL_SEC", 3600))
+IMAGE_CACHE = DecodedImageCache(IMAGE_CACHE_DIR, IMAGE_CACHE_MAX_BYTES, url_ttl_sec=IMAGE_CACHE_URL_TTL_SEC) if IMAGE_CACHE_MAX_BYTES > 0 else None
+
+# Spans are exported as configured by TRACING_EXPORTER (see tracing.py)
+tracing.configure("ocr-worker")
+
+# Prometheus metrics are served on http://0.0.0.0:METRICS_PORT/metrics (0 disables them, see metrics.py).
+# In prefork mode, pool processes write their metrics to WORKER_METRICS_DIR, and the parent process serves them all.
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 9100))
+WORKER_METRICS_DIR = os.environ.get("WORKER_METRICS_DIR", "/dev/shm/mezanno-metrics")
+metrics.observe_spans()
+TASKS_IN_FLIGHT = metrics.Gauge("mezanno_ocr_worker_tasks_in_flight", "Tasks being run, by task name.", ["task"])
+TASKS = metrics.Counter("mezanno_ocr_worker_tasks_total", "Finished tasks, by task name and final state.", ["task", "state"])
+MODEL_LOAD_SECONDS = metrics.Gauge("mezanno_ocr_worker_model_load_seconds",
+                                   "Time to load (and warm up) the OCR models, slowest process.", merge="max")
+STARTUP_SECONDS = metrics.Gauge("mezanno_ocr_worker_startup_seconds",
+                                "Time from the start of the container until the worker is ready.", merge="max")
+IMAGE_CACHE_LOOKUPS = metrics.Counter("mezanno_ocr_worker_image_cache_lookups_total",
+                                      "Lookups of the decoded image cache, by result ('url_hit', 'hit' or 'miss').", ["result"])
+DECODED_MEGAPIXELS = metrics.Histogram("mezanno_ocr_worker_decoded_image_megapixels", "Size of decoded images, in megapixels.",
+                                       buckets=(0.25, 0.5, 1., 2., 4., 8., 16., 32., 64.))
+OCR_LINES = metrics.Counter("mezanno_ocr_worker_lines_total", "Transcribed lines, by OCR mode.", ["mode"])
+OCR_SECONDS = metrics.Counter("mezanno_ocr_worker_ocr_seconds_total",
+                              "Time spent in the OCR engine, by OCR mode (lines per second: rate of lines / rate of seconds).",
+                              ["mode"])
 
 # Initialize Celery
 celery = Celery("worker", broker=CELERY_BROKER_URL, backend=CELERY_RESULT_BACKEND) # 'ocr_worker', 
 celery.config_from_object('celeryconfig')
 
-# Define our OCR task
-@celery.task()
-def run_ocr(image_url: str, image_regions: dict) -> dict:
-    print(f"Processing image: {image_url}")
+# Number of pool processes, set in the parent process (and inherited by the forked ones)
+_pool_process_count = 1
+# Prefork pool with warm-up: the worker is only ready once every pool process is warm
+_wait_for_pool_warm_up = False
+# Each warm pool process writes its model load duration to a file named after its pid in this directory
+WORKER_WARM_PROCESSES_DIR = f"{WORKER_READY_FILE}.processes" if WORKER_READY_FILE else ""
+# Startup durations (seconds), reported when the worker is ready
+_startup_stats = {}
+# Span (and timings collection) of each running task, by task id
+_task_spans = {}
+
+
+def _is_prefork_pool(pool_cls) -> bool:
+    if isinstance(pool_cls, str):
+        return pool_cls in ("prefork", "processes")
+    return "prefork" in getattr(pool_cls, "__module__", "")
+
+
+def _warm_up_models() -> float:
+    """Loads PERO models in this process and runs a first inference, returning its duration."""
+    start = time.perf_counter()
+    warm_up_sec = PERO_driver(PERO_CONFIG_DIR, batch_lines=PERO_BATCH_LINES).warm_up()
+    print(f"PERO models of process {os.getpid()} loaded and warmed up in {time.perf_counter() - start:.1f} s"
+          f" (warm-up inference: {warm_up_sec:.1f} s).")
+    return time.perf_counter() - start
+
+
+@worker_init.connect
+def _preload_models(sender=None, **kwargs):
+    """Runs in the parent process of the worker, before the pool starts and before any task is consumed."""
+    global _pool_process_count, _wait_for_pool_warm_up
+    _pool_process_count = max(1, int(getattr(sender, "concurrency", None) or 1))
+    if _is_prefork_pool(getattr(sender, "pool_cls", None)):
+        # No inference before forking: pool processes warm up in `_configure_pool_process`
+        _wait_for_pool_warm_up = PERO_WARM_UP and bool(WORKER_WARM_PROCESSES_DIR)
+        if _wait_for_pool_warm_up:
+            # Markers of the pool processes of a previous run
+            shutil.rmtree(WORKER_WARM_PROCESSES_DIR, ignore_errors=True)
+            os.makedirs(WORKER_WARM_PROCESSES_DIR)
+        if PERO_PRELOAD_MODELS:
+            print(f"Preloading PERO models from {PERO_CONFIG_DIR} before starting {_pool_process_count} pool processes.")
+            start = time.perf_counter()
+            preload_page_parser(PERO_CONFIG_DIR)
+            _startup_stats["model_load_sec"] = time.perf_counter() - start
+    elif PERO_WARM_UP:
+        # Tasks run in this process: the consumer starts once models are ready
+        _startup_stats["model_load_sec"] = _warm_up_models()
+    if "model_load_sec" in _startup_stats:
+        MODEL_LOAD_SECONDS.set(_startup_stats["model_load_sec"])
+    if METRICS_PORT > 0:
+        # Snapshots of the pool processes of a previous run
+        shutil.rmtree(WORKER_METRICS_DIR, ignore_errors=True)
+        metrics.start_http_server(METRICS_PORT, snapshot_dir=WORKER_METRICS_DIR)
+
+
+@worker_process_init.connect
+def _configure_pool_process(**kwargs):
+    """Runs in each process of a prefork pool, after it is forked and before it accepts tasks."""
+    thread_count = PERO_THREADS_PER_PROCESS or max(1, available_cpu_count() // _pool_process_count)
+    set_inference_threads(thread_count)
+    print(f"Pool process {os.getpid()} uses {thread_count} inference threads.")
+    # The exporter thread of the parent process does not survive the fork
+    tracing.configure("ocr-worker")
+    if METRICS_PORT > 0:
+        # Served by the parent process
+        metrics.start_snapshot_writer(WORKER_METRICS_DIR)
+    if PERO_WARM_UP:
+        model_load_sec = _warm_up_models()
+        MODEL_LOAD_SECONDS.set(model_load_sec)
+        if _wait_for_pool_warm_up:
+            with open(os.path.join(WORKER_WARM_PROCESSES_DIR, str(os.getpid())), "w") as f:
+                f.write(str(model_load_sec))
+
+
+def _is_running(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _warm_pool_processes() -> dict:
+    """Model load durations (seconds) of the running pool processes which are warm, by pid."""
+    load_secs = {}
+    for name in os.listdir(WORKER_WARM_PROCESSES_DIR):
+        try:
+            with open(os.path.join(WORKER_WARM_PROCESSES_DIR, name)) as f:
+                load_sec = float(f.read())
+        except (OSError, ValueError):
+            # Being written
+            continue
+        if _is_running(int(name)):
+            load_secs[int(name)] = load_sec
+    return load_secs
+
+
+def _mark_ready_when_pool_is_warm(poll_interval_sec: float = 0.5):
+    """Waits until every pool process is warm (see `_configure_pool_process`), then marks the worker as ready."""
+    while True:
+        load_secs = _warm_pool_processes()
+        if len(load_secs) >= _pool_process_count:
+            break
+        time.sleep(poll_interval_sec)
+    # The slowest process, after the preloading of the parent process if any
+    _startup_stats["model_load_sec"] = _startup_stats.get("model_load_sec", 0.) + max(load_secs.values())
+    _write_ready_file()
+
+
+@worker_ready.connect
+def _mark_ready(**kwargs):
+    """Marks the worker as ready once it consumes tasks (see `_write_ready_file`).
 
+    With a prefork pool warming up its processes, the consumer starts before they are warm:
+    the readiness file is then created once all of them are.
+    """
+    if _wait_for_pool_warm_up:
+        print(f"Worker consuming tasks, waiting for the warm-up of {_pool_process_count} pool processes.")
+        threading.Thread(target=_mark_ready_when_pool_is_warm, name="pool-warm-up", daemon=True).start()
+        return
+    _write_ready_file()
+
+
+def _write_ready_file():
+    """Reports startup durations, and creates the readiness file with them."""
+    _startup_stats["startup_sec"] = time.time() - WORKER_STARTUP_STARTED_AT
+    STARTUP_SECONDS.set(_startup_stats["startup_sec"])
+    if MODEL_VERIFICATION_SEC is not None:
+        _startup_stats["model_verification_sec"] = MODEL_VERIFICATION_SEC
+    print(f"Worker ready, startup stats: {json.dumps(_startup_stats)}")
+    if WORKER_READY_FILE:
+        with open(WORKER_READY_FILE, "w") as f:
+            json.dump(_startup_stats, f)
+
+
+@worker_shutdown.connect
+def _unmark_ready(**kwargs):
+    if WORKER_READY_FILE and os.path.exists(WORKER_READY_FILE):
+        os.remove(WORKER_READY_FILE)
+    if _wait_for_pool_warm_up:
+        shutil.rmtree(WORKER_WARM_PROCESSES_DIR, ignore_errors=True)
+
+
+@task_prerun.connect
+def _start_task_span(task_id=None, task=None, **kwargs):
+    """Traces a task as a child of the span which sent it (see `tracing.task_headers`), with its wait in the queue."""
+    traceparent = task.request.get(tracing.TRACEPARENT_HEADER)
+    sent_at = task.request.get(tracing.SENT_AT_HEADER)
+    stack = ExitStack()
+    if task.request.get(tracing.COLLECT_TIMINGS_HEADER):
+        # Returned with the result (see `_format_ocr_result`)
+        stack.enter_context(tracing.collect_timings())
+    if sent_at is not None:
+        with tracing.span("worker.queue_wait", traceparent=traceparent, start_time=float(sent_at)):
+            pass
+    span = stack.enter_context(tracing.span(f"worker.{task.name.rsplit('.', 1)[-1]}", traceparent=traceparent,
+                                            task_id=task_id, pid=os.getpid()))
+    _task_spans[task_id] = (stack, span)
+    TASKS_IN_FLIGHT.inc(task=task.name)
+
+
+@task_postrun.connect
+def _end_task_span(task_id=None, task=None, state=None, **kwargs):
+    TASKS_IN_FLIGHT.dec(task=task.name)
+    TASKS.inc(task=task.name, state=state)
+    stack, span = _task_spans.pop(task_id, (None, None))
+    if stack is not None:
+        if state == states.FAILURE:
+            span.error = state
+        stack.close()
+
+
+def _regions_to_bboxes(image_regions: list) -> list:
+    """Converts a list of `ImageRegion` dicts to a list of (xtl, ytl, xbr, ybr) integer tuples."""
     bboxes_xyxy = []
     for region in image_regions:
         # Convert the region to a tuple of integers
         bbox = tuple(map(lambda x: max(0, int(x)), [region[key] for key in ["xtl", "ytl", "xbr", "ybr"]]))
         bboxes_xyxy.append(bbox)
     # bboxes_xyxy = [(0, 0, 100, 100), (200, 200, 300, 300)]
+    return bboxes_xyxy
 
 
+def _download_image(image_url: str):
+    """Downloads and decodes an image.
 
-    # use requests to download the image synchronously
-    r = requests.get(image_url, timeout=10.0)
-    if r.status_code != 200:
-        return {"error": "Cannot download image."}
+    Decoded images are looked up in (and added to) the image cache of the node, if enabled.
+
+    Returns:
+        tuple: `(image, None)` with an RGB numpy array on success, `(None, error_message)` otherwise.
+    """
+    if IMAGE_CACHE is not None:
+        image_numpy = IMAGE_CACHE.get_by_url(image_url)
+        if image_numpy is not None:
+            print(f"Image cache: URL hit for {image_url}.")
+            IMAGE_CACHE_LOOKUPS.inc(result="url_hit")
+            return image_numpy, None
+
+    # download the image synchronously, reusing pooled connections
+    try:
+        with tracing.span("worker.download_image", url=image_url):
+            r = IMAGE_FETCHER.fetch(image_url)
+    except ImageFetchError as e:
+        print(f"Cannot download image {image_url}: {e}")
+        return None, "Cannot download image."
     image_data = r.content
 
     # Check if the image data is None
     # or if the content type is not image/jpg
-    if r.headers.get('Content-Type') not in VALID_IMAGE_TYPES:
-        return {"error": "Request does not contain a valid image. Valid types are: " + ", ".join(VALID_IMAGE_TYPES)}
+    if r.content_type not in VALID_IMAGE_TYPES:
+        return None, "Request does not contain a valid image. Valid types are: " + ", ".join(VALID_IMAGE_TYPES)
     if image_data is None:
-        return {"error": "Request contains no image data."}
-    
-    # Read the image data into a numpy array using OpenCV
-    # Beware of channels order
-    image_numpy = cv2.imdecode(np.frombuffer(image_data, np.uint8), cv2.IMREAD_COLOR)
-    if image_numpy is None:
-        return {"error": "Cannot open image."}
-    # Convert the image to RGB format
-    image_numpy = cv2.cvtColor(image_numpy, cv2.COLOR_BGR2RGB)
+        return None, "Request contains no image data."
 
+    if IMAGE_CACHE is not None:
+        content_hash = IMAGE_CACHE.content_hash(image_data)
+        image_numpy = IMAGE_CACHE.get(content_hash, url=image_url)
+        if image_numpy is not None:
+            print(f"Image cache: content hit for {image_url}.")
+            IMAGE_CACHE_LOOKUPS.inc(result="hit")
+            return image_numpy, None
+    
+    with tracing.span("worker.decode_image", bytes=len(image_data)):
+        # Read the image data into a numpy array using OpenCV
+        # Beware of channels order
+        image_numpy = cv2.imdecode(np.frombuffer(image_data, np.uint8), cv2.IMREAD_COLOR)
+        if image_numpy is None:
+            return None, "Cannot open image."
+        # Convert the image to RGB format
+        image_numpy = cv2.cvtColor(image_numpy, cv2.COLOR_BGR2RGB)
+    DECODED_MEGAPIXELS.observe(image_numpy.shape[0] * image_numpy.shape[1] / 1e6)
 
-    # We expect image/jpg Content type
-    if image_data is None:
-        return {"error": "Request contains no image data."}
+    if IMAGE_CACHE is not None:
+        IMAGE_CACHE_LOOKUPS.inc(result="miss")
+        image_numpy = IMAGE_CACHE.put(content_hash, image_numpy, url=image_url)
+        print(f"Image cache: miss for {image_url}, stats: {IMAGE_CACHE.counters}.")
+    return image_numpy, None
 
-    # Fake response to test
-    # return {
-    #     "image_url": image_url,
-    #     "image_regions": image_regions,
-    #     "image_shape": image_numpy.shape,
-    # }
 
-    # if the bboxes are empty, generate one with the full image
-    if len(bboxes_xyxy) == 0:
-        bboxes_xyxy = [(0, 0, image_numpy.shape[1], image_numpy.shape[0])]
+def _format_ocr_result(bboxes_xyxy: list, ocr_results: list, result_format: str = "json", mode: str = "block"):
+    """Builds the result of a page from the lines of its regions.
 
+    When the task was sent with `tracing.COLLECT_TIMINGS_HEADER`, the result has a `"timings"`
+    field with the duration (seconds) of the stages run so far, by span name.
 
-    # Run the OCR engine
-    print("Calling OCR engine...")
-    ocr_engine = PERO_driver(PERO_CONFIG_DIR)
-    ocr_results = ocr_engine.detect_and_recognize(image_numpy, bboxes_xyxy)
-    # ocr_results = "\n".join([textline.transcription for textline in ocr_results])
-    return {
+    Returns:
+        dict or bytes: the result as a JSON-serializable dict, or packed with
+            `compact_result.pack_ocr_result` if `result_format` is "msgpack".
+    """
+    if result_format == "json":
+        ocr_results = [[{**line, "polygon": line["polygon"].tolist()} for line in lines] for lines in ocr_results]
+    result = {
         "ocr_engine": {
-            "name": "PERO OCR",
+            "name": OCR_ENGINE_NAME,
             "code_version": PERO_CODE_VERSION,
             "model_version": PERO_MODEL_VERSION,
         },
+        "mode": mode,
         "transcriptions": [
             {
                 "region": region,
@@ -118,3 +405,297 @@ def run_ocr(image_url: str, image_regions: dict) -> dict:
             } for region, lines in zip(bboxes_xyxy, ocr_results)
         ]
     }
+    timings = tracing.current_timings()
+    if timings is not None:
+        result["timings"] = timings
+    if result_format == "msgpack":
+        return pack_ocr_result(result)
+    return result
+
+
+def _check_result_format(result_format: str):
+    if result_format not in RESULT_FORMATS:
+        raise ValueError(f"Invalid result format {result_format!r}, valid formats are: {', '.join(RESULT_FORMATS)}")
+
+
+def _check_mode(mode: str):
+    if mode not in OCR_MODES:
+        raise ValueError(f"Invalid OCR mode {mode!r}, valid modes are: {', '.join(OCR_MODES)}")
+
+
+def _window_url(image_url: str, bboxes_xyxy: list) -> tuple:
+    """URL of the part of the page needed for `bboxes_xyxy` (all the page if empty), and its `ImageWindow`."""
+    iiif_url = IIIFImageUrl.parse(image_url) if IIIF_REGION_FETCH else None
+    if iiif_url is None or not iiif_url.is_full_page():
+        return image_url, ImageWindow()
+    valid_bboxes = [bbox for bbox in bboxes_xyxy if bbox[0] < bbox[2] and bbox[1] < bbox[3]]
+    if not valid_bboxes:
+        if IIIF_FETCH_SCALE >= 1:
+            return image_url, ImageWindow()
+        return iiif_url.window_url(None, IIIF_FETCH_SCALE)
+    # A single request for the bounding box of all the regions
+    union = (min(bbox[0] for bbox in valid_bboxes), min(bbox[1] for bbox in valid_bboxes),
+             max(bbox[2] for bbox in valid_bboxes), max(bbox[3] for bbox in valid_bboxes))
+    return iiif_url.window_url(union, IIIF_FETCH_SCALE)
+
+
+def _prepare_page(page: dict) -> tuple:
+    """Downloads the image of a page and converts its regions (the full page if there is none).
+
+    For IIIF image URLs of full pages, only the part of the page covering the regions is
+    fetched, at `IIIF_FETCH_SCALE`; the whole page is fetched if the server rejects it.
+
+    Returns:
+        tuple: `(image, bboxes, window, None)` on success, with `bboxes` in page coordinates and
+            `window` mapping coordinates of `image` to the page (see `_to_image_bboxes` and
+            `_to_page_lines`); `(None, None, None, error_message)` otherwise.
+    """
+    bboxes_xyxy = _regions_to_bboxes(page.get("regions", []))
+
+    image_url, window = _window_url(page["image_url"], bboxes_xyxy)
+    image_numpy, error = _download_image(image_url)
+    if error is not None and image_url != page["image_url"]:
+        print(f"Cannot fetch part of the page {image_url} ({error}), fetching the whole page.")
+        image_url, window = page["image_url"], ImageWindow()
+        image_numpy, error = _download_image(image_url)
+    if error is not None:
+        return None, None, None, error
+
+    # if the bboxes are empty, generate one with the full image
+    if len(bboxes_xyxy) == 0:
+        bboxes_xyxy = [(0, 0, int(round(image_numpy.shape[1] / window.scale)), int(round(image_numpy.shape[0] / window.scale)))]
+    return image_numpy, bboxes_xyxy, window, None
+
+
+def _to_image_bboxes(window: ImageWindow, bboxes_xyxy: list) -> list:
+    """Converts page bboxes to coordinates of the image fetched by `_prepare_page`."""
+    if window.is_identity():
+        return bboxes_xyxy
+    return [window.to_image_bbox(bbox) for bbox in bboxes_xyxy]
+
+
+def _to_page_lines(window: ImageWindow, ocr_results: list) -> list:
+    """Converts the line polygons of each region from image to page coordinates."""
+    if window.is_identity():
+        return ocr_results
+    return [
+        [{**line, "polygon": window.to_page_points(np.asarray(line["polygon"], dtype=np.float64))} for line in lines]
+        for lines in ocr_results
+    ]
+
+
+def _count_lines(ocr_results_list: list, ocr_span: tracing.Span, mode: str = "block") -> None:
+    """Counts the lines of OCR results (lines of each region of each page) and the time spent in `ocr_span`."""
+    OCR_LINES.inc(sum(len(lines) for ocr_results in ocr_results_list for lines in ocr_results), mode=mode)
+    OCR_SECONDS.inc(ocr_span.duration_sec, mode=mode)
+
+
+def _ocr_pages(ocr_engine: PERO_driver, pages: list, result_format: str = "json", mode: str = "block") -> list:
+    """Downloads pages and transcribes their regions (or the full page if there is none).
+
+    When several pages are given, the lines of all of them are recognized in a single batch
+    (see `PERO_driver.detect_and_recognize_many`).
+
+    Args:
+        pages (list of dict): each page is `{"image_url": str, "regions": list of ImageRegion dicts}`.
+        result_format (str): format of page results (see `_format_ocr_result`).
+        mode (str): "block", or "line" to transcribe each region as a single line with
+            `PERO_driver.recognize_line_regions` (one page at a time).
+
+    Returns:
+        list: the result (or `{"error": str}`) of each page.
+    """
+    page_results = [None] * len(pages)
+    jobs = []  # (page index, image, bboxes)
+    for page_index, page in enumerate(pages):
+        image_numpy, bboxes_xyxy, window, error = _prepare_page(page)
+        if error is not None:
+            page_results[page_index] = {"error": error}
+            continue
+        jobs.append((page_index, image_numpy, bboxes_xyxy, window))
+    if not jobs:
+        # No page could be downloaded
+        return page_results
+
+    # Run the OCR engine
+    print("Calling OCR engine...")
+    image_jobs = [(image_numpy, _to_image_bboxes(window, bboxes_xyxy)) for (_, image_numpy, bboxes_xyxy, window) in jobs]
+    with tracing.span("worker.ocr", pages=len(image_jobs), mode=mode) as ocr_span:
+        if mode == "line":
+            ocr_results_list = [ocr_engine.recognize_line_regions(image_numpy, image_bboxes) for (image_numpy, image_bboxes) in image_jobs]
+        elif len(jobs) == 1:
+            (image_numpy, image_bboxes), = image_jobs
+            ocr_results_list = [ocr_engine.detect_and_recognize(image_numpy, image_bboxes)]
+        else:
+            ocr_results_list = ocr_engine.detect_and_recognize_many(image_jobs)
+    _count_lines(ocr_results_list, ocr_span, mode)
+    # ocr_results = "\n".join([textline.transcription for textline in ocr_results])
+    for (page_index, _, bboxes_xyxy, window), ocr_results in zip(jobs, ocr_results_list):
+        page_results[page_index] = _format_ocr_result(bboxes_xyxy, _to_page_lines(window, ocr_results), result_format, mode)
+    return page_results
+
+
+# Define our OCR task
+# `result_format` is "json" (dict result) or "msgpack" (compact bytes result, see compact_result.py)
+# `mode` is "block" (detect lines in regions) or "line" (each region is a known line)
+@celery.task()
+def run_ocr(image_url: str, image_regions: dict, result_format: str = "json", mode: str = "block"):
+    print(f"Processing image: {image_url} ({mode} mode)")
+    _check_result_format(result_format)
+    _check_mode(mode)
+    ocr_engine = PERO_driver(PERO_CONFIG_DIR, batch_lines=PERO_BATCH_LINES)
+    return _ocr_pages(ocr_engine, [{"image_url": image_url, "regions": image_regions}], result_format, mode)[0]
+
+
+# Tiled OCR task: same result as `run_ocr` ("block" mode), but large regions are split into
+# overlapping tiles which several workers transcribe in parallel (a Celery chord).
+@celery.task(bind=True)
+def run_ocr_tiled(self, image_url: str, image_regions: list, result_format: str = "json",
+                  tile_size: int = OCR_TILE_SIZE, tile_overlap: int = OCR_TILE_OVERLAP):
+    """Transcribes a page, splitting its regions larger than `tile_size` into tiles (see tiling.py).
+
+    If no region needs to be split, the page is transcribed here, as by `run_ocr`. Otherwise this
+    task is replaced by a chord: one `run_ocr_tile` task per tile, sent to the queue of this task
+    with its priority, then `merge_ocr_tiles`, whose result is the result of this task (same task id).
+    The page is only fetched here when it is transcribed here, or when it has no region (to get its size).
+    Each tile task fetches its image: the whole page, usually from the decoded image cache of its node,
+    or only its tile with `IIIF_REGION_FETCH`.
+
+    Returns:
+        the page result (or `{"error": str}`), as `run_ocr`.
+    """
+    print(f"Processing image (tiled): {image_url}")
+    _check_result_format(result_format)
+    # Tiles of the given regions only need their bboxes
+    bboxes_xyxy = _regions_to_bboxes(image_regions)
+    region_tiles = [split_region(bbox, tile_size, tile_overlap) for bbox in bboxes_xyxy]
+    if all(len(tiles) == 1 for tiles in region_tiles):
+        image_numpy, bboxes_xyxy, window, error = _prepare_page({"image_url": image_url, "regions": image_regions})
+        if error is not None:
+            return {"error": error}
+        # Without regions, the full page region is only known now
+        region_tiles = [split_region(bbox, tile_size, tile_overlap) for bbox in bboxes_xyxy]
+        if all(len(tiles) == 1 for tiles in region_tiles):
+            ocr_engine = PERO_driver(PERO_CONFIG_DIR, batch_lines=PERO_BATCH_LINES)
+            with tracing.span("worker.ocr", pages=1, mode="block") as ocr_span:
+                ocr_results = ocr_engine.detect_and_recognize(image_numpy, _to_image_bboxes(window, bboxes_xyxy))
+            _count_lines([ocr_results], ocr_span)
+            return _format_ocr_result(bboxes_xyxy, _to_page_lines(window, ocr_results), result_format)
+
+    tiles = [tile for tiles in region_tiles for tile in tiles]
+    print(f"Splitting {len(bboxes_xyxy)} regions of {image_url} into {len(tiles)} tiles.")
+    delivery_info = self.request.delivery_info or {}
+    options = {key: value for key, value in (("queue", delivery_info.get("routing_key")),
+                                              ("priority", delivery_info.get("priority"))) if value is not None}
+    # Tile tasks are traced as children of this task
+    options["headers"] = tracing.task_headers()
+    tile_tasks = group(run_ocr_tile.s(image_url, tile).set(**options) for tile in tiles)
+    merge_task = merge_ocr_tiles.s(bboxes_xyxy, [len(tiles) for tiles in region_tiles], result_format).set(**options)
+    raise self.replace(chord(tile_tasks, merge_task))
+
+
+@celery.task()
+def run_ocr_tile(image_url: str, tile: list) -> list:
+    """Transcribes a tile of `run_ocr_tiled`, returning its lines (polygons as lists, in full image coordinates).
+
+    With IIIF image URLs, only the tile is fetched.
+    """
+    xtl, ytl, xbr, ybr = tile
+    image_numpy, bboxes_xyxy, window, error = _prepare_page(
+        {"image_url": image_url, "regions": [{"xtl": xtl, "ytl": ytl, "xbr": xbr, "ybr": ybr}]})
+    if error is not None:
+        raise ValueError(error)
+    ocr_engine = PERO_driver(PERO_CONFIG_DIR, batch_lines=PERO_BATCH_LINES)
+    with tracing.span("worker.ocr", pages=1, mode="block") as ocr_span:
+        ocr_results = ocr_engine.detect_and_recognize(image_numpy, _to_image_bboxes(window, bboxes_xyxy))
+    _count_lines([ocr_results], ocr_span)
+    lines, = _to_page_lines(window, ocr_results)
+    return [{**line, "polygon": line["polygon"].tolist()} for line in lines]
+
+
+@celery.task()
+def merge_ocr_tiles(tile_lines: list, bboxes_xyxy: list, region_tile_counts: list, result_format: str = "json"):
+    """Merges the lines of the tiles of each region (in the order of `run_ocr_tiled`) into a page result."""
+    ocr_results = []
+    tile_start = 0
+    for tile_count in region_tile_counts:
+        ocr_results.append(merge_tile_lines(tile_lines[tile_start:tile_start + tile_count]))
+        tile_start += tile_count
+    return _format_ocr_result([tuple(bbox) for bbox in bboxes_xyxy], ocr_results, result_format)
+
+
+# Streaming OCR task: same result as `run_ocr`, but each region result is
+# published as soon as it is ready using a custom task state.
+@celery.task(bind=True)
+def run_ocr_stream(self, image_url: str, image_regions: list, result_format: str = "json"):
+    """Transcribes a page region by region, publishing each region result as soon as it is ready.
+
+    Each region result is published with a `REGION_DONE` state whose meta is
+    `{"region_index": int, "result": page result holding this region only}`, in `result_format`.
+    Only the "block" mode is supported: "line" mode transcribes all lines in a few batches.
+
+    Returns:
+        the page result with all its regions (or `{"error": str}`), as `run_ocr`.
+    """
+    print(f"Processing image (streaming): {image_url}")
+    _check_result_format(result_format)
+    ocr_engine = PERO_driver(PERO_CONFIG_DIR, batch_lines=PERO_BATCH_LINES)
+    image_numpy, bboxes_xyxy, window, error = _prepare_page({"image_url": image_url, "regions": image_regions})
+    if error is not None:
+        return {"error": error}
+
+    ocr_results = []
+    with tracing.span("worker.ocr", pages=1, mode="block") as ocr_span:
+        for region_index, lines in ocr_engine.detect_and_recognize_iter(image_numpy, _to_image_bboxes(window, bboxes_xyxy)):
+            lines, = _to_page_lines(window, [lines])
+            ocr_results.append(lines)
+            region_result = _format_ocr_result([bboxes_xyxy[region_index]], [lines], result_format)
+            self.update_state(state=REGION_DONE_STATE, meta={"region_index": region_index, "result": region_result})
+    _count_lines([ocr_results], ocr_span)
+    return _format_ocr_result(bboxes_xyxy, ocr_results, result_format)
+
+
+# Multi-page OCR task: one message for many pages, each page result is
+# published as soon as it is ready using a custom task state.
+@celery.task(bind=True)
+def run_ocr_batch(self, pages: list, result_format: str = "json", mode: str = "block") -> dict:
+    """Transcribes a list of pages.
+
+    Args:
+        pages (list of dict): each page is `{"image_url": str, "regions": list of ImageRegion dicts}`.
+        result_format (str): "json" or "msgpack", format of the page results (see `run_ocr`).
+        mode (str): "block" or "line" (see `run_ocr`).
+
+    Each page result is published with a `PAGE_DONE` state whose meta is
+    `{"page_index": int, "image_url": str, "result": dict}` (or `"error": str` instead of `"result"`).
+    A failed page does not abort the batch.
+    Pages are processed in groups of `PERO_BATCH_PAGES` pages whose lines are recognized together:
+    larger groups give larger OCR batches, but results are published once per group.
+
+    Returns:
+        dict: summary with the number of pages and the indices of failed pages.
+    """
+    print(f"Processing batch of {len(pages)} pages.")
+    _check_result_format(result_format)
+    _check_mode(mode)
+    ocr_engine = PERO_driver(PERO_CONFIG_DIR, batch_lines=PERO_BATCH_LINES)
+    failed_pages = []
+    for group_start in range(0, len(pages), PERO_BATCH_PAGES):
+        page_group = pages[group_start:group_start + PERO_BATCH_PAGES]
+        print(f"Processing pages {group_start + 1}-{group_start + len(page_group)}/{len(pages)}: {[page['image_url'] for page in page_group]}")
+        try:
+            group_results = _ocr_pages(ocr_engine, page_group, result_format, mode)
+        except Exception as e:
+            group_results = [{"error": f"Cannot process page: {e!r}"}] * len(page_group)
+        for page_index, page, page_result in zip(range(group_start, group_start + len(page_group)), page_group, group_results):
+            page_meta = {"page_index": page_index, "image_url": page["image_url"]}
+            if isinstance(page_result, dict) and "error" in page_result:
+                failed_pages.append(page_index)
+                page_meta["error"] = page_result["error"]
+            else:
+                page_meta["result"] = page_result
+            self.update_state(state=PAGE_DONE_STATE, meta=page_meta)
+    return {
+        "page_count": len(pages),
+        "failed_pages": failed_pages,
+    }
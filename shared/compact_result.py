@@ -0,0 +1,117 @@
+"""
+Compact binary encoding of OCR results, as an alternative to JSON.
+
+A JSON OCR result is a tree of dicts (`{"ocr_engine", "mode", "transcriptions": [{"region",
+"lines": [{"id", "polygon", "transcription", "transcription_confidence"}]}]}`) whose
+polygon coordinates are re-encoded as text by every service they go through.
+The compact form stores the same content column by column in a msgpack map:
+numbers are raw little-endian buffers (float32 polygon points and confidences,
+int32 regions and offsets), and polygons of all the lines are concatenated, with
+offsets telling where each one starts.
+
+    {
+        "format": "mezanno-ocr-compact/1",
+        "ocr_engine": {"name": str, "code_version": str, "model_version": str},
+        "mode": "block" | "line",
+        "regions": int32 (R, 4),            # xtl, ytl, xbr, ybr of each region
+        "region_line_offsets": int32 (R + 1,),  # lines of region r: [offsets[r], offsets[r + 1])
+        "line_ids": [str] (L),
+        "transcriptions": [str] (L),
+        "confidences": float32 (L,),
+        "line_point_offsets": int32 (L + 1,),   # points of line l: [offsets[l], offsets[l + 1])
+        "points": float32 (P, 2),           # x, y of polygon points
+        "timings": {str: float},            # optional, duration (seconds) of each processing stage
+    }
+
+Clients decode it with any msgpack library and `numpy.frombuffer` (or with
+`unpack_ocr_result`, which rebuilds the JSON form).
+
+This file is copied into each service image (see the `shared` build context in
+`docker-compose.yml`); it must stay compatible with Python 3.9.
+"""
+
+from typing import Any
+
+import msgpack
+import numpy as np
+
+# Formats in which OCR results can be requested
+RESULT_FORMATS = ("json", "msgpack")
+
+COMPACT_FORMAT_VERSION = "mezanno-ocr-compact/1"
+
+# Decimals kept when decoding float32 values to JSON (which would otherwise show noise digits)
+_JSON_POINT_DECIMALS = 2
+_JSON_CONFIDENCE_DECIMALS = 4
+
+
+def _buffer(values: Any, dtype: str) -> bytes:
+    return np.ascontiguousarray(values, dtype=dtype).tobytes()
+
+
+def pack_ocr_result(result: dict) -> bytes:
+    """Encodes an OCR result to the compact form.
+
+    Args:
+        result (dict): OCR result in JSON form; line polygons may be lists or numpy arrays.
+
+    Returns:
+        bytes: msgpack-encoded compact result.
+    """
+    transcriptions = result["transcriptions"]
+    lines = [line for transcription in transcriptions for line in transcription["lines"]]
+    polygons = [np.asarray(line["polygon"], dtype=np.float32).reshape(-1, 2) for line in lines]
+    packed = {
+        "format": COMPACT_FORMAT_VERSION,
+        "ocr_engine": result["ocr_engine"],
+        "mode": result.get("mode", "block"),
+        "regions": _buffer([transcription["region"] for transcription in transcriptions], "<i4"),
+        "region_line_offsets": _buffer(np.cumsum([0] + [len(t["lines"]) for t in transcriptions]), "<i4"),
+        "line_ids": [line["id"] for line in lines],
+        "transcriptions": [line["transcription"] for line in lines],
+        "confidences": _buffer([line["transcription_confidence"] for line in lines], "<f4"),
+        "line_point_offsets": _buffer(np.cumsum([0] + [len(polygon) for polygon in polygons]), "<i4"),
+        "points": _buffer(np.concatenate(polygons) if polygons else np.zeros((0, 2)), "<f4"),
+    }
+    if "timings" in result:
+        packed["timings"] = result["timings"]
+    return msgpack.packb(packed, use_bin_type=True)
+
+
+def unpack_ocr_result(data: bytes) -> dict:
+    """Decodes a compact OCR result to its JSON form.
+
+    Raises:
+        ValueError: if `data` is not a compact OCR result.
+    """
+    packed = msgpack.unpackb(data, raw=False)
+    if not isinstance(packed, dict) or packed.get("format") != COMPACT_FORMAT_VERSION:
+        raise ValueError("Not a compact OCR result.")
+    regions = np.frombuffer(packed["regions"], dtype="<i4").reshape(-1, 4).tolist()
+    region_line_offsets = np.frombuffer(packed["region_line_offsets"], dtype="<i4").tolist()
+    confidences = np.frombuffer(packed["confidences"], dtype="<f4").astype(np.float64).round(_JSON_CONFIDENCE_DECIMALS).tolist()
+    line_point_offsets = np.frombuffer(packed["line_point_offsets"], dtype="<i4")
+    points = np.frombuffer(packed["points"], dtype="<f4").reshape(-1, 2).astype(np.float64).round(_JSON_POINT_DECIMALS)
+    polygons = [polygon.tolist() for polygon in np.split(points, line_point_offsets[1:-1])]
+    lines = [
+        {
+            "id": line_id,
+            "polygon": polygon,
+            "transcription": transcription,
+            "transcription_confidence": confidence,
+        } for line_id, polygon, transcription, confidence in zip(
+            packed["line_ids"], polygons, packed["transcriptions"], confidences)
+    ]
+    result = {
+        "ocr_engine": packed["ocr_engine"],
+        "mode": packed.get("mode", "block"),
+        "transcriptions": [
+            {
+                "region": region,
+                "lines": lines[start:end],
+            } for region, start, end in zip(regions, region_line_offsets[:-1], region_line_offsets[1:])
+        ],
+    }
+    if "timings" in packed:
+        result["timings"] = packed["timings"]
+    return result
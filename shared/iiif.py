@@ -0,0 +1,89 @@
+"""
+IIIF Image API URLs: requesting only the needed part of a page, at the needed resolution.
+
+Page images are usually requested as `{base}/{identifier}/full/max/0/default.jpg`, while
+OCR and layout requests often only need a few regions of the page. The IIIF Image API
+(https://iiif.io/api/image/3.0/#4-image-requests, also supported by version 2 servers)
+lets the server crop (`/x,y,w,h/`) and scale (`/pct:n/`) the image before sending it.
+
+`ImageWindow` maps coordinates between the page (as given by clients) and the fetched image.
+
+This file is copied into each service image (see the `shared` build context in
+`docker-compose.yml`); it must stay compatible with Python 3.9.
+"""
+
+import re
+from dataclasses import dataclass
+from typing import Optional, Sequence
+
+# {prefix}/{identifier}/{region}/{size}/{rotation}/{quality}.{format}
+_IIIF_URL_RE = re.compile(
+    r"^(?P<prefix>https?://.+/[^/]+)"
+    r"/(?P<region>full|square|\d+,\d+,\d+,\d+|pct:[\d.]+,[\d.]+,[\d.]+,[\d.]+)"
+    r"/(?P<size>full|\^?max|\^?\d*,\d*|\^?!\d+,\d+|\^?pct:[\d.]+)"
+    r"/(?P<rotation>!?\d+(?:\.\d+)?)"
+    r"/(?P<quality>default|color|gray|bitonal|native)\.(?P<format>\w+)$"
+)
+
+
+@dataclass(frozen=True)
+class ImageWindow:
+    """Part of a page held by an image: `page coordinates = (x, y) + image coordinates / scale`."""
+    x: int = 0
+    y: int = 0
+    scale: float = 1.0
+
+    def is_identity(self) -> bool:
+        return self.x == 0 and self.y == 0 and self.scale == 1.0
+
+    def to_image_bbox(self, bbox: Sequence[int]) -> tuple:
+        """Converts a `(xtl, ytl, xbr, ybr)` page bbox to integer image coordinates."""
+        xtl, ytl, xbr, ybr = bbox
+        return (int(round((xtl - self.x) * self.scale)), int(round((ytl - self.y) * self.scale)),
+                int(round((xbr - self.x) * self.scale)), int(round((ybr - self.y) * self.scale)))
+
+    def to_page_points(self, points):
+        """Converts a numpy array of `(x, y)` image points to page coordinates."""
+        return points / self.scale + (self.x, self.y)
+
+
+@dataclass(frozen=True)
+class IIIFImageUrl:
+    prefix: str  # base URI of the image, with its identifier
+    region: str
+    size: str
+    rotation: str
+    quality: str
+    format: str
+
+    @classmethod
+    def parse(cls, url: str) -> Optional["IIIFImageUrl"]:
+        """Parses an IIIF Image API URL, or returns None if `url` is not one."""
+        match = _IIIF_URL_RE.match(url)
+        if match is None:
+            return None
+        return cls(**match.groupdict())
+
+    def is_full_page(self) -> bool:
+        """Whether the URL requests the whole page at its full resolution, unrotated
+        (coordinates in the image fetched from this URL are then page coordinates)."""
+        return self.region == "full" and self.size in ("full", "max", "^max") and self.rotation == "0"
+
+    def window_url(self, bbox: Optional[Sequence[int]] = None, scale: float = 1.0) -> tuple:
+        """URL of a part of the page, at a given scale.
+
+        Args:
+            bbox (tuple of int): `(xtl, ytl, xbr, ybr)` part of the page, or None for the whole page.
+            scale (float): scale of the image (at most 1, the full resolution).
+
+        Returns:
+            tuple: `(url, ImageWindow)` mapping coordinates of the fetched image to the page.
+        """
+        region = self.region
+        x, y = 0, 0
+        if bbox is not None:
+            x, y, xbr, ybr = bbox
+            region = f"{x},{y},{xbr - x},{ybr - y}"
+        size = self.size if scale >= 1 else f"pct:{scale * 100:g}"
+        window = ImageWindow(x, y, min(scale, 1.0))
+        return f"{self.prefix}/{region}/{size}/{self.rotation}/{self.quality}.{self.format}", window
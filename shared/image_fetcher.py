@@ -0,0 +1,230 @@
+"""
+Image fetcher shared by the services which download images
+(ocr-worker, layout-worker-wrapper and the Surya server).
+
+Fetchers keep persistent connection pools (keep-alive to the `cache` nginx and to
+upstream image servers), bound the number of concurrent requests per upstream host,
+and stream response bodies so that oversized images are rejected before being fully
+read.
+- `ImageFetcher` is blocking (based on `requests`), for Celery workers.
+- `AsyncImageFetcher` is asyncio-native (based on `httpx`), for FastAPI services.
+  It can use HTTP/2 (`http2=True`), which requires the `h2` package (`httpx[http2]`).
+
+Both count downloads by status and by `X-Cache-Status` of the `cache` nginx, and downloaded
+bytes (see metrics.py).
+
+This file is copied into each service image (see the `shared` build context in
+`docker-compose.yml`); it must stay compatible with Python 3.9.
+"""
+
+import asyncio
+import threading
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Dict, Optional
+from urllib.parse import urlsplit
+
+import metrics
+
+try:
+    import requests
+    import requests.adapters
+except ImportError:  # only needed by ImageFetcher
+    requests = None
+
+try:
+    import httpx
+except ImportError:  # only needed by AsyncImageFetcher
+    httpx = None
+
+DEFAULT_TIMEOUT_SEC = 10.0
+DEFAULT_MAX_CONNECTIONS_PER_HOST = 8
+DEFAULT_MAX_BYTES = 100 * 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+
+FETCHES = metrics.Counter(
+    "mezanno_image_fetches_total",
+    "Image downloads, by HTTP status ('error' for network errors) and X-Cache-Status of the image cache ('none' when bypassed).",
+    ["status", "cache_status"])
+FETCHED_BYTES = metrics.Counter("mezanno_image_fetch_bytes_total", "Bytes of downloaded images.")
+
+
+class ImageFetchError(Exception):
+    """Raised when an image cannot be downloaded.
+
+    `status_code` is None for network errors, and `content` holds the beginning
+    of the response body for HTTP errors.
+    """
+    def __init__(self, message: str, url: str, status_code: Optional[int] = None, content: bytes = b""):
+        super().__init__(message)
+        self.url = url
+        self.status_code = status_code
+        self.content = content
+
+
+@dataclass
+class FetchedImage:
+    url: str
+    status_code: int
+    content_type: Optional[str]
+    content: bytes
+    headers: Dict[str, str] = field(default_factory=dict)
+
+
+def _host_of(url: str) -> str:
+    return urlsplit(url).netloc
+
+
+def _count_fetch(headers=None, status_code: Optional[int] = None) -> None:
+    cache_status = headers.get("X-Cache-Status", "none").lower() if headers is not None else "none"
+    FETCHES.inc(status=status_code if status_code is not None else "error", cache_status=cache_status)
+
+
+def _check_declared_size(url: str, headers, max_bytes: int) -> None:
+    content_length = headers.get("Content-Length")
+    if content_length is not None and content_length.isdigit() and int(content_length) > max_bytes:
+        raise ImageFetchError(f"Image is too large ({content_length} bytes, max is {max_bytes}).", url)
+
+
+class ImageFetcher():
+    def __init__(self, timeout_sec: float = DEFAULT_TIMEOUT_SEC,
+                 max_connections_per_host: int = DEFAULT_MAX_CONNECTIONS_PER_HOST,
+                 max_bytes: int = DEFAULT_MAX_BYTES) -> None:
+        """
+        Blocking image fetcher with pooled connections.
+
+        Args:
+            timeout_sec (float): Connection and read timeout.
+            max_connections_per_host (int): Max concurrent requests (and pooled connections) per host.
+            max_bytes (int): Max size of an image.
+        """
+        if requests is None:
+            raise ImportError("ImageFetcher requires the `requests` package.")
+        self.timeout_sec = timeout_sec
+        self.max_connections_per_host = max_connections_per_host
+        self.max_bytes = max_bytes
+        self._session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=16, pool_maxsize=max_connections_per_host)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+        self._host_semaphores: Dict[str, threading.BoundedSemaphore] = {}
+        self._lock = threading.Lock()
+
+    def _semaphore(self, url: str) -> threading.BoundedSemaphore:
+        host = _host_of(url)
+        with self._lock:
+            if host not in self._host_semaphores:
+                self._host_semaphores[host] = threading.BoundedSemaphore(self.max_connections_per_host)
+            return self._host_semaphores[host]
+
+    def fetch(self, url: str) -> FetchedImage:
+        """Downloads an image, raising `ImageFetchError` on failure."""
+        with self._semaphore(url):
+            r = None
+            try:
+                with self._session.get(url, timeout=self.timeout_sec, stream=True) as r:
+                    _count_fetch(r.headers, r.status_code)
+                    if r.status_code != 200:
+                        raise ImageFetchError(f"Image server returned status {r.status_code}.", url,
+                                              status_code=r.status_code, content=next(r.iter_content(CHUNK_SIZE), b""))
+                    _check_declared_size(url, r.headers, self.max_bytes)
+                    chunks = []
+                    size = 0
+                    for chunk in r.iter_content(CHUNK_SIZE):
+                        size += len(chunk)
+                        FETCHED_BYTES.inc(len(chunk))
+                        if size > self.max_bytes:
+                            raise ImageFetchError(f"Image is too large (more than {self.max_bytes} bytes).", url)
+                        chunks.append(chunk)
+                    return FetchedImage(url=url, status_code=r.status_code, content_type=r.headers.get("Content-Type"),
+                                        content=b"".join(chunks), headers=dict(r.headers))
+            except requests.RequestException as e:
+                if r is None:
+                    _count_fetch()
+                raise ImageFetchError(f"Cannot download image: {e}", url) from e
+
+    def close(self) -> None:
+        self._session.close()
+
+
+class AsyncImageFetcher():
+    def __init__(self, timeout_sec: float = DEFAULT_TIMEOUT_SEC,
+                 max_connections_per_host: int = DEFAULT_MAX_CONNECTIONS_PER_HOST,
+                 max_bytes: int = DEFAULT_MAX_BYTES, http2: bool = False) -> None:
+        """
+        Asyncio image fetcher with pooled connections.
+
+        Args:
+            timeout_sec (float): Connection and read timeout.
+            max_connections_per_host (int): Max concurrent requests per host.
+            max_bytes (int): Max size of an image.
+            http2 (bool): Use HTTP/2 with servers supporting it (requires the `h2` package: `httpx[http2]`).
+        """
+        if httpx is None:
+            raise ImportError("AsyncImageFetcher requires the `httpx` package.")
+        self.timeout_sec = timeout_sec
+        self.max_connections_per_host = max_connections_per_host
+        self.max_bytes = max_bytes
+        self.client = httpx.AsyncClient(
+            http2=http2,
+            timeout=timeout_sec,
+            limits=httpx.Limits(max_connections=None, max_keepalive_connections=4 * max_connections_per_host),
+        )
+        self._host_semaphores: Dict[str, asyncio.Semaphore] = {}
+
+    def _semaphore(self, url: str) -> asyncio.Semaphore:
+        host = _host_of(url)
+        if host not in self._host_semaphores:
+            self._host_semaphores[host] = asyncio.Semaphore(self.max_connections_per_host)
+        return self._host_semaphores[host]
+
+    @asynccontextmanager
+    async def stream(self, url: str) -> AsyncIterator["httpx.Response"]:
+        """Opens an image response without reading its body.
+
+        Use `iter_body(response)` to read the body with the size guard. Raises
+        `ImageFetchError` on network errors and HTTP errors.
+        """
+        async with self._semaphore(url):
+            try:
+                response = await self.client.send(self.client.build_request("GET", url), stream=True)
+            except httpx.HTTPError as e:
+                _count_fetch()
+                raise ImageFetchError(f"Cannot download image: {e}", url) from e
+            _count_fetch(response.headers, response.status_code)
+            try:
+                if response.status_code != 200:
+                    content = b""
+                    async for chunk in self.iter_body(response):
+                        content = chunk
+                        break
+                    raise ImageFetchError(f"Image server returned status {response.status_code}.", url,
+                                          status_code=response.status_code, content=content)
+                _check_declared_size(url, response.headers, self.max_bytes)
+                yield response
+            finally:
+                await response.aclose()
+
+    async def iter_body(self, response: "httpx.Response") -> AsyncIterator[bytes]:
+        """Yields the chunks of a response body, raising `ImageFetchError` past `max_bytes`."""
+        size = 0
+        try:
+            async for chunk in response.aiter_bytes(CHUNK_SIZE):
+                size += len(chunk)
+                FETCHED_BYTES.inc(len(chunk))
+                if size > self.max_bytes:
+                    raise ImageFetchError(f"Image is too large (more than {self.max_bytes} bytes).", str(response.url))
+                yield chunk
+        except httpx.HTTPError as e:
+            raise ImageFetchError(f"Cannot download image: {e}", str(response.url)) from e
+
+    async def fetch(self, url: str) -> FetchedImage:
+        """Downloads an image, raising `ImageFetchError` on failure."""
+        async with self.stream(url) as response:
+            content = b"".join([chunk async for chunk in self.iter_body(response)])
+            return FetchedImage(url=url, status_code=response.status_code,
+                                content_type=response.headers.get("Content-Type"),
+                                content=content, headers=dict(response.headers))
+
+    async def aclose(self) -> None:
+        await self.client.aclose()
@@ -0,0 +1,315 @@
+"""
+Prometheus metrics of the services, in the Prometheus text exposition format
+(https://prometheus.io/docs/instrumenting/exposition_formats/).
+
+Metrics are declared at module level, then updated by the code they measure:
+
+    DOWNLOADED_BYTES = metrics.Counter("mezanno_image_fetch_bytes_total", "Bytes of downloaded images.")
+    IN_FLIGHT = metrics.Gauge("mezanno_ocr_api_requests_in_flight", "Requests being processed.", ["endpoint"])
+    DOWNLOADED_BYTES.inc(len(content))
+    IN_FLIGHT.inc(endpoint="transcribe")
+
+`render()` gives the page scraped by Prometheus: services serve it on `/metrics`, with their web
+framework or with `start_http_server`. `observe_spans()` feeds the latency histogram of each stage
+(`mezanno_stage_duration_seconds{stage=...}`) with the spans of tracing.py.
+
+Processes of a prefork pool each have their own metrics: they write them to a directory with
+`start_snapshot_writer`, and the process serving the page adds them with `render(snapshot_dir)`.
+
+This file is copied into each service image (see the `shared` build context in
+`docker-compose.yml`); it must stay compatible with Python 3.9.
+"""
+
+import json
+import math
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import tracing
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Bucket upper bounds (seconds) of latency histograms: from a cache lookup to a large page
+DEFAULT_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+LabelValues = Tuple[str, ...]
+
+# Metrics of this process, by name, in declaration order
+_metrics: Dict[str, "_Metric"] = {}
+_metrics_lock = threading.Lock()
+
+
+def _format_value(value: float) -> str:
+    value = float(value)
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(value)
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    escaped = (value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for value in values)
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, escaped)) + "}"
+
+
+class _Metric(ABC):
+    type_name = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        with _metrics_lock:
+            if name in _metrics:
+                raise ValueError(f"Metric {name!r} is already declared.")
+            _metrics[name] = self
+
+    def _key(self, labels: Dict) -> LabelValues:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"Metric {self.name!r} expects labels {self.labelnames}, got {tuple(labels)}.")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    @abstractmethod
+    def samples(self) -> Dict[LabelValues, object]:
+        """Current value of each label set (JSON-serializable, see `_merge_value`)."""
+
+    def _merge_value(self, value: object, other: object) -> object:
+        """Value of a label set in two processes, combined."""
+        return value + other
+
+    def _sample_lines(self, key: LabelValues, value: object) -> Iterable[str]:
+        yield f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+
+    def render(self, samples: Dict[LabelValues, object]) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        for key in sorted(samples):
+            lines.extend(self._sample_lines(key, samples[key]))
+        return "\n".join(lines) + "\n"
+
+
+class Counter(_Metric):
+    """Monotonically increasing count (name it `..._total`)."""
+    type_name = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> None:
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {} if labelnames else {(): 0.}
+
+    def inc(self, amount: float = 1., **labels) -> None:
+        if amount < 0:
+            raise ValueError("Counters can only increase.")
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.) + amount
+
+    def samples(self) -> Dict[LabelValues, object]:
+        with self._lock:
+            return dict(self._values)
+
+
+class Gauge(_Metric):
+    """Value which goes up and down, e.g. a number of requests in flight.
+
+    Args:
+        name (str): Metric name.
+        documentation (str): Help text.
+        labelnames (list of str): Label names.
+        merge (str): How values of the processes of a prefork pool are combined: "sum" or "max".
+    """
+    type_name = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), merge: str = "sum") -> None:
+        if merge not in ("sum", "max"):
+            raise ValueError(f"Invalid merge {merge!r}: expected 'sum' or 'max'.")
+        super().__init__(name, documentation, labelnames)
+        self.merge = merge
+        self._values: Dict[LabelValues, float] = {} if labelnames else {(): 0.}
+        self._function: Optional[Callable[[], object]] = None
+
+    def set(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = float(value)
+
+    def inc(self, amount: float = 1., **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.) + amount
+
+    def dec(self, amount: float = 1., **labels) -> None:
+        self.inc(-amount, **labels)
+
+    def set_function(self, function: Callable[[], object]) -> None:
+        """Computes the values when rendered: `function` returns a number (no labels), or a dict
+        mapping label values (a tuple in the order of `labelnames`) to numbers."""
+        self._function = function
+
+    def samples(self) -> Dict[LabelValues, object]:
+        if self._function is not None:
+            try:
+                values = self._function()
+            except Exception as e:
+                print(f"Cannot compute metric {self.name}: {e!r}")
+                return {}
+            if not isinstance(values, dict):
+                return {(): float(values)}
+            return {tuple(str(value) for value in key): float(value) for key, value in values.items()}
+        with self._lock:
+            return dict(self._values)
+
+    def _merge_value(self, value: object, other: object) -> object:
+        return max(value, other) if self.merge == "max" else value + other
+
+
+class Histogram(_Metric):
+    """Distribution of observed values, e.g. latencies, counted in cumulative buckets."""
+    type_name = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_LATENCY_BUCKETS) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        if not self.buckets or self.buckets[-1] != math.inf:
+            self.buckets += (math.inf,)
+        # For each label set: [count in each bucket (not cumulative)..., sum]
+        self._values: Dict[LabelValues, List[float]] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        bucket_index = next(index for index, bound in enumerate(self.buckets) if value <= bound)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0.] * (len(self.buckets) + 1)
+            counts[bucket_index] += 1
+            counts[-1] += value
+
+    def samples(self) -> Dict[LabelValues, object]:
+        with self._lock:
+            return {key: list(counts) for key, counts in self._values.items()}
+
+    def _merge_value(self, value: object, other: object) -> object:
+        return [count + other_count for count, other_count in zip(value, other)]
+
+    def _sample_lines(self, key: LabelValues, value: object) -> Iterable[str]:
+        cumulative = 0.
+        for bound, count in zip(self.buckets, value[:-1]):
+            cumulative += count
+            labels = _format_labels(self.labelnames + ("le",), key + (_format_value(bound),))
+            yield f"{self.name}_bucket{labels} {_format_value(cumulative)}"
+        labels = _format_labels(self.labelnames, key)
+        yield f"{self.name}_sum{labels} {_format_value(value[-1])}"
+        yield f"{self.name}_count{labels} {_format_value(cumulative)}"
+
+
+STAGE_DURATION = Histogram("mezanno_stage_duration_seconds", "Duration of each stage of the requests (span name).", ["stage"])
+
+
+def _observe_span(span: tracing.Span) -> None:
+    STAGE_DURATION.observe(span.duration_sec, stage=span.name)
+
+
+def observe_spans() -> None:
+    """Feeds `mezanno_stage_duration_seconds` with the spans of this process (see tracing.py)."""
+    tracing.add_span_listener(_observe_span)
+
+
+def _snapshot() -> Dict[str, list]:
+    return {name: [[list(key), value] for key, value in metric.samples().items()] for name, metric in list(_metrics.items())}
+
+
+def write_snapshot(snapshot_dir: str) -> None:
+    """Writes the metrics of this process to `snapshot_dir`, to be rendered by another process."""
+    path = os.path.join(snapshot_dir, f"{os.getpid()}.json")
+    with open(path + ".tmp", "w") as f:
+        json.dump(_snapshot(), f)
+    os.replace(path + ".tmp", path)
+
+
+def start_snapshot_writer(snapshot_dir: str, interval_sec: float = 5.) -> threading.Thread:
+    """Writes the metrics of this process to `snapshot_dir` every `interval_sec` seconds, from a background thread."""
+    os.makedirs(snapshot_dir, exist_ok=True)
+
+    def run():
+        while True:
+            try:
+                write_snapshot(snapshot_dir)
+            except Exception as e:
+                print(f"Cannot write metrics to {snapshot_dir}: {e!r}")
+            time.sleep(interval_sec)
+    thread = threading.Thread(target=run, name="metrics-snapshot-writer", daemon=True)
+    thread.start()
+    return thread
+
+
+def _is_running(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _read_snapshots(snapshot_dir: str) -> List[Dict[str, list]]:
+    """Snapshots of the other running processes; those of exited processes are removed."""
+    snapshots = []
+    for filename in os.listdir(snapshot_dir) if os.path.isdir(snapshot_dir) else []:
+        stem, extension = os.path.splitext(filename)
+        if extension != ".json" or not stem.isdigit() or int(stem) == os.getpid():
+            continue
+        path = os.path.join(snapshot_dir, filename)
+        if not _is_running(int(stem)):
+            # Counters of exited processes restart from zero with their replacement, as after a restart
+            os.remove(path)
+            continue
+        try:
+            with open(path) as f:
+                snapshots.append(json.load(f))
+        except (OSError, ValueError) as e:
+            print(f"Cannot read metrics of {path}: {e!r}")
+    return snapshots
+
+
+def render(snapshot_dir: Optional[str] = None) -> str:
+    """Metrics of this process, plus those of the processes writing to `snapshot_dir` if given, in text format."""
+    pages = []
+    snapshots = _read_snapshots(snapshot_dir) if snapshot_dir else []
+    for name, metric in list(_metrics.items()):
+        samples = metric.samples()
+        for snapshot in snapshots:
+            for key, value in snapshot.get(name, []):
+                key = tuple(key)
+                samples[key] = metric._merge_value(samples[key], value) if key in samples else value
+        pages.append(metric.render(samples))
+    return "".join(pages)
+
+
+def start_http_server(port: int, host: str = "0.0.0.0", snapshot_dir: Optional[str] = None) -> ThreadingHTTPServer:
+    """Serves `render(snapshot_dir)` on `http://host:port/metrics`, from a background thread."""
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = render(snapshot_dir).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-http-server", daemon=True).start()
+    return server
@@ -0,0 +1,128 @@
+"""
+Persistent cache of OCR and layout results, shared by the services which dispatch
+work (api-ocr and layout-worker-wrapper).
+
+Results are stored as JSON in a local SQLite database, keyed by a hash of the
+canonicalized request (image URL, normalized regions, engine and model versions,
+processing flags…), so that identical requests are answered without recomputing
+them. Entries expire after `ttl_sec`, and the least recently used entries are
+evicted when the cache holds more than `max_entries` results.
+
+This file is copied into each service image (see the `shared` build context in
+`docker-compose.yml`); it must stay compatible with Python 3.9.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Optional
+
+
+def normalize_regions(regions: list) -> list:
+    """Canonical form of a list of `ImageRegion` dicts, as the OCR worker reads them.
+
+    Coordinates are truncated to non-negative integers (see `_regions_to_bboxes` in
+    ocr-worker/worker.py), so requests which only differ by sub-pixel values share
+    their result. The order of the regions is kept: it is the order of the lines.
+    """
+    return [[max(0, int(region[key])) for key in ("xtl", "ytl", "xbr", "ybr")] for region in regions]
+
+
+def make_cache_key(namespace: str, **params: Any) -> str:
+    """Hash of a canonicalized request (`params` must be JSON-serializable)."""
+    canonical = json.dumps({"namespace": namespace, **params}, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class ResultCache():
+    def __init__(self, path: str, ttl_sec: float = 30 * 24 * 3600., max_entries: int = 100000,
+                 recount_interval: int = 1000) -> None:
+        """
+        Args:
+            path (str): SQLite database file, created if needed.
+            ttl_sec (float): How long a result stays valid.
+            max_entries (int): Max number of cached results.
+            recount_interval (int): Number of `put` calls between two counts of the rows of the
+                database (the count is kept up to date in between, but not with the writes of other
+                processes sharing the database, e.g. replicas sharing a volume).
+        """
+        self.path = path
+        self.ttl_sec = ttl_sec
+        self.max_entries = max_entries
+        self.recount_interval = recount_interval
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Calls may come from several threads (e.g. `asyncio.to_thread`)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            " key TEXT PRIMARY KEY,"
+            " value TEXT NOT NULL,"
+            " created_at REAL NOT NULL,"
+            " accessed_at REAL NOT NULL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS results_accessed_at ON results (accessed_at)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS results_created_at ON results (created_at)")
+        # Counters of the current process
+        self.counters = {"hits": 0, "misses": 0, "evictions": 0}
+        # Number of rows, kept up to date by `put` and `_evict` so that they need no table scan
+        self._entries = 0
+        self._puts_since_count = 0
+        self._count_entries()
+
+    def get(self, key: str) -> Optional[Any]:
+        """Returns the cached result for `key`, or None."""
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM results WHERE key = ? AND created_at >= ?", (key, now - self.ttl_sec)).fetchone()
+            if row is None:
+                self.counters["misses"] += 1
+                return None
+            self._conn.execute("UPDATE results SET accessed_at = ? WHERE key = ?", (now, key))
+            self.counters["hits"] += 1
+        return json.loads(row[0])
+
+    def put(self, key: str, value: Any) -> None:
+        """Stores a result (which must be JSON-serializable), evicting old entries if needed."""
+        now = time.time()
+        serialized = json.dumps(value, separators=(",", ":"))
+        with self._lock:
+            exists = self._conn.execute("SELECT 1 FROM results WHERE key = ?", (key,)).fetchone() is not None
+            self._conn.execute(
+                "INSERT OR REPLACE INTO results (key, value, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, serialized, now, now))
+            if not exists:
+                self._entries += 1
+            self._puts_since_count += 1
+            if self._puts_since_count >= self.recount_interval:
+                self._count_entries()
+            self._evict(now)
+
+    def stats(self) -> dict:
+        """Counters of the current process, and current size of the cache."""
+        with self._lock:
+            return {**self.counters, "entries": self._entries, "max_entries": self.max_entries}
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    def _count_entries(self) -> None:
+        (self._entries,) = self._conn.execute("SELECT COUNT(*) FROM results").fetchone()
+        self._puts_since_count = 0
+
+    def _evict(self, now: float) -> None:
+        """Removes expired entries, then least recently used ones until the cache fits in `max_entries`."""
+        removed = self._conn.execute("DELETE FROM results WHERE created_at < ?", (now - self.ttl_sec,)).rowcount
+        if self._entries - removed > self.max_entries:
+            removed += self._conn.execute(
+                "DELETE FROM results WHERE key IN (SELECT key FROM results ORDER BY accessed_at LIMIT ?)",
+                (self._entries - removed - self.max_entries,)).rowcount
+        self._entries -= removed
+        self.counters["evictions"] += removed
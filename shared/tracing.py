@@ -0,0 +1,307 @@
+"""
+Per-stage timing and distributed tracing of requests, across the gateway, the API and the workers.
+
+Each stage of a request (image download, decoding, OCR, serialization…) is recorded as a span:
+a named and timed operation, whose parent is the span of the enclosing stage, possibly in
+another service. The trace context is propagated between services with the W3C `traceparent`
+header (https://www.w3.org/TR/trace-context/), in HTTP requests and in Celery task headers,
+so that spans of the gateway (Caddy `tracing` directive) and of any OpenTelemetry-instrumented
+service join the same traces.
+
+Finished spans are exported depending on `TRACING_EXPORTER`:
+- "" (default): not exported,
+- "file": appended as JSON lines to `TRACING_FILE`,
+- "otlp": sent in batches to an OpenTelemetry collector (OTLP/HTTP with JSON encoding,
+  at `OTEL_EXPORTER_OTLP_ENDPOINT`, by default http://localhost:4318).
+
+Independently of the exporter, `collect_timings()` gathers the durations of the spans ended
+within it, to answer a timing breakdown to clients, and listeners added with `add_span_listener`
+get every finished span (e.g. to feed latency histograms, see metrics.py).
+
+Usage:
+    tracing.configure("ocr-worker")
+    with tracing.span("api.transcribe", traceparent=request.headers.get(tracing.TRACEPARENT_HEADER)):
+        with tracing.span("api.cache_lookup"):
+            ...
+        celery.send_task(..., headers=tracing.task_headers())
+
+This file is copied into each service image (see the `shared` build context in
+`docker-compose.yml`); it must stay compatible with Python 3.9.
+"""
+
+import contextvars
+import json
+import os
+import queue
+import re
+import secrets
+import threading
+import time
+import urllib.request
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+TRACEPARENT_HEADER = "traceparent"
+# Celery task headers: time the task was sent (epoch seconds), and whether to return the timings of its stages
+SENT_AT_HEADER = "sent_at"
+COLLECT_TIMINGS_HEADER = "collect_timings"
+
+_TRACEPARENT_RE = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$")
+
+# Span of the stage being run, and timings being collected, in the current context
+_current_span: contextvars.ContextVar[Optional["Span"]] = contextvars.ContextVar("current_span", default=None)
+_collected_timings: contextvars.ContextVar[Optional[Dict[str, float]]] = contextvars.ContextVar("collected_timings", default=None)
+# Functions called with each finished span, in any tracer of this process
+_span_listeners: List[Callable[["Span"], None]] = []
+
+
+def parse_traceparent(traceparent: Optional[str]) -> Optional[Tuple[str, str]]:
+    """Returns `(trace_id, parent_span_id)` of a `traceparent` header, or None if it is missing or invalid."""
+    match = _TRACEPARENT_RE.match((traceparent or "").strip().lower())
+    if match is None or match[1] == "0" * 32 or match[2] == "0" * 16:
+        return None
+    return match[1], match[2]
+
+
+class Span():
+    def __init__(self, name: str, trace_id: str, parent_id: Optional[str], attributes: Dict,
+                 start_time: Optional[float] = None) -> None:
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.error: Optional[str] = None
+        self.start_time = time.time() if start_time is None else start_time
+        self.end_time: Optional[float] = None
+        # Monotonic clock at `start_time`, to measure the duration
+        self._start_counter = time.perf_counter() - (time.time() - self.start_time)
+
+    @property
+    def traceparent(self) -> str:
+        """`traceparent` header of requests sent within this span."""
+        return f"00-{self.trace_id}-{self.span_id}-01"
+
+    @property
+    def duration_sec(self) -> float:
+        return (self.end_time or time.time()) - self.start_time
+
+    def set_attribute(self, key: str, value) -> None:
+        self.attributes[key] = value
+
+    def end(self) -> None:
+        self.end_time = self.start_time + (time.perf_counter() - self._start_counter)
+
+    def to_dict(self, service_name: str) -> dict:
+        return {
+            "service": service_name,
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start_time": self.start_time,
+            "duration_sec": self.duration_sec,
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+
+class FileExporter():
+    """Appends finished spans to a file, one JSON object per line."""
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+
+    def export(self, span: Span, service_name: str) -> None:
+        line = json.dumps(span.to_dict(service_name), default=str) + "\n"
+        with self._lock, open(self.path, "a") as f:
+            f.write(line)
+
+
+def _otlp_value(value) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+class OTLPExporter():
+    """Sends finished spans in batches to an OpenTelemetry collector, from a background thread."""
+    def __init__(self, endpoint: str, max_batch_size: int = 512, flush_interval_sec: float = 2.0,
+                 max_queue_size: int = 8192, timeout_sec: float = 5.0) -> None:
+        self.url = endpoint.rstrip("/") + "/v1/traces"
+        self.max_batch_size = max_batch_size
+        self.flush_interval_sec = flush_interval_sec
+        self.timeout_sec = timeout_sec
+        self._spans: queue.Queue = queue.Queue(maxsize=max_queue_size)
+        self._thread = threading.Thread(target=self._run, name="otlp-exporter", daemon=True)
+        self._thread.start()
+
+    def export(self, span: Span, service_name: str) -> None:
+        try:
+            self._spans.put_nowait((span, service_name))
+        except queue.Full:
+            # Never slow requests down: drop spans the collector cannot keep up with
+            pass
+
+    def _run(self) -> None:
+        while True:
+            batch = [self._spans.get()]
+            deadline = time.monotonic() + self.flush_interval_sec
+            while len(batch) < self.max_batch_size:
+                try:
+                    batch.append(self._spans.get(timeout=max(0., deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            try:
+                self._send(batch)
+            except Exception as e:
+                print(f"Cannot export {len(batch)} spans to {self.url}: {e}")
+
+    def _send(self, batch: List[Tuple[Span, str]]) -> None:
+        spans_by_service: Dict[str, list] = {}
+        for span, service_name in batch:
+            spans_by_service.setdefault(service_name, []).append({
+                "traceId": span.trace_id,
+                "spanId": span.span_id,
+                **({"parentSpanId": span.parent_id} if span.parent_id else {}),
+                "name": span.name,
+                "kind": 1,  # internal
+                "startTimeUnixNano": str(int(span.start_time * 1e9)),
+                "endTimeUnixNano": str(int((span.end_time or span.start_time) * 1e9)),
+                "attributes": [{"key": key, "value": _otlp_value(value)} for key, value in span.attributes.items()],
+                "status": {"code": 2, "message": span.error} if span.error else {"code": 0},
+            })
+        payload = {"resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": service_name}}]},
+            "scopeSpans": [{"scope": {"name": "mezanno"}, "spans": spans}],
+        } for service_name, spans in spans_by_service.items()]}
+        request = urllib.request.Request(self.url, data=json.dumps(payload).encode(), method="POST",
+                                         headers={"Content-Type": "application/json"})
+        with urllib.request.urlopen(request, timeout=self.timeout_sec) as response:
+            response.read()
+
+
+class Tracer():
+    def __init__(self, service_name: str, exporter=None) -> None:
+        """
+        Records the spans of a service.
+
+        Args:
+            service_name (str): Name of the service, attached to its spans.
+            exporter: `FileExporter`, `OTLPExporter`, or None not to export spans.
+        """
+        self.service_name = service_name
+        self.exporter = exporter
+
+    @contextmanager
+    def span(self, name: str, traceparent: Optional[str] = None, start_time: Optional[float] = None,
+             **attributes) -> Iterator[Span]:
+        """Records the enclosed stage as a span, child of the span of `traceparent` if given and valid,
+        of the current span otherwise, or starting a new trace.
+
+        `start_time` (a `time.time()` value) backdates the start of the span, e.g. to when a task was sent.
+        """
+        parent = parse_traceparent(traceparent)
+        if parent is not None:
+            trace_id, parent_id = parent
+        elif _current_span.get() is not None:
+            trace_id, parent_id = _current_span.get().trace_id, _current_span.get().span_id
+        else:
+            trace_id, parent_id = secrets.token_hex(16), None
+        span = Span(name, trace_id, parent_id, attributes, start_time=start_time)
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.error = repr(e)
+            raise
+        finally:
+            span.end()
+            _current_span.reset(token)
+            self._finish(span)
+
+    def _finish(self, span: Span) -> None:
+        timings = _collected_timings.get()
+        if timings is not None:
+            timings[span.name] = timings.get(span.name, 0.) + span.duration_sec
+        for listener in _span_listeners:
+            listener(span)
+        if self.exporter is not None:
+            self.exporter.export(span, self.service_name)
+
+
+# Tracer of this process (spans are only collected until `configure` is called)
+_tracer = Tracer("unknown")
+
+
+def configure(service_name: str) -> Tracer:
+    """Sets the tracer of this process up from the environment (see the module docstring)."""
+    global _tracer
+    exporter_name = os.environ.get("TRACING_EXPORTER", "").lower()
+    if exporter_name == "file":
+        exporter = FileExporter(os.environ.get("TRACING_FILE", f"/tmp/{service_name}-spans.jsonl"))
+    elif exporter_name == "otlp":
+        exporter = OTLPExporter(os.environ.get("OTEL_EXPORTER_OTLP_ENDPOINT", "http://localhost:4318"))
+    elif exporter_name in ("", "none"):
+        exporter = None
+    else:
+        raise ValueError(f"Invalid TRACING_EXPORTER {exporter_name!r}: expected 'file', 'otlp' or ''.")
+    _tracer = Tracer(service_name, exporter)
+    return _tracer
+
+
+def add_span_listener(listener: Callable[[Span], None]) -> None:
+    """Calls `listener` with each span finished from now on (it must be fast and thread-safe)."""
+    if listener not in _span_listeners:
+        _span_listeners.append(listener)
+
+
+def span(name: str, traceparent: Optional[str] = None, start_time: Optional[float] = None, **attributes):
+    """`Tracer.span` of the tracer of this process."""
+    return _tracer.span(name, traceparent=traceparent, start_time=start_time, **attributes)
+
+
+def current_traceparent() -> Optional[str]:
+    """`traceparent` header to propagate the current span to another service, or None outside spans."""
+    current = _current_span.get()
+    return current.traceparent if current is not None else None
+
+
+def task_headers(collect_timings: bool = False) -> Dict:
+    """Headers of a Celery task sent within the current span (see `SENT_AT_HEADER` and `COLLECT_TIMINGS_HEADER`)."""
+    headers = {SENT_AT_HEADER: time.time()}
+    traceparent = current_traceparent()
+    if traceparent is not None:
+        headers[TRACEPARENT_HEADER] = traceparent
+    if collect_timings:
+        headers[COLLECT_TIMINGS_HEADER] = True
+    return headers
+
+
+@contextmanager
+def collect_timings() -> Iterator[Dict[str, float]]:
+    """Yields a dict filled with the total duration (seconds) of the spans ended within it, by span name."""
+    timings: Dict[str, float] = {}
+    token = _collected_timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _collected_timings.reset(token)
+
+
+def current_timings() -> Optional[Dict[str, float]]:
+    """Timings being collected in the current context (see `collect_timings`), or None."""
+    collected = _collected_timings.get()
+    return dict(collected) if collected is not None else None
+
+
+def add_timings(timings: Dict[str, float]) -> None:
+    """Adds durations measured elsewhere (e.g. by a worker) to the timings being collected, if any."""
+    collected = _collected_timings.get()
+    if collected is not None:
+        for name, duration_sec in timings.items():
+            collected[name] = collected.get(name, 0.) + duration_sec
@@ -0,0 +1,104 @@
+"""
+Micro-batching des appels aux prédicteurs Surya.
+
+Les images (régions découpées) de toutes les requêtes concurrentes sont accumulées
+pendant une courte fenêtre (`max_wait_sec`) ou jusqu'à `max_batch_size` images,
+puis envoyées en un seul appel au prédicteur, dans un exécuteur dédié : la boucle
+d'événements n'est jamais bloquée, et chaque requête récupère ses résultats via
+un future.
+"""
+
+import asyncio
+import time
+from concurrent.futures import Executor
+from typing import Any, Callable, List, Optional
+
+
+class MicroBatcher:
+    def __init__(self, name: str, predict_fn: Callable[[List[Any]], List[Any]], executor: Executor,
+                 max_batch_size: int = 8, max_wait_sec: float = 0.01):
+        """
+        Args:
+            name: nom du prédicteur (pour les statistiques).
+            predict_fn: fonction appelée avec une liste d'entrées, qui renvoie une sortie par entrée.
+            executor: exécuteur dans lequel `predict_fn` est appelée.
+            max_batch_size: nombre max d'entrées par appel.
+            max_wait_sec: attente max après la première entrée d'un batch avant l'appel.
+        """
+        self.name = name
+        self._predict_fn = predict_fn
+        self._executor = executor
+        self.max_batch_size = max_batch_size
+        self.max_wait_sec = max_wait_sec
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+        self.stats = {"batches": 0, "items": 0, "busy_sec": 0.0}
+
+    def start(self):
+        """Démarre la tâche de collecte (à appeler depuis la boucle d'événements)."""
+        self._queue = asyncio.Queue()
+        self._worker = asyncio.create_task(self._run(), name=f"batcher-{self.name}")
+
+    async def stop(self):
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+
+    @property
+    def queued(self) -> int:
+        """Nombre d'entrées en attente du prochain batch."""
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def submit(self, item: Any) -> Any:
+        """Ajoute une entrée au prochain batch, et renvoie sa sortie."""
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((item, future))
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait_sec
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            # Requêtes annulées entre-temps (client parti)
+            batch = [(item, future) for item, future in batch if not future.cancelled()]
+            if not batch:
+                continue
+
+            start = time.perf_counter()
+            try:
+                outputs = await loop.run_in_executor(self._executor, self._predict_fn, [item for item, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            finally:
+                self.stats["batches"] += 1
+                self.stats["items"] += len(batch)
+                self.stats["busy_sec"] += time.perf_counter() - start
+            outputs = list(outputs)
+            if len(outputs) != len(batch):
+                # L'appariement entrées/sorties n'est plus fiable : toutes les requêtes du batch échouent,
+                # plutôt que d'attendre indéfiniment une sortie manquante
+                error = RuntimeError(f"Predictor {self.name} returned {len(outputs)} outputs"
+                                     f" for {len(batch)} inputs.")
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(error)
+                continue
+            for (_, future), output in zip(batch, outputs):
+                if not future.done():
+                    future.set_result(output)
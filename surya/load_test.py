@@ -0,0 +1,69 @@
+"""
+Test de charge du serveur Surya : débit et latences (p50/p95/p99) sous concurrence.
+
+Exemple (serveur lancé sur localhost:8000) :
+    python load_test.py --endpoint layout --requests 64 --concurrency 8 \\
+        --url "https://picsum.photos/id/24/1200/1600" \\
+        --regions '[{"xtl": 0, "ytl": 0, "xbr": 600, "ybr": 800}, {"xtl": 600, "ytl": 800, "xbr": 1200, "ybr": 1600}]'
+
+À lancer avant et après un changement de `SURYA_BATCH_MAX_SIZE` / `SURYA_BATCH_MAX_WAIT_MS`
+(`SURYA_BATCH_MAX_SIZE=1` revient à un appel du prédicteur par région).
+"""
+
+import argparse
+import asyncio
+import json
+import statistics
+import time
+
+import httpx
+
+
+def percentile(values: list, p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Test de charge du serveur Surya")
+    parser.add_argument("--server", default="http://localhost:8000", type=str)
+    parser.add_argument("--endpoint", default="ocr", choices=["ocr", "layout", "table", "analyze"])
+    parser.add_argument("--url", required=True, type=str, help="URL de l'image")
+    parser.add_argument("--regions", default="[]", type=str, help="Régions (JSON)")
+    parser.add_argument("--requests", default=32, type=int, help="Nombre total de requêtes")
+    parser.add_argument("--concurrency", default=8, type=int, help="Requêtes simultanées")
+    args = parser.parse_args()
+
+    payload = {"url": args.url, "regions": json.loads(args.regions)}
+    semaphore = asyncio.Semaphore(args.concurrency)
+    latencies = []
+    errors = 0
+
+    async with httpx.AsyncClient(base_url=args.server, timeout=None) as client:
+        async def one_request():
+            nonlocal errors
+            async with semaphore:
+                start = time.perf_counter()
+                response = await client.post(f"/{args.endpoint}", json=payload)
+                latencies.append(time.perf_counter() - start)
+                if response.status_code != 200:
+                    errors += 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one_request() for _ in range(args.requests)))
+        elapsed = time.perf_counter() - start
+        stats = (await client.get("/batching_stats")).json()
+
+    print(f"{args.requests} requêtes /{args.endpoint} ({args.concurrency} simultanées) en {elapsed:.2f}s,"
+          f" {errors} erreurs")
+    print(f"débit : {args.requests / elapsed:.2f} requêtes/s")
+    print(f"latence : moyenne {statistics.mean(latencies):.3f}s, p50 {percentile(latencies, 50):.3f}s,"
+          f" p95 {percentile(latencies, 95):.3f}s, p99 {percentile(latencies, 99):.3f}s")
+    for name, batcher_stats in stats.items():
+        if batcher_stats["batches"]:
+            print(f"batches {name} : {batcher_stats['batches']}, taille moyenne"
+                  f" {batcher_stats['items'] / batcher_stats['batches']:.1f}, occupation {batcher_stats['busy_sec']:.2f}s")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,164 @@
+"""
+Représentation des résultats Surya sous forme de tableaux NumPy.
+
+Les prédicteurs renvoient des objets Pydantic (une instance par ligne, caractère,
+boîte, cellule…). Décaler puis fusionner ces objets un par un est lent sur les pages
+denses. Ici, les polygones de chaque liste de boîtes sont regroupés dans un tableau
+(N, 4, 2), et les boîtes filles (caractères et mots des lignes) dans leur propre
+tableau, avec des plages d'indices par parent :
+- un décalage est une seule addition par tableau,
+- une fusion est une concaténation,
+- les dictionnaires JSON ne sont construits qu'à la sérialisation (`to_dict`), avec le
+  même contenu que `model_dump()` des objets Surya (dont le champ calculé `bbox`).
+"""
+
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+# Champs des objets Surya qui sont des listes de boîtes, par type de résultat
+BOX_LIST_FIELDS = {
+    'layout': ['bboxes'],
+    'ocr': ['text_lines'],
+    'table': ['cells', 'unmerged_cells', 'rows', 'cols'],
+}
+# Champs des boîtes qui sont eux-mêmes des listes de boîtes (éventuellement None)
+CHILD_BOX_FIELDS = ['chars', 'words']
+
+
+class BoxArrays:
+    """Liste de boîtes : polygones (N, 4, 2), autres champs par boîte, et boîtes filles."""
+    def __init__(self, polygons: np.ndarray, attrs: List[dict], children: Optional[Dict[str, "ChildBoxes"]] = None):
+        self.polygons = polygons
+        self.attrs = attrs
+        self.children = children or {}
+
+    @classmethod
+    def from_models(cls, boxes: List[Any]) -> "BoxArrays":
+        polygons = np.array([box.polygon for box in boxes], dtype=np.float64).reshape(len(boxes), 4, 2)
+        skipped = {'polygon', *CHILD_BOX_FIELDS}
+        attrs = [{k: v for k, v in box.__dict__.items() if k not in skipped} for box in boxes]
+        children = {}
+        for field in CHILD_BOX_FIELDS:
+            if any(field in box.__dict__ for box in boxes):
+                children[field] = ChildBoxes.from_models([box.__dict__.get(field) for box in boxes])
+        return cls(polygons, attrs, children)
+
+    def __len__(self):
+        return len(self.attrs)
+
+    def shift(self, dx: float, dy: float):
+        self.polygons += (dx, dy)
+        for child in self.children.values():
+            child.boxes.shift(dx, dy)
+
+    def bboxes(self) -> np.ndarray:
+        """Boîtes englobantes (N, 4) : x_min, y_min, x_max, y_max."""
+        return np.concatenate([self.polygons.min(axis=1), self.polygons.max(axis=1)], axis=1)
+
+    @classmethod
+    def concatenate(cls, parts: List["BoxArrays"]) -> "BoxArrays":
+        fields = set().union(*(part.children for part in parts)) if parts else set()
+        return cls(
+            np.concatenate([part.polygons for part in parts]) if parts else np.zeros((0, 4, 2)),
+            [attrs for part in parts for attrs in part.attrs],
+            {field: ChildBoxes.concatenate([part.children.get(field) or ChildBoxes.empty(len(part)) for part in parts])
+             for field in fields},
+        )
+
+    def to_dicts(self) -> List[dict]:
+        polygons = self.polygons.tolist()
+        bboxes = self.bboxes().tolist()
+        children = {field: child.to_lists() for field, child in self.children.items()}
+        return [
+            {
+                'polygon': polygon,
+                **attrs,
+                **{field: child_lists[i] for field, child_lists in children.items()},
+                'bbox': bbox,
+            }
+            for i, (attrs, polygon, bbox) in enumerate(zip(self.attrs, polygons, bboxes))
+        ]
+
+
+class ChildBoxes:
+    """Boîtes filles de N boîtes parentes : les filles du parent i sont `boxes[offsets[i]:offsets[i + 1]]`."""
+    def __init__(self, boxes: BoxArrays, offsets: np.ndarray, present: np.ndarray):
+        self.boxes = boxes
+        self.offsets = offsets
+        # False si le champ vaut None pour ce parent (ex. `words` non demandés)
+        self.present = present
+
+    @classmethod
+    def from_models(cls, box_lists: List[Optional[List[Any]]]) -> "ChildBoxes":
+        counts = [len(boxes) if boxes is not None else 0 for boxes in box_lists]
+        return cls(
+            BoxArrays.from_models([box for boxes in box_lists if boxes is not None for box in boxes]),
+            np.concatenate([[0], np.cumsum(counts)]).astype(np.int64),
+            np.array([boxes is not None for boxes in box_lists], dtype=bool),
+        )
+
+    @classmethod
+    def empty(cls, parent_count: int) -> "ChildBoxes":
+        return cls(BoxArrays(np.zeros((0, 4, 2)), []), np.zeros(parent_count + 1, dtype=np.int64),
+                   np.zeros(parent_count, dtype=bool))
+
+    @classmethod
+    def concatenate(cls, parts: List["ChildBoxes"]) -> "ChildBoxes":
+        starts = np.cumsum([0] + [len(part.boxes) for part in parts[:-1]])
+        return cls(
+            BoxArrays.concatenate([part.boxes for part in parts]),
+            np.concatenate([[0]] + [part.offsets[1:] + start for part, start in zip(parts, starts)]).astype(np.int64),
+            np.concatenate([part.present for part in parts]) if parts else np.zeros(0, dtype=bool),
+        )
+
+    def to_lists(self) -> List[Optional[List[dict]]]:
+        dicts = self.boxes.to_dicts()
+        return [dicts[start:end] if present else None
+                for start, end, present in zip(self.offsets[:-1], self.offsets[1:], self.present)]
+
+
+class ResultArrays:
+    """Résultat Surya (layout, OCR ou tables) d'une région ou d'une page."""
+    def __init__(self, type: str, fields: Dict[str, BoxArrays], image_bbox: np.ndarray, sliced: Optional[bool] = None):
+        self.type = type
+        self.fields = fields
+        self.image_bbox = image_bbox
+        # Seulement pour les résultats de layout
+        self.sliced = sliced
+
+    @classmethod
+    def from_result(cls, type: str, pred: Any) -> "ResultArrays":
+        return cls(
+            type,
+            {field: BoxArrays.from_models(getattr(pred, field)) for field in BOX_LIST_FIELDS[type]},
+            np.array(pred.image_bbox, dtype=np.float64),
+            getattr(pred, 'sliced', None) if type == 'layout' else None,
+        )
+
+    def shift(self, dx: float, dy: float):
+        for boxes in self.fields.values():
+            boxes.shift(dx, dy)
+        self.image_bbox = self.image_bbox + (dx, dy, dx, dy)
+
+    @classmethod
+    def merge(cls, type: str, results: List["ResultArrays"]) -> "ResultArrays":
+        # image_bbox = enveloppe de tous les image_bbox
+        image_bboxes = np.array([r.image_bbox for r in results if len(r.image_bbox) == 4]).reshape(-1, 4)
+        if len(image_bboxes):
+            merged_bbox = np.concatenate([image_bboxes[:, :2].min(axis=0), image_bboxes[:, 2:].max(axis=0)])
+        else:
+            merged_bbox = np.zeros(4)
+        return cls(
+            type,
+            {field: BoxArrays.concatenate([r.fields[field] for r in results]) for field in BOX_LIST_FIELDS[type]},
+            merged_bbox,
+            any(r.sliced for r in results) if type == 'layout' else None,
+        )
+
+    def to_dict(self) -> dict:
+        result = {field: boxes.to_dicts() for field, boxes in self.fields.items()}
+        result['image_bbox'] = self.image_bbox.tolist()
+        if self.type == 'layout':
+            result['sliced'] = bool(self.sliced)
+        return result
@@ -1,20 +1,65 @@
-from typing import List
-from fastapi import FastAPI, HTTPException, Request
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import List, Literal
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel
 from PIL import Image
-import requests
 from io import BytesIO
 
-from surya.common.polygon import PolygonBox
 from surya.foundation import FoundationPredictor
-from surya.layout import LayoutPredictor, LayoutResult, LayoutBox
-from surya.recognition import RecognitionPredictor, OCRResult, TextLine
+from surya.layout import LayoutPredictor
+from surya.recognition import RecognitionPredictor
 from surya.detection import DetectionPredictor
 from fastapi.middleware.cors import CORSMiddleware
-from surya.table_rec import TableRecPredictor, TableResult, TableCell, TableCol, TableRow
+from surya.table_rec import TableRecPredictor
 from sympy.strategies.core import switch
 
-app = FastAPI()
+import numpy as np
+
+from batching import MicroBatcher
+from image_fetcher import AsyncImageFetcher
+from result_arrays import ResultArrays
+import metrics
+import tracing
+
+# Micro-batching : taille max d'un batch, et attente max (ms) pour le compléter
+SURYA_BATCH_MAX_SIZE = int(os.environ.get("SURYA_BATCH_MAX_SIZE", 8))
+SURYA_BATCH_MAX_WAIT_MS = float(os.environ.get("SURYA_BATCH_MAX_WAIT_MS", 10))
+
+# Client HTTP partagé (connexions persistantes, nombre de requêtes simultanées borné par hôte)
+image_fetcher: AsyncImageFetcher = None
+
+# Exécuteur dédié aux prédicteurs : un seul appel à la fois, hors de la boucle d'événements
+predictor_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="surya-predictor")
+
+# Métriques Prometheus, servies sur /metrics (voir metrics.py)
+REQUESTS_IN_FLIGHT = metrics.Gauge("mezanno_surya_requests_in_flight", "Requests being processed, by path.", ["path"])
+MODEL_LOAD_SECONDS = metrics.Gauge("mezanno_surya_model_load_seconds", "Time to load the Surya predictors.")
+BATCHER_QUEUED_ITEMS = metrics.Gauge("mezanno_surya_batcher_queued_items",
+                                     "Regions waiting for the next batch of each predictor.", ["predictor"])
+DECODED_MEGAPIXELS = metrics.Histogram("mezanno_surya_decoded_image_megapixels", "Size of decoded images, in megapixels.",
+                                       buckets=(0.25, 0.5, 1., 2., 4., 8., 16., 32., 64.))
+OCR_LINES = metrics.Counter("mezanno_surya_lines_total", "Lines recognized by the OCR.")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global image_fetcher
+    # Export des spans selon TRACING_EXPORTER (voir tracing.py)
+    tracing.configure("surya")
+    metrics.observe_spans()
+    image_fetcher = AsyncImageFetcher()
+    for batcher in batchers.values():
+        batcher.start()
+    yield
+    for batcher in batchers.values():
+        await batcher.stop()
+    await image_fetcher.aclose()
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -24,12 +69,46 @@ app.add_middleware(
     allow_headers=["*"],  # Autorise tous les headers
 )
 
+@app.middleware("http")
+async def trace_request(request: Request, call_next):
+    # Chaque requête est un span, enfant de celui de l'appelant s'il envoie l'en-tête traceparent ;
+    # les durées des étapes sont collectées pour les requêtes qui les demandent (champ `timings`)
+    path = request.url.path.strip('/')
+    if path == "metrics":
+        return await call_next(request)
+    REQUESTS_IN_FLIGHT.inc(path=path)
+    try:
+        with tracing.collect_timings(), tracing.span(f"surya.{path}",
+                                                     traceparent=request.headers.get(tracing.TRACEPARENT_HEADER)):
+            return await call_next(request)
+    finally:
+        REQUESTS_IN_FLIGHT.dec(path=path)
+
 # Initialise une fois les predictiors
+model_load_start = time.perf_counter()
 foundation_predictor = FoundationPredictor()
 recognition_predictor = RecognitionPredictor(foundation_predictor)
 detection_predictor = DetectionPredictor()
 layout_predictor = LayoutPredictor()
 table_rec_predictor = TableRecPredictor()
+MODEL_LOAD_SECONDS.set(time.perf_counter() - model_load_start)
+
+# Régions de toutes les requêtes concurrentes, regroupées par prédicteur
+batchers = {
+    'layout': MicroBatcher('layout', lambda images: layout_predictor(images), predictor_executor,
+                           max_batch_size=SURYA_BATCH_MAX_SIZE, max_wait_sec=SURYA_BATCH_MAX_WAIT_MS / 1000),
+    'table': MicroBatcher('table', lambda images: table_rec_predictor(images), predictor_executor,
+                          max_batch_size=SURYA_BATCH_MAX_SIZE, max_wait_sec=SURYA_BATCH_MAX_WAIT_MS / 1000),
+    # OCR en deux étapes, pour pouvoir réutiliser la détection des lignes
+    'detection': MicroBatcher('detection', lambda images: detection_predictor(images), predictor_executor,
+                              max_batch_size=SURYA_BATCH_MAX_SIZE, max_wait_sec=SURYA_BATCH_MAX_WAIT_MS / 1000),
+    # Entrées : (image, polygones des lignes détectées)
+    'recognition': MicroBatcher('recognition', lambda jobs: recognition_predictor(
+                                    [image for image, _ in jobs], polygons=[polygons for _, polygons in jobs]),
+                                predictor_executor,
+                                max_batch_size=SURYA_BATCH_MAX_SIZE, max_wait_sec=SURYA_BATCH_MAX_WAIT_MS / 1000),
+}
+BATCHER_QUEUED_ITEMS.set_function(lambda: {(name,): batcher.queued for name, batcher in batchers.items()})
 
 class Region(BaseModel):
     xtl: float
@@ -40,177 +119,147 @@ class Region(BaseModel):
 class ImageUrlRequest(BaseModel):
     url: str
     regions: List[Region]
+    # Ajoute à la réponse la durée (secondes) de chaque étape
+    timings: bool = False
 
-def shift_layout_result(pred: LayoutResult, dx: float, dy: float) -> LayoutResult:
-    new_pred = pred.model_copy()
-
-    # on clone chaque box et on la décale
-    new_boxes: list[LayoutBox] = []
-    for box in pred.bboxes:
-        b = box.model_copy()     # clone de LayoutBox
-        b.shift(dx, dy)          # ta méthode PolygonBox
-        new_boxes.append(b)
-
-    new_pred.bboxes = new_boxes
-    return new_pred
-
-def shift_ocr_result(pred:OCRResult, dx: float, dy: float) -> OCRResult:
-    new_pred = pred.model_copy()
-    for line in new_pred.text_lines:
-        line.shift(dx, dy)
-        for char in line.chars:
-            char.shift(dx, dy)
-
-    new_pred.image_bbox = [
-        new_pred.image_bbox[0] + dx,
-        new_pred.image_bbox[1] + dy,
-        new_pred.image_bbox[2] + dx,
-        new_pred.image_bbox[3] + dy,
-    ]
-    return new_pred
-
-def shift_table_result(pred: TableResult, dx: float, dy: float) -> TableResult:
-    new_pred = pred.model_copy()
-
-    for cell in new_pred.cells:
-        cell.shift(dx, dy)
-
-    for ucell in new_pred.unmerged_cells:
-        ucell.shift(dx, dy)
-
-    for col in new_pred.cols:
-        col.shift(dx, dy)
-
-    for row in new_pred.rows:
-        row.shift(dx, dy)
-
-    new_pred.image_bbox = [
-        new_pred.image_bbox[0] + dx,
-        new_pred.image_bbox[1] + dy,
-        new_pred.image_bbox[2] + dx,
-        new_pred.image_bbox[3] + dy,
-    ]
-    return new_pred
-
-def merge_layout_results(results: list[LayoutResult]) -> LayoutResult:
-    all_boxes: list[LayoutBox] = []
-    # image_bbox = enveloppe de tous les image_bbox (après décalage)
-    minx = float("inf"); miny = float("inf"); maxx = float("-inf"); maxy = float("-inf")
-    sliced_any = False
-
-    for r in results:
-        all_boxes.extend(r.bboxes)
-        if r.image_bbox and len(r.image_bbox) == 4:
-            x1, y1, x2, y2 = r.image_bbox
-            minx = min(minx, x1); miny = min(miny, y1)
-            maxx = max(maxx, x2); maxy = max(maxy, y2)
-        sliced_any = sliced_any or r.sliced
-
-    merged_bbox = [minx, miny, maxx, maxy] if minx != float("inf") else [0, 0, 0, 0]
-    return LayoutResult(bboxes=all_boxes, image_bbox=merged_bbox, sliced=sliced_any)
-
-def merge_ocr_results(results: list[OCRResult]) -> OCRResult:
-    all_lines: list[TextLine] = []
-    minx = float("inf"); miny = float("inf"); maxx = float("-inf"); maxy = float("-inf")
-
-    for r in results:
-        all_lines.extend(r.text_lines)
-        if r.image_bbox and len(r.image_bbox) == 4:
-            x1, y1, x2, y2 = r.image_bbox
-            minx = min(minx, x1); miny = min(miny, y1)
-            maxx = max(maxx, x2); maxy = max(maxy, y2)
-
-    merged_bbox = [minx, miny, maxx, maxy] if minx != float("inf") else [0, 0, 0, 0]
-    return OCRResult(text_lines=all_lines, image_bbox=merged_bbox)
-
-def merge_table_results(results: list[TableResult]) -> TableResult:
-    all_cells: list[TableCell] = []
-    all_ucells: list[TableCell] = []
-    all_cols: list[TableCol] = []
-    all_rows: list[TableRow] = []
-    minx = float("inf"); miny = float("inf"); maxx = float("-inf"); maxy = float("-inf")
-
-    for r in results:
-        all_cells.extend(r.cells)
-        all_cols.extend(r.cols)
-        all_rows.extend(r.rows)
-        all_ucells.extend(r.unmerged_cells)
-        if r.image_bbox and len(r.image_bbox) == 4:
-            x1, y1, x2, y2 = r.image_bbox
-            minx = min(minx, x1); miny = min(miny, y1)
-            maxx = max(maxx, x2); maxy = max(maxy, y2)
-
-    merged_bbox = [minx, miny, maxx, maxy] if minx != float("inf") else [0, 0, 0, 0]
-    return TableResult(cells=all_cells,rows=all_rows,cols=all_cols, unmerged_cells=all_ucells, image_bbox=merged_bbox)
+Task = Literal['layout', 'ocr', 'table']
+
+class AnalyzeRequest(ImageUrlRequest):
+    tasks: List[Task] = ['layout', 'ocr', 'table']
 
 @app.post("/ocr")
 async def predict_image(request: ImageUrlRequest):
-    return process(request, 'ocr')
+    image = await fetch_image(request.url)
+    return with_timings(await process(image, request.regions, 'ocr'), request)
 
 @app.post("/layout")
 async def predict_layout(request: ImageUrlRequest):
-    return process(request, 'layout')
+    image = await fetch_image(request.url)
+    return with_timings(await process(image, request.regions, 'layout'), request)
 
 @app.post("/table")
 async def predict_table(request: ImageUrlRequest):
-    return process(request, 'table')
-
-def process(request: ImageUrlRequest, type):
+    image = await fetch_image(request.url)
+    return with_timings(await process(image, request.regions, 'table'), request)
+
+@app.post("/analyze")
+async def analyze(request: AnalyzeRequest):
+    # Plusieurs tâches sur la même page : un seul téléchargement, un seul décodage et découpage des régions,
+    # tâches exécutées en parallèle (et batchées avec les autres requêtes)
+    image = await fetch_image(request.url)
+    regions, cropped = await crop_regions(image, request.regions)
+    tasks = list(dict.fromkeys(request.tasks))
+    results = dict(zip(tasks, await asyncio.gather(*(predict_regions(cropped, regions, task) for task in tasks))))
+    if 'ocr' in results and 'table' in results:
+        # Les lignes détectées et reconnues par l'OCR remplissent les cellules des tables
+        await run_in_threadpool(fill_table_cells, results['table'], results['ocr'])
+    with tracing.span("surya.serialize"):
+        response = {task: {"predictions": [await run_in_threadpool(merged.to_dict)]} for task, merged in results.items()}
+    return with_timings(response, request)
+
+@app.get("/batching_stats")
+async def batching_stats():
+    # Taille moyenne des batches = items / batches
+    return {name: batcher.stats for name, batcher in batchers.items()}
+
+@app.get("/metrics")
+async def get_metrics():
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+def with_timings(response: dict, request: ImageUrlRequest) -> dict:
+    # Durées des étapes terminées (voir le middleware `trace_request`), si la requête les demande
+    if request.timings:
+        response["timings"] = tracing.current_timings()
+    return response
+
+async def fetch_image(url: str) -> Image.Image:
     try:
-        # Téléchargement de l'image depuis l'URL
-        response = requests.get(request.url)
-        response.raise_for_status()
-        image = Image.open(BytesIO(response.content)).convert("RGB")
+        # Téléchargement de l'image depuis l'URL, sans bloquer la boucle d'événements
+        with tracing.span("surya.download_image", url=url):
+            fetched = await image_fetcher.fetch(url)
+        with tracing.span("surya.decode_image"):
+            image = await run_in_threadpool(lambda: Image.open(BytesIO(fetched.content)).convert("RGB"))
+        DECODED_MEGAPIXELS.observe(image.width * image.height / 1e6)
+        return image
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Impossible de charger l'image: {str(e)}")
 
+async def process(image: Image.Image, request_regions: List[Region], type):
+    regions, cropped = await crop_regions(image, request_regions)
+    merged = await predict_regions(cropped, regions, type)
+    with tracing.span("surya.serialize"):
+        return {"predictions": [await run_in_threadpool(merged.to_dict)]}
+
+async def crop_regions(image: Image.Image, request_regions: List[Region]):
     regions: List[Region]
-    if not request.regions:
+    if not request_regions:
         width, height = image.size
         regions = [Region(xtl=0, ytl=0, xbr=width, ybr=height)]
     else:
-        regions = request.regions
+        regions = request_regions
 
     print('regions ', regions)
+    with tracing.span("surya.crop_regions", regions=len(regions)):
+        cropped = await run_in_threadpool(
+            lambda: [image.crop((region.xtl, region.ytl, region.xbr, region.ybr)) for region in regions])
+    return regions, cropped
+
+async def predict_regions(cropped: List[Image.Image], regions: List[Region], type) -> ResultArrays:
+    # Le span couvre aussi l'attente des batches (voir /batching_stats)
+    with tracing.span(f"surya.predict_{type if type in ('layout', 'table') else 'ocr'}", regions=len(regions)):
+        return await _predict_regions(cropped, regions, type)
+
+async def _predict_regions(cropped: List[Image.Image], regions: List[Region], type) -> ResultArrays:
+    # Les régions sont prédites avec celles des autres requêtes en cours
     match type:
         case 'layout':
-            all_predictions: list[LayoutResult] = []
-            for region in regions:
-                cropped = image.crop((region.xtl, region.ytl, region.xbr, region.ybr))
-                predictions = layout_predictor([cropped])
-                adjusted_preds = [
-                    shift_layout_result(pred, region.xtl, region.ytl) for pred in predictions
-                ]
-                all_predictions.extend(adjusted_preds)
-            merged = merge_layout_results(all_predictions)
-            return {"predictions": [merged]}
+            predictions = await asyncio.gather(*(batchers['layout'].submit(crop) for crop in cropped))
         case 'table':
-            all_predictions: list[TableResult] = []
-            for region in regions:
-                cropped = image.crop((region.xtl, region.ytl, region.xbr, region.ybr))
-                predictions = table_rec_predictor([cropped])
-                adjusted_preds = [
-                    shift_table_result(pred, region.xtl, region.ytl) for pred in predictions
-                ]
-                all_predictions.extend(adjusted_preds)
-            merged = merge_table_results(all_predictions)
-            return {"predictions": [merged]}
+            predictions = await asyncio.gather(*(batchers['table'].submit(crop) for crop in cropped))
         case _:
-            all_predictions: list[OCRResult] = []
-            for region in regions:
-                cropped = image.crop((region.xtl, region.ytl, region.xbr, region.ybr))
-                predictions = recognition_predictor([cropped], det_predictor=detection_predictor)
-                adjusted_preds = [
-                    shift_ocr_result(pred, region.xtl, region.ytl) for pred in predictions
-                ]
-                all_predictions.extend(adjusted_preds)
-            merged = merge_ocr_results(all_predictions)
-            return {"predictions": [merged]}
-
-
+            type = 'ocr'
+            region_detections = await asyncio.gather(*(batchers['detection'].submit(crop) for crop in cropped))
+            predictions = await asyncio.gather(*(
+                batchers['recognition'].submit((crop, [box.polygon for box in detection.bboxes]))
+                for crop, detection in zip(cropped, region_detections)
+            ))
+
+    def shift_and_merge():
+        # Résultats convertis en tableaux : un décalage vectorisé par région, puis concaténation
+        adjusted_preds = []
+        for pred, region in zip(predictions, regions):
+            pred_arrays = ResultArrays.from_result(type, pred)
+            pred_arrays.shift(region.xtl, region.ytl)
+            adjusted_preds.append(pred_arrays)
+        return ResultArrays.merge(type, adjusted_preds)
+    merged = await run_in_threadpool(shift_and_merge)
+    if type == 'ocr':
+        # Lignes par seconde : rate(mezanno_surya_lines_total) / rate(..._sum{stage="surya.predict_ocr"})
+        OCR_LINES.inc(len(merged.fields['text_lines']))
+    return merged
+
+def fill_table_cells(table: ResultArrays, ocr: ResultArrays):
+    """Affecte chaque ligne OCR à la cellule de table qui contient son centre (coordonnées de la page)."""
+    lines, cells = ocr.fields['text_lines'], table.fields['cells']
+    if len(lines) == 0 or len(cells) == 0:
+        return
+    line_bboxes, cell_bboxes = lines.bboxes(), cells.bboxes()
+    centers = (line_bboxes[:, :2] + line_bboxes[:, 2:]) / 2
+    # (lignes, cellules) : le centre de la ligne est dans la cellule
+    inside = ((cell_bboxes[None, :, :2] <= centers[:, None, :]) & (centers[:, None, :] <= cell_bboxes[None, :, 2:])).all(axis=2)
+    line_polygons = lines.polygons.tolist()
+    # Première cellule contenant chaque ligne
+    first_cells = inside.argmax(axis=1)
+    for line_index in np.flatnonzero(inside.any(axis=1)):
+        cell_index = first_cells[line_index]
+        cell_attrs, line_attrs = cells.attrs[cell_index], lines.attrs[line_index]
+        if cell_attrs.get('text_lines') is None:
+            cell_attrs['text_lines'] = []
+        cell_attrs['text_lines'].append({"text": line_attrs['text'], "polygon": line_polygons[line_index],
+                                         "confidence": line_attrs['confidence']})
 
 # Pour lancer le serveur (localhost:8000) :
-# ~/venv/surya/bin/uvicorn surya_server:app --reload
-# !! Nécessite la création d'un venv python où l'on installera : python3 -m pip install surya-ocr fastapi uvicorn pillow requests
+# PYTHONPATH=../shared ~/venv/surya/bin/uvicorn surya_server:app --reload
+# !! Nécessite la création d'un venv python où l'on installera : python3 -m pip install surya-ocr fastapi uvicorn pillow httpx
 # Ainsi que : sudo apt install uvicorn
 